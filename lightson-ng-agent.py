@@ -0,0 +1,782 @@
+#!/usr/bin/env python3
+
+"""
+ User session agent. Helper for lightson-ng program.
+
+ Copyright (c) 2022 grytsenko.alexander at gmail com
+ URL: https://github.com/LehValensa/lightson-ng
+ This script is licensed under GNU GPL version 2.0 or above
+
+ Agent:
+   - runs inside the GUI session of the user, started by lightson-ng-agent.desktop at login.
+   - tracks audio streams of Pulse Audio by subscribing to sink-input events.
+     PipeWire is tracked the same way, since pipewire-pulse speaks the Pulse protocol.
+   - evaluates GUI checks (full-screen app, MPRIS media player) and reads GUI values
+     (idle counter, gnome settings) in-process, when asked by lightson-ng via stats service.
+   - watches gnome settings used by lightson-ng to calculate the loop delay and publishes them when changed.
+   - arms idle watches of Mutter right before the idle/sleep timeouts, so lightson-ng starts the iteration
+     when the timeout is close, instead of polling the idle counter.
+   - holds gnome's idle/sleep inhibitors for stats service, since they live while their holder is in the session bus.
+   - publishes collected data to lightson-ng-stat DBUS service, so lightson-ng (running as root)
+     reads it with one DBUS call instead of running tools in the GUI session via sudo.
+ Agent finds the stats service either in system bus (lightson-ng runs as root) or in session bus,
+ and re-publishes its data every time the stats service (re)appears.
+ Limitation: agent checks only its own session, i.e. the display of its DISPLAY, and the stats service
+ accepts the data from the user of the active GUI session only. Other X displays or seats are not checked,
+ the same as by getGuiVariables() of lightson-ng, which finds a single active GUI session.
+"""
+
+import os
+import re
+import signal
+import subprocess
+from fnmatch import fnmatchcase
+
+from gi.repository import Gio, GLib
+
+# Definition of dbus service is here.
+# Take the necessary only.
+statModule = __import__("lightson-ng-stat")
+# Create shortcuts
+log = statModule.log
+log_debug = statModule.log_debug
+log_error = statModule.log_error
+parse_command_line = statModule.parse_command_line
+IF_NAME = statModule.IF_NAME
+SRV_NAME = statModule.SRV_NAME
+OBJ_NAME = statModule.OBJ_NAME
+AGENT_IF_NAME = statModule.AGENT_IF_NAME
+AGENT_OBJ_NAME = statModule.AGENT_OBJ_NAME
+INHIBITOR_WHO = statModule.INHIBITOR_WHO
+
+# Object exported to stats service.
+agentXml = (
+        f"""<node>
+    <interface name='{AGENT_IF_NAME}'>
+        <method name='Inhibit'>
+            <arg type='s' name='Reason' direction='in'/>
+            <arg type='u' name='Flags' direction='in'/>
+            <arg type='u' name='Cookie' direction='out'/>
+        </method>
+        <method name='Uninhibit'>
+            <arg type='u' name='Cookie' direction='in'/>
+        </method>
+    </interface>
+</node>""")
+
+# Delay to collect a burst of audio events into one refresh of sink inputs. [milliseconds]
+AUDIO_REFRESH_DELAY = 100
+
+# Delay before subscribing again when the sound server has gone. [seconds]
+AUDIO_RESUBSCRIBE_DELAY = 5
+
+# Idle monitor of Mutter: idle counter and idle watches.
+IDLE_MONITOR_NAME = "org.gnome.Mutter.IdleMonitor"
+IDLE_MONITOR_PATH = "/org/gnome/Mutter/IdleMonitor/Core"
+
+# Spare time of idle watch, when lightson-ng has not passed its loopSpareTime yet. [seconds]
+IDLE_WATCH_SPARE_TIME = 10
+
+# pactl output is parsed, so it should not be translated.
+PACTL_ENV = {**os.environ, "LC_ALL": "C"}
+
+# Gnome settings read by lightson-ng to calculate the loop delay: schema, key.
+# Published as "schema key" -> value, the same way as readGnomeVariable() is called.
+GNOME_SETTINGS = (
+    ("org.gnome.desktop.session", "idle-delay"),
+    ("org.gnome.settings-daemon.plugins.power", "sleep-inactive-ac-timeout"),
+    ("org.gnome.settings-daemon.plugins.power", "sleep-inactive-battery-timeout"),
+)
+
+# Applications detected by full-screen check, the same as in isAppRunning() of lightson-ng:
+# window class patterns, list of (detect flag, process name pattern, application name playing audio or None).
+FULLSCREEN_APPS = (
+    (("*[Cc]hromium*",), (("detectFsChromiumFlash", "chromium --type=ppapi", None),
+                          ("detectFsHtml5", "chromium", "chromium"))),
+    (("*[Cc]hrome*",), (("detectFsChromiumFlash", "chrome --type=ppapi", None),
+                        ("detectFsHtml5", "chrome", "chrom"))),
+    (("*[Ff]irefox*",), (("detectFsHtml5", "firefox", "firefox"),)),
+    (("*[Bb]rave*",), (("detectFsChromiumFlash", "brave --type=ppapi", None),
+                       ("detectFsHtml5", "brave", "brave"))),
+    (("*opera*",), (("detectFsHtml5", "opera", "opera"),)),
+    (("*epiphany*",), (("detectFsHtml5", "epiphany", "epiphany"),)),
+    (("*unknown*", "*plugin-container*"), (("detectFsFirefoxFlash", "plugin-container", None),)),
+    (("*WebKitPluginProcess*",), (("detectFsWebkitFlash", ".*WebKitPluginProcess.*flashp.*", None),)),
+    (("*MPlayer", "mplayer*"), (("detectFsMplayer", "mplayer", "mplayer"),)),
+    (("*plexmediaplayer*",), (("detectFsPlex", "plexmediaplayer", "Plex Media Player"),)),
+    (("*vlc*", "*VLC*"), (("detectFsVlc", "vlc", "vlc"),)),
+    (("*totem*",), (("detectFsTotem", "totem", "totem"),)),
+    (("*steam*",), (("detectFsStream", "steam", None),)),
+    (("*minitube*",), (("detectFsMiniTube", "minitube", None),)),
+)
+
+
+class AudioTracker:
+    """
+    Track audio streams (sink inputs) of the Pulse Audio server.
+    "pactl subscribe" holds one connection to the sound server and prints an event on every change of sink inputs,
+    so sink inputs are re-read only when something has really changed, once per burst of events.
+    The result is an indexed map: application name (lowercase) -> at least one stream of application is running.
+    Stream is considered running when it is not corked, that is the same as "state: RUNNING" of pacmd.
+    """
+
+    def __init__(self, on_change):
+        """
+        Subscribe to audio events and read the initial state of streams.
+        :param on_change: function called with the new map of applications when it is changed.
+        """
+        self.on_change = on_change
+        self.apps = {}
+        self.subscriber = None
+        self.event_buffer = b""
+        self.refresh_id = None
+        self.subscribe()
+
+    def subscribe(self):
+        """
+        Start "pactl subscribe" and watch its output from the main loop.
+        :return: False to stop GLib timer when called as resubscribe timer.
+        """
+        try:
+            self.subscriber = subprocess.Popen(["pactl", "subscribe"], stdout=subprocess.PIPE,
+                                               stderr=subprocess.DEVNULL, env=PACTL_ENV)
+        except (OSError, Exception):
+            log_error("can not subscribe to audio events")
+            self.resubscribe()
+            return False
+
+        GLib.io_add_watch(self.subscriber.stdout.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR,
+                          self.on_event)
+        log("Subscribed to audio events")
+        self.refresh()
+        return False
+
+    def resubscribe(self):
+        """
+        The sound server has gone (or is restarting): no streams are playing until it is back.
+        """
+        self.subscriber = None
+        self.update({})
+        GLib.timeout_add_seconds(AUDIO_RESUBSCRIBE_DELAY, self.subscribe)
+
+    # noinspection PyUnusedLocal
+    def on_event(self, fd, condition):
+        """
+        Read events printed by "pactl subscribe", example: Event 'change' on sink-input #42
+        Only sink-input events schedule the refresh.
+        :return: True to keep watching, False to remove the watch.
+        """
+        data = b""
+        if condition & GLib.IOCondition.IN:
+            data = os.read(fd, 4096)
+
+        if not data:
+            log("Audio events subscription is lost")
+            self.subscriber.wait()
+            self.resubscribe()
+            return False
+
+        self.event_buffer += data
+        *lines, self.event_buffer = self.event_buffer.split(b"\n")
+        if any(b"on sink-input" in line for line in lines) and self.refresh_id is None:
+            self.refresh_id = GLib.timeout_add(AUDIO_REFRESH_DELAY, self.refresh)
+
+        return True
+
+    def refresh(self):
+        """
+        Read all sink inputs and rebuild the map of applications.
+        :return: False to stop GLib timer.
+        """
+        self.refresh_id = None
+        try:
+            output = subprocess.run(["pactl", "list", "sink-inputs"], stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, env=PACTL_ENV, check=True).stdout.decode()
+        except (OSError, subprocess.CalledProcessError, Exception):
+            log_error("can not list sink inputs")
+            return False
+
+        self.update(self.parse_sink_inputs(output))
+        return False
+
+    @staticmethod
+    def parse_sink_inputs(output):
+        """
+        Parse "pactl list sink-inputs" output into the map of applications.
+        :param output: text printed by pactl.
+        :return: dictionary: application name (lowercase) -> any stream of application is running.
+        """
+        apps = {}
+        running = False
+        for line in output.splitlines():
+            line = line.strip()
+            if line.startswith("Sink Input #"):
+                running = False
+            elif line.startswith("Corked:"):
+                running = line.split(":", 1)[1].strip() == "no"
+            else:
+                match = re.match(r'application\.name = "(.*)"$', line)
+                if match:
+                    app_name = match.group(1).lower()
+                    apps[app_name] = apps.get(app_name, False) or running
+        return apps
+
+    def update(self, apps):
+        """
+        Store the new map of applications and report it if changed.
+        :param apps: dictionary: application name -> stream is running.
+        """
+        if apps != self.apps:
+            self.apps = apps
+            log("Audio streams changed: " + str(apps))
+            self.on_change(apps)
+
+    def stop(self):
+        """
+        Stop the subscription.
+        """
+        if self.subscriber is not None:
+            self.subscriber.terminate()
+            self.subscriber.wait()
+            self.subscriber = None
+
+
+class SessionChecks:
+    """
+    GUI checks and GUI values of lightson-ng evaluated in-process, inside the GUI session.
+    lightson-ng (running as root) does the same by running every command via sudo with GUI environment reloaded,
+    which is the most expensive part of its iteration.
+    Settings of checks (detect* flags, windowName...) are passed by lightson-ng with every request.
+    """
+
+    def __init__(self, audio_tracker, settings_tracker):
+        """
+        :param audio_tracker: AudioTracker to answer audio queries of full-screen check.
+        :param settings_tracker: GnomeSettingsTracker to answer gnome settings.
+        """
+        self.audio_tracker = audio_tracker
+        self.settings_tracker = settings_tracker
+        self.settings = {}
+        self.process_names = None
+        self.session_bus = Gio.bus_get_sync(Gio.BusType.SESSION)
+
+    def evaluate(self, settings):
+        """
+        Evaluate enabled checks and read GUI values.
+        :param settings: dictionary with lightson-ng settings: "detectMediaPlayerPlaying" -> "1", etc.
+        :return: dictionary: check name -> disable reason (empty if check is false), value name -> value.
+        """
+        self.settings = settings
+        self.process_names = None
+        results = {"user": GLib.get_user_name()}
+
+        for check_name, check_flag, check_function in (
+                ("isFullscreenAppPlayingCheck", "detectFullscreenAppPlaying", self.is_fullscreen_app_playing),
+                ("isMediaPlayerPlayingCheck", "detectMediaPlayerPlaying", self.is_media_player_playing)):
+            if not self.is_flag_set(check_flag):
+                continue
+            try:
+                results[check_name] = check_function()
+            except (ValueError, Exception):
+                # lightson-ng will execute the check itself.
+                log_error("can not evaluate " + check_name)
+
+        idle_counter = self.get_idle_counter()
+        if idle_counter is not None:
+            results["idleCounter"] = str(idle_counter)
+
+        results.update(self.settings_tracker.values)
+        return results
+
+    def is_flag_set(self, flag_name):
+        """
+        :param flag_name: name of lightson-ng flag.
+        :return: True if flag is set to 1.
+        """
+        return self.settings.get(flag_name, "0") == "1"
+
+    @staticmethod
+    def xprop(*args):
+        """
+        Run xprop in the GUI session.
+        :param args: xprop arguments.
+        :return: xprop output, empty string on error.
+        """
+        try:
+            return subprocess.run(["xprop", *args], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                  timeout=5).stdout.decode(errors="replace")
+        except (OSError, subprocess.TimeoutExpired, Exception):
+            return ""
+
+    def is_fullscreen_app_playing(self):
+        """
+        The same as isFullscreenAppPlayingCheck() of lightson-ng, for the screen of agent's DISPLAY:
+        the active window is in full-screen state and is a known application running,
+        or a window named by windowName is full-screen and audio is playing.
+        :return: disable reason or empty string.
+        """
+        active_win = re.search(r"window id # (0x[0-9a-fA-F]+)", self.xprop("-root", "_NET_ACTIVE_WINDOW"))
+        if active_win:
+            # Both state and class of window with one xprop call.
+            active_props = self.xprop("-id", active_win.group(1), "_NET_WM_STATE", "WM_CLASS")
+            if "_NET_WM_STATE_FULLSCREEN" in active_props:
+                win_class = re.search(r'WM_CLASS\(STRING\) = .*"(.*)"', active_props)
+                if self.is_app_running(win_class.group(1) if win_class else ""):
+                    return "full screen app is running"
+
+        window_name = self.settings.get("windowName", "")
+        if window_name \
+                and "_NET_WM_STATE_FULLSCREEN" in self.xprop("-name", window_name, "_NET_WM_STATE") \
+                and any(self.audio_tracker.apps.values()):
+            return "full screen app is playing audio"
+
+        return ""
+
+    def is_app_running(self, win_class):
+        """
+        The same as isAppRunning() of lightson-ng: check if a known application owns the full-screen window.
+        :param win_class: class of active window.
+        :return: True if application process exists and (optionally) is playing audio.
+        """
+        for class_patterns, app_list in FULLSCREEN_APPS:
+            if any(fnmatchcase(win_class, pattern) for pattern in class_patterns):
+                return any(self.is_flag_set(flag) and self.is_process_playing(process, audio_app)
+                           for flag, process, audio_app in app_list)
+
+        chrome_app_name = self.settings.get("detectFsChromeAppName", "")
+        return bool(chrome_app_name) and chrome_app_name in win_class and self.is_process_playing("chrome --app")
+
+    def is_process_playing(self, process_pattern, audio_app=None):
+        """
+        The same as isProcessPlaying() of lightson-ng: process exists and (optionally) is playing audio.
+        Process names are read from /proc once per evaluation and are matched as pgrep does.
+        :param process_pattern: regular expression of process name.
+        :param audio_app: (optional) application name to find in audio streams.
+        :return: True if process exists and (optionally) is playing audio.
+        """
+        if self.process_names is None:
+            self.process_names = []
+            for pid in filter(str.isdigit, os.listdir("/proc")):
+                try:
+                    with open("/proc/" + pid + "/comm") as comm_file:
+                        self.process_names.append(comm_file.read().strip())
+                except OSError:
+                    pass
+
+        if not any(re.search(process_pattern, name) for name in self.process_names):
+            return False
+
+        if audio_app is None:
+            return True
+
+        if not self.is_flag_set("detectFsAudioStreaming"):
+            return False
+
+        return any(audio_app.lower() in app for app in self.audio_tracker.apps)
+
+    def is_media_player_playing(self):
+        """
+        The same as isMediaPlayerPlayingCheck() of lightson-ng: any MPRIS media player is playing.
+        :return: disable reason or empty string.
+        """
+        names = self.session_bus.call_sync("org.freedesktop.DBus", "/org/freedesktop/DBus", "org.freedesktop.DBus",
+                                           "ListNames", None, GLib.VariantType("(as)"),
+                                           Gio.DBusCallFlags.NONE, 1000, None).unpack()[0]
+
+        for player in filter(lambda name: name.startswith("org.mpris.MediaPlayer2."), names):
+            try:
+                status = self.session_bus.call_sync(player, "/org/mpris/MediaPlayer2",
+                                                    "org.freedesktop.DBus.Properties", "Get",
+                                                    GLib.Variant("(ss)", ("org.mpris.MediaPlayer2.Player",
+                                                                          "PlaybackStatus")),
+                                                    GLib.VariantType("(v)"),
+                                                    Gio.DBusCallFlags.NONE, 1000, None).unpack()[0]
+            except (ValueError, Exception):
+                continue
+            if status == "Playing":
+                return "MPRIS Media Player is playing"
+
+        return ""
+
+    def get_idle_counter(self):
+        """
+        The same as getIdleCounter() of lightson-ng: the current value of Gnome's idle counter.
+        :return: idle time in seconds, None if not available.
+        """
+        try:
+            idle_time = self.session_bus.call_sync(IDLE_MONITOR_NAME, IDLE_MONITOR_PATH,
+                                                   IDLE_MONITOR_NAME, "GetIdletime", None,
+                                                   GLib.VariantType("(t)"), Gio.DBusCallFlags.NONE,
+                                                   1000, None).unpack()[0]
+        except (ValueError, Exception):
+            log_error("can not get idle counter")
+            return None
+        return idle_time // 1000
+
+
+class GnomeSettingsTracker:
+    """
+    Watch gnome settings lightson-ng needs, the same as readGnomeVariable() of lightson-ng reads.
+    Values are re-read only when gsettings notifies about the change.
+    """
+
+    def __init__(self, on_change):
+        """
+        Read the settings and start watching them. Schema is looked up first,
+        because Gio aborts the program when schema is missing.
+        :param on_change: function called with the new values when any setting is changed.
+        """
+        self.on_change = on_change
+        self.settings = []
+
+        schema_source = Gio.SettingsSchemaSource.get_default()
+        for schema, key in GNOME_SETTINGS:
+            settings_schema = schema_source.lookup(schema, True) if schema_source else None
+            if settings_schema is None or not settings_schema.has_key(key):
+                continue
+            settings = Gio.Settings.new(schema)
+            settings.connect("changed::" + key, self.on_setting_changed)
+            self.settings.append((settings, schema, key))
+
+        # Note: reading the value is also needed to receive notifications about its changes.
+        self.values = self.read()
+
+    def read(self):
+        """
+        :return: dictionary: "schema key" -> value.
+        """
+        return {schema + " " + key: str(settings.get_value(key).unpack()) for settings, schema, key in self.settings}
+
+    # noinspection PyUnusedLocal
+    def on_setting_changed(self, settings, key):
+        """
+        Setting is changed by user or by program.
+        """
+        self.values = self.read()
+        log("Gnome settings changed: " + str(self.values))
+        self.on_change(self.values)
+
+
+class IdleScheduler:
+    """
+    Wake lightson-ng up right before the idle/sleep timeout is reached, instead of polling the idle counter.
+    An idle watch of Mutter fires every time the idle counter crosses its interval, so a watch is armed
+    for every gnome timeout minus the spare time of lightson-ng. When the watch fires, stats service breaks
+    the loop delay. One user-active watch is armed then: the user is back and the loop delay is planned again.
+    Watches are re-armed when gnome settings or lightson-ng settings are changed.
+    """
+
+    def __init__(self, session_bus, settings_tracker, on_fire):
+        """
+        :param session_bus: connection to the session bus, watches belong to it.
+        :param settings_tracker: GnomeSettingsTracker to take the timeouts from.
+        :param on_fire: function called with the reason when lightson-ng should start the iteration.
+        """
+        self.session_bus = session_bus
+        self.settings_tracker = settings_tracker
+        self.on_fire = on_fire
+        self.enabled = False
+        self.spare_time = IDLE_WATCH_SPARE_TIME
+        # watch id -> (setting name, interval in seconds)
+        self.watches = {}
+        self.active_watch_id = None
+        self.subscription_id = session_bus.signal_subscribe(IDLE_MONITOR_NAME, IDLE_MONITOR_NAME, "WatchFired",
+                                                            IDLE_MONITOR_PATH, None, Gio.DBusSignalFlags.NONE,
+                                                            self.on_watch_fired)
+
+    def configure(self, settings):
+        """
+        Take the settings of lightson-ng passed with every request, and re-arm watches if they are changed.
+        :param settings: dictionary with lightson-ng settings: "useIdleScheduler" -> "1", "loopSpareTime" -> "10".
+        """
+        enabled = settings.get("useIdleScheduler", "0") == "1"
+        try:
+            spare_time = int(settings.get("loopSpareTime", IDLE_WATCH_SPARE_TIME))
+        except ValueError:
+            spare_time = IDLE_WATCH_SPARE_TIME
+
+        if (enabled, spare_time) != (self.enabled, self.spare_time):
+            self.enabled = enabled
+            self.spare_time = spare_time
+            self.rearm()
+
+    def call_monitor(self, method_name, parameters, reply_type):
+        """
+        Call the method of Mutter's idle monitor.
+        :return: unpacked reply, None on error.
+        """
+        try:
+            return self.session_bus.call_sync(IDLE_MONITOR_NAME, IDLE_MONITOR_PATH, IDLE_MONITOR_NAME, method_name,
+                                              parameters, reply_type, Gio.DBusCallFlags.NONE, 1000, None).unpack()
+        except (GLib.Error, Exception):
+            log_error("can not call " + method_name + " of idle monitor")
+            return None
+
+    def remove_watches(self):
+        """
+        Remove all watches armed.
+        """
+        for watch_id in list(self.watches) + ([self.active_watch_id] if self.active_watch_id is not None else []):
+            self.call_monitor("RemoveWatch", GLib.Variant("(u)", (watch_id,)), None)
+        self.watches = {}
+        self.active_watch_id = None
+
+    def rearm(self):
+        """
+        Arm idle watches for gnome timeouts which are set (0 means never).
+        """
+        self.remove_watches()
+        if not self.enabled:
+            return
+
+        for name, value in self.settings_tracker.values.items():
+            try:
+                timeout = int(value)
+            except ValueError:
+                continue
+            if timeout <= 0:
+                continue
+            interval = max(timeout - self.spare_time, 1)
+            reply = self.call_monitor("AddIdleWatch", GLib.Variant("(t)", (interval * 1000,)), GLib.VariantType("(u)"))
+            if reply is not None:
+                self.watches[reply[0]] = (name, interval)
+
+        log_debug("Idle watches armed: " + self.describe())
+
+    def describe(self):
+        """
+        :return: armed watches as "setting name=interval,..." or empty string if none is armed.
+        """
+        return ",".join(name + "=" + str(interval) for name, interval in self.watches.values())
+
+    # noinspection PyUnusedLocal
+    def on_watch_fired(self, connection, sender_name, object_path, interface_name, signal_name, parameters):
+        """
+        Idle counter crossed the interval of idle watch, or the user became active.
+        """
+        watch_id = parameters.unpack()[0]
+        if watch_id in self.watches:
+            name, interval = self.watches[watch_id]
+            # The user-active watch fires once, arm it again after every idle watch fired.
+            if self.active_watch_id is None:
+                reply = self.call_monitor("AddUserActiveWatch", None, GLib.VariantType("(u)"))
+                if reply is not None:
+                    self.active_watch_id = reply[0]
+            self.on_fire("idle for " + str(interval) + " seconds, close to " + name)
+
+        elif watch_id == self.active_watch_id:
+            self.active_watch_id = None
+            self.on_fire("user is active")
+
+    def stop(self):
+        """
+        Remove watches and stop listening to them.
+        """
+        self.remove_watches()
+        self.session_bus.signal_unsubscribe(self.subscription_id)
+
+
+class LightsonAgent:
+    """
+    lightson-ng-agent main object: runs trackers in the GUI session and publishes their data
+    to lightson-ng-stat DBUS service.
+    """
+
+    def __init__(self):
+        self.stats_bus = None
+        self.watch_ids = []
+
+        self.evaluate_subscription_id = None
+        self.stats_owner = None
+        self.agent_reg_id = None
+        self.node_info = Gio.DBusNodeInfo.new_for_xml(agentXml)
+
+        self.audio_tracker = AudioTracker(self.publish_audio_state)
+        self.settings_tracker = GnomeSettingsTracker(self.on_gnome_settings_changed)
+        self.session_checks = SessionChecks(self.audio_tracker, self.settings_tracker)
+        self.idle_scheduler = IdleScheduler(self.session_checks.session_bus, self.settings_tracker,
+                                            self.on_idle_watch_fired)
+
+        # Stats service is in system bus when lightson-ng runs as root, in session bus otherwise.
+        for bus_type in (Gio.BusType.SYSTEM, Gio.BusType.SESSION):
+            try:
+                self.watch_ids.append(Gio.bus_watch_name(bus_type, SRV_NAME, Gio.BusNameWatcherFlags.NONE,
+                                                         self.on_stats_appeared, self.on_stats_vanished))
+            except (ValueError, Exception):
+                log_error("can not watch " + SRV_NAME + " service in DBUS.")
+
+    # noinspection PyUnusedLocal
+    def on_stats_appeared(self, connection, name, owner):
+        """
+        Stats service is (re)started: publish everything collected so far.
+        """
+        log("Stats service appeared: " + owner)
+        self.unsubscribe_stats_signals()
+        self.stats_bus = connection
+        self.stats_owner = owner
+        try:
+            self.agent_reg_id = connection.register_object(AGENT_OBJ_NAME, self.node_info.interfaces[0],
+                                                           self.handle_method_call, None, None)
+        except (GLib.Error, Exception):
+            log_error("can not export " + AGENT_OBJ_NAME + " object to stats service")
+        self.evaluate_subscription_id = connection.signal_subscribe(SRV_NAME, IF_NAME, "EvaluateSessionChecksSignal",
+                                                                    OBJ_NAME, None, Gio.DBusSignalFlags.NONE,
+                                                                    self.on_evaluate_request)
+        self.publish_audio_state(self.audio_tracker.apps)
+        self.publish_gnome_settings(self.settings_tracker.values)
+
+    # noinspection PyUnusedLocal
+    def on_stats_vanished(self, connection, name):
+        """
+        Stats service has gone. Wait until it appears again.
+        """
+        if connection == self.stats_bus:
+            log("Stats service has gone")
+            self.unsubscribe_stats_signals()
+            self.stats_bus = None
+
+    def unsubscribe_stats_signals(self):
+        """
+        Stop listening to signals of stats service.
+        """
+        if self.stats_bus is not None and self.evaluate_subscription_id is not None:
+            self.stats_bus.signal_unsubscribe(self.evaluate_subscription_id)
+        self.evaluate_subscription_id = None
+
+        if self.stats_bus is not None and self.agent_reg_id is not None:
+            self.stats_bus.unregister_object(self.agent_reg_id)
+        self.agent_reg_id = None
+
+    # noinspection PyUnusedLocal
+    def handle_method_call(self, connection, sender, object_path, interface_name, method_name, params, invocation):
+        """
+        Handle the calls of stats service: add/remove gnome's inhibitors.
+        The inhibitor is held by connection of the agent to the session bus, so it is removed if the agent exits.
+        """
+        if sender != self.stats_owner:
+            invocation.return_dbus_error("org.freedesktop.DBus.Error.AccessDenied", "Only stats service may call")
+            return
+
+        session_bus = self.session_checks.session_bus
+        if method_name == "Inhibit":
+            reason, flags = params.unpack()
+            session_bus.call("org.gnome.SessionManager", "/org/gnome/SessionManager", "org.gnome.SessionManager",
+                             "Inhibit", GLib.Variant("(susu)", (INHIBITOR_WHO, 0, reason, flags)),
+                             GLib.VariantType("(u)"), Gio.DBusCallFlags.NONE, -1, None,
+                             self.on_inhibit_finished, invocation)
+
+        elif method_name == "Uninhibit":
+            session_bus.call("org.gnome.SessionManager", "/org/gnome/SessionManager", "org.gnome.SessionManager",
+                             "Uninhibit", params, None, Gio.DBusCallFlags.NONE, -1, None,
+                             self.on_call_finished, method_name)
+            invocation.return_value(None)
+
+        else:
+            invocation.return_error_literal(Gio.dbus_error_quark(), Gio.DBusError.UNKNOWN_METHOD,
+                                            "No such method on interface: %s.%s" % (interface_name, method_name))
+
+    # noinspection PyMethodMayBeStatic
+    def on_inhibit_finished(self, connection, result, invocation):
+        """
+        Reply the cookie of gnome's inhibitor to stats service.
+        """
+        try:
+            invocation.return_value(connection.call_finish(result))
+            log("Gnome inhibitor is added")
+        except GLib.Error as error:
+            log_error("can not add gnome inhibitor")
+            invocation.return_gerror(error)
+
+    # noinspection PyUnusedLocal
+    def on_evaluate_request(self, connection, sender_name, object_path, interface_name, signal_name, parameters):
+        """
+        lightson-ng asks to evaluate GUI checks: evaluate them in-process and push the results.
+        :param parameters: lightson-ng settings as "name=value" strings.
+        """
+        settings = dict(setting.split("=", 1) for setting in parameters.unpack()[0] if "=" in setting)
+        log_debug("Evaluating session checks")
+        self.idle_scheduler.configure(settings)
+        results = self.session_checks.evaluate(settings)
+        idle_watches = self.idle_scheduler.describe()
+        if idle_watches:
+            results["idleWatches"] = idle_watches
+        self.call_stats_method("SetSessionResults", GLib.Variant("(a{ss})", (results,)))
+
+    def on_idle_watch_fired(self, reason):
+        """
+        Idle scheduler tells it is time for lightson-ng to start the iteration.
+        :param reason: why the iteration is needed.
+        """
+        log("Idle watch fired: " + reason)
+        self.call_stats_method("IdleWatchFired", GLib.Variant("(s)", (reason,)))
+
+    def on_gnome_settings_changed(self, values):
+        """
+        Gnome settings are changed: publish them and re-arm idle watches for the new timeouts.
+        :param values: dictionary: "schema key" -> value.
+        """
+        self.publish_gnome_settings(values)
+        self.idle_scheduler.rearm()
+
+    def call_stats_method(self, method_name, parameters):
+        """
+        Asynchronously call the method of stats service, so the agent never blocks on DBUS.
+        :param method_name: the name of dbus method.
+        :param parameters: GLib.Variant tuple with method parameters.
+        """
+        if self.stats_bus is None:
+            return
+
+        self.stats_bus.call(SRV_NAME, OBJ_NAME, IF_NAME, method_name, parameters, None,
+                            Gio.DBusCallFlags.NONE, -1, None, self.on_call_finished, method_name)
+
+    # noinspection PyMethodMayBeStatic
+    def on_call_finished(self, connection, result, method_name):
+        """
+        Check the result of asynchronous call.
+        """
+        try:
+            connection.call_finish(result)
+        except (ValueError, Exception):
+            log_error("can not call " + method_name)
+
+    def publish_audio_state(self, apps):
+        """
+        Send the map of audio applications to stats service.
+        :param apps: dictionary: application name -> stream is running.
+        """
+        self.call_stats_method("SetAudioState", GLib.Variant("(a{sb})", (apps,)))
+
+    def publish_gnome_settings(self, values):
+        """
+        Send gnome settings to stats service, along with the user they belong to.
+        :param values: dictionary: "schema key" -> value.
+        """
+        self.call_stats_method("SetGnomeSettings",
+                               GLib.Variant("(a{ss})", ({**values, "user": GLib.get_user_name()},)))
+
+    def stop(self):
+        """
+        Stop trackers and stop watching the stats service.
+        """
+        for watch_id in self.watch_ids:
+            Gio.bus_unwatch_name(watch_id)
+        self.idle_scheduler.stop()
+        self.audio_tracker.stop()
+
+
+if __name__ == '__main__':
+    # Parse command line
+    cmdline = parse_command_line("lightson-ng-agent - user session agent for lightson-ng")
+
+    # A loop to handle both trackers and DBUS
+    mainloop = GLib.MainLoop()
+
+    agent = LightsonAgent()
+
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, mainloop.quit)
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGTERM, mainloop.quit)
+    mainloop.run()
+
+    agent.stop()
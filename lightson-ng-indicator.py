@@ -14,9 +14,11 @@
 
 import sys
 import os
+import json
 import time
 import subprocess
 import signal
+from bisect import bisect_left
 from threading import Thread
 # import traceback
 from queue import Queue, Empty
@@ -42,6 +44,7 @@ warnings.filterwarnings("ignore", category=DeprecationWarning, message='AppIndic
 statModule = __import__("lightson-ng-stat")
 # Create shortcuts
 log = statModule.log
+log_debug = statModule.log_debug
 # OPTIMIZE: log_error is extended in LightsonIndicator. Create class for logging.
 log_error_stat = statModule.log_error
 parse_command_line = statModule.parse_command_line
@@ -49,6 +52,7 @@ IF_NAME = statModule.IF_NAME
 SRV_NAME = statModule.SRV_NAME
 OBJ_NAME = statModule.OBJ_NAME
 StatObject = statModule.StatObject
+StatsSnapshotReader = statModule.StatsSnapshotReader
 SYSTEMD_LIGHTSON_SERVICE = statModule.SYSTEMD_LIGHTSON_SERVICE
 SERVICE_OPERATION_TIMEOUT = statModule.SERVICE_OPERATION_TIMEOUT
 
@@ -95,6 +99,7 @@ class LightsonIndicator:
     about_dialog = None
     stats_dialog = None
     stats_all = None
+    stats_snapshot = None
     dbus_error = False
     log_win = None
     current_icon = 'dialog-information'
@@ -108,6 +113,9 @@ class LightsonIndicator:
         # Connect to freedesktop notification bus
         self.init_notification()
 
+        # Stats published by lightson-ng stats module to the memory-mapped file.
+        self.stats_snapshot = StatsSnapshotReader()
+
         # Connect to lightson-ng DBUS
         try:
             self.dbus_reconnect_client()
@@ -122,6 +130,17 @@ class LightsonIndicator:
         except (ValueError, Exception):
             self.log_error("can not execute iteration_finished_action.")
 
+    def get_stats(self):
+        """
+        Get the stats of the last iteration from the snapshot file published by stats module:
+        it is a memory read and a check that the stats module is alive, without DBUS round trip. If the snapshot is not available, get the stats by DBUS.
+        :return: dictionary with stats.
+        """
+        stats = self.stats_snapshot.read(check_writer=True)
+        if stats is None:
+            stats = self.call_dbus_method("GetStats")[0]
+        return stats
+
     def call_dbus_method(self, method_name, is_ping=False):
         """
         Synchronously call the method from dbus service.
@@ -181,7 +200,7 @@ class LightsonIndicator:
             # Ping the object by calling its method.
             reply = self.call_dbus_method("PingStats", is_ping=True)[0]
             if reply == "Hello":
-                log("Ping OK")
+                log_debug("Ping OK")
 
         except (ValueError, Exception):
             raise
@@ -266,6 +285,10 @@ class LightsonIndicator:
         item_show_stats.connect('activate', self.on_show_stats)
         menu.append(item_show_stats)
 
+        item_show_config = Gtk.MenuItem(label='Show config')
+        item_show_config.connect('activate', self.on_show_config)
+        menu.append(item_show_config)
+
         item_show_logs = Gtk.MenuItem(label='Show logs')
         item_show_logs.connect('activate', self.on_show_logs)
         menu.append(item_show_logs)
@@ -404,13 +427,35 @@ class LightsonIndicator:
 
         try:
             # refresh statistics
-            self.stats_all = self.call_dbus_method("GetStats")[0]
+            self.stats_all = self.get_stats()
         except (ValueError, Exception):
             self.log_error("can not get statistics")
             raise
 
-        # log(self.stats_all)
-        win = LightsonStatisticsWindow(self.stats_all)
+        # The window is created once, and then is only shown again: it is kept up to date by iterations.
+        if self.stats_dialog is None:
+            self.stats_dialog = LightsonStatisticsWindow(self.stats_all, hide_on_close=True)
+        else:
+            self.stats_dialog.update_stats(self.stats_all)
+            self.stats_dialog.present()
+
+    # noinspection PyUnusedLocal
+    def on_show_config(self, source):
+        """
+        Display the window with configuration of lightson-ng, as parsed by config watcher of stats module.
+        The window is the same as statistics window, so config variables can be filtered by buttons.
+        :param source:
+        :return:
+        """
+        log("Showing config window")
+
+        try:
+            generation, config = self.call_dbus_method("GetConfig")
+        except (ValueError, Exception):
+            self.log_error("can not get config")
+            raise
+
+        win = LightsonStatisticsWindow(config, title="lightson-ng config, generation %d" % generation)
 
     # noinspection PyUnresolvedReferences
     def systemd_operation(self, action):
@@ -543,7 +588,7 @@ class LightsonIndicator:
         :param args:
         :return:
         """
-        log(f"Received signal: {signal_name}")
+        log_debug(f"Received signal: {signal_name}")
 
         if signal_name == "IterationFinishedSignal":
             self.iteration_finished_action()
@@ -565,9 +610,13 @@ class LightsonIndicator:
         Send the desktop notification (for verbose mode only) with details of status.
         :return:
         """
-        log("Executing iteration_finished_action()")
+        log_debug("Executing iteration_finished_action()")
+
+        self.stats_all = self.get_stats()
 
-        self.stats_all = self.call_dbus_method("GetStats")[0]
+        # Live statistics window: only rows changed by the iteration are updated.
+        if self.stats_dialog is not None and self.stats_dialog.get_visible():
+            self.stats_dialog.update_stats(self.stats_all)
 
         if len(self.stats_all['disableReason_idle']) > 0:
             label_text = "X"
@@ -586,14 +635,14 @@ class LightsonIndicator:
         elif "-" in label_text:
             self.set_icon("semi-starred")
         else:
-            log("current label:" + label_text)
+            log_debug("current label:" + label_text)
             self.set_icon("dialog-warning")
 
         if int(self.stats_all["runtimeErrors"]) > 0:
             label_text = "ERR"
 
         self.app_indicator.set_label(label_text, self.app_id)
-        log("label_text: " + label_text)
+        log_debug("label_text: " + label_text)
 
         self.send_notification("Checks status: [" + label_text + "] Disable reasons: ",
                                "For idle mode: [" + self.stats_all['disableReason_idle'] + "]" + "\n" +
@@ -683,20 +732,50 @@ class LightsonStatisticsWindow(Gtk.Window):
     All - all stats collected
     disableReason - all disable reasons
     checkPerformed - all checks performed
+    The window can be updated by new stats: rows are found by the index of their keys,
+    and only the rows changed are touched, so the filter and the view re-check these rows only.
+    Categories of keys are computed once, when the row is inserted. Visibility of rows is kept in the model
+    and is changed only for rows whose visibility changes, when the view is switched or the keys are searched.
     """
 
-    def __init__(self, stats_all):
+    # Columns of the model.
+    COLUMN_KEY = 0
+    COLUMN_VALUE = 1
+    COLUMN_VISIBLE = 2
+    COLUMN_WEIGHT = 3
+
+    # Categories of stats keys.
+    CATEGORY_DISABLE_REASON = 1
+    CATEGORY_CHECK = 2
+    CATEGORY_MAIN_REASON = 4
+    CATEGORY_FAKE = 8
+
+    # Views selected by buttons, showing the keys of category. "Default view" and "All stats" are special.
+    VIEW_CATEGORIES = {"disableReason": CATEGORY_DISABLE_REASON, "checkPerformed": CATEGORY_CHECK}
+
+    # Main disable reasons, shown even when empty.
+    MAIN_REASONS = ("disableReason_idle", "disableReason_sleep")
+
+    # Stats used to test the interface, not shown in default view.
+    FAKE_STATS = ("permissionsCheck",)
+
+    def __init__(self, stats_all, title="lightson-ng statistics", hide_on_close=False):
         """
         Display a window with statistics
         :param stats_all: dictionary with stats collected.
+        :param title: window title, the name of filter selected is appended to it.
+        :param hide_on_close: hide the window instead of destroying it, to show it again later.
         """
-        super().__init__(title="lightson-ng statistics: default view")
+        super().__init__(title=title + ": default view")
 
         # Setting up statistics window
-        self.set_title("lightson-ng statistics: default view")
+        self.title_prefix = title
+        self.set_title(self.title_prefix + ": default view")
         self.set_default_size(600, 700)
         self.set_border_width(10)
+        self.hide_on_close = hide_on_close
         self.connect("key-press-event", self.on_key_press_event)
+        self.connect("delete-event", self.on_delete_event)
 
         # Setting up the self.grid in which the elements are to be positioned
         self.grid = Gtk.Grid()
@@ -704,28 +783,42 @@ class LightsonStatisticsWindow(Gtk.Window):
         self.grid.set_row_homogeneous(True)
         self.add(self.grid)
 
-        # Creating the ListStore model
-        self.list_store = Gtk.ListStore(str, str)
+        # Creating the ListStore model: key, value, row is visible, font weight.
+        self.list_store = Gtk.ListStore(str, str, bool, int)
+
+        # Index of rows: key -> TreeIter (iterators of ListStore are persistent), the values shown,
+        # and the keys sorted as the rows are.
+        self.rows = {}
+        self.values = {}
+        self.sorted_keys = []
+        # Categories of keys (CATEGORY_* bits) and lowercase keys for search, computed once per key.
+        self.categories = {}
+        self.search_keys = {}
+        # Keys of visible rows.
+        self.visible_keys = set()
+
+        # The view selected by buttons and the text searched.
+        self.current_filter_key = "Default view"
+        self.search_text = ""
 
         # Put all stats into model
         for Key, Value in sorted(stats_all.items()):
-            self.list_store.append([Key, Value])
+            self.add_row(len(self.sorted_keys), Key, Value)
 
-        # Creating the filter, feeding it with the list_store model
-        self.current_filter_key = "Default view"
+        # Creating the filter, feeding it with the list_store model.
+        # Visibility is kept in the model, so filtering does not call Python for every row.
         self.key_filter = self.list_store.filter_new()
-        # Setting the filter function
-        self.key_filter.set_visible_func(self.stats_dialog_filter)
+        self.key_filter.set_visible_column(self.COLUMN_VISIBLE)
 
         # Creating the treeview, making it use the filter as a model, and adding the columns
         self.treeview = Gtk.TreeView(model=self.key_filter)
+        # Typed text goes to the search entry below.
+        self.treeview.set_enable_search(False)
 
-        # Create two columns with one shared renderer and a shared set_cell_data_func().
+        # Create two columns with one shared renderer. Main nonempty disable reasons are bold.
         renderer_text = Gtk.CellRendererText()
-        column_text1 = Gtk.TreeViewColumn("Key", renderer_text, text=0)
-        column_text2 = Gtk.TreeViewColumn("Value", renderer_text, text=1)
-        column_text1.set_cell_data_func(renderer_text, self.reason_highlight)
-        column_text2.set_cell_data_func(renderer_text, self.reason_highlight)
+        column_text1 = Gtk.TreeViewColumn("Key", renderer_text, text=self.COLUMN_KEY, weight=self.COLUMN_WEIGHT)
+        column_text2 = Gtk.TreeViewColumn("Value", renderer_text, text=self.COLUMN_VALUE, weight=self.COLUMN_WEIGHT)
         self.treeview.append_column(column_text1)
         self.treeview.append_column(column_text2)
 
@@ -736,6 +829,11 @@ class LightsonStatisticsWindow(Gtk.Window):
             self.buttons.append(button)
             button.connect("clicked", self.on_stats_selection_button_clicked)
 
+        # Search keys of the view selected, as they are typed.
+        self.search_entry = Gtk.SearchEntry()
+        self.search_entry.set_placeholder_text("Type to search keys")
+        self.search_entry.connect("search-changed", self.on_search_changed)
+
         # setting up the layout, putting the treeview in a scroll-window, and the buttons in a row
         self.scrollable_tree_list = Gtk.ScrolledWindow()
         self.scrollable_tree_list.set_vexpand(True)
@@ -759,68 +857,132 @@ class LightsonStatisticsWindow(Gtk.Window):
             self.grid.attach_next_to(
                 button, self.buttons[i], Gtk.PositionType.RIGHT, 1, 1
             )
+
+        # Search entry is under the filter buttons.
+        self.grid.attach_next_to(
+            self.search_entry, self.buttons[0], Gtk.PositionType.BOTTOM, len(self.buttons), 1
+        )
         self.scrollable_tree_list.add(self.treeview)
 
         self.show_all()
         self.connect("destroy", self.destroy_stats_dialog)
 
-    # noinspection PyMethodMayBeStatic, PyUnusedLocal
-    def reason_highlight(self, column, renderer, model, iter_index, extra_param):
-        """Mark the main nonempty disable reasons bold"""
+    @classmethod
+    def key_categories(cls, stats_key):
+        """
+        :return: categories of the stats key, as CATEGORY_* bits.
+        """
+        categories = 0
+        if "disableReason" in stats_key:
+            categories |= cls.CATEGORY_DISABLE_REASON
+        if "checkPerformed" in stats_key:
+            categories |= cls.CATEGORY_CHECK
+        if stats_key in cls.MAIN_REASONS:
+            categories |= cls.CATEGORY_MAIN_REASON
+        if stats_key in cls.FAKE_STATS:
+            categories |= cls.CATEGORY_FAKE
+        return categories
+
+    def is_visible(self, stats_key):
+        """Tests if the row of stats key is shown by the view selected and matches the text searched"""
+
+        if self.search_text and self.search_text not in self.search_keys[stats_key]:
+            return False
 
-        stats_key = model[iter_index][0]
-        stats_value = model[iter_index][1]
+        categories = self.categories[stats_key]
 
-        if (stats_key == "disableReason_idle" or stats_key == "disableReason_sleep") \
-                and len(stats_value) > 0:
+        # No filter at all - show everything.
+        if self.current_filter_key == "All stats":
+            return True
 
-            # Switch from plain text to markup which has extended capabilities
-            renderer.set_property("text", None)
+        elif self.current_filter_key == "Default view":
+            # Skipping fake stats and empty disable reasons, but the main ones.
+            return not categories & self.CATEGORY_FAKE \
+                and bool(not categories & self.CATEGORY_DISABLE_REASON or categories & self.CATEGORY_MAIN_REASON
+                         or len(self.values[stats_key]) > 0)
+
+        # Show only values that match the filter
+        return bool(categories & self.VIEW_CATEGORIES.get(self.current_filter_key, 0))
+
+    def row_weight(self, stats_key):
+        """:return: font weight of the row: main nonempty disable reasons are bold"""
+        if self.categories[stats_key] & self.CATEGORY_MAIN_REASON and len(self.values[stats_key]) > 0:
+            return Pango.Weight.BOLD
+        return Pango.Weight.NORMAL
 
-            # Check which column called this renderer and set the emphasized value for corresponding column
-            if column.get_property("title") == "Key":
-                renderer.set_property("markup", "<b>" + stats_key + "</b>")
+    def add_row(self, position, stats_key, stats_value):
+        """
+        Insert the row of the new key and index it.
+        :param position: position of the row in the model, as of the key in the sorted keys.
+        """
+        self.sorted_keys.insert(position, stats_key)
+        self.values[stats_key] = stats_value
+        self.categories[stats_key] = self.key_categories(stats_key)
+        self.search_keys[stats_key] = stats_key.lower()
+        visible = self.is_visible(stats_key)
+        if visible:
+            self.visible_keys.add(stats_key)
+        self.rows[stats_key] = self.list_store.insert(position, [stats_key, stats_value, visible,
+                                                                 self.row_weight(stats_key)])
+
+    def update_row(self, stats_key):
+        """
+        Update visibility of the row, it is touched only if the visibility is changed.
+        """
+        visible = self.is_visible(stats_key)
+        if visible != (stats_key in self.visible_keys):
+            if visible:
+                self.visible_keys.add(stats_key)
             else:
-                renderer.set_property("markup", "<b>" + stats_value + "</b>")
+                self.visible_keys.discard(stats_key)
+            self.list_store.set_value(self.rows[stats_key], self.COLUMN_VISIBLE, visible)
+
+    def apply_filter(self, narrowed=False):
+        """
+        Show the rows of the view selected and matching the text searched.
+        :param narrowed: the text searched is extended: only visible rows can be hidden, others are not checked.
+        """
+        for stats_key in (list(self.visible_keys) if narrowed else self.sorted_keys):
+            self.update_row(stats_key)
+
+    def update_stats(self, stats_all):
+        """
+        Apply the new stats to the model: change the values changed, add new keys at their sorted places,
+        remove the keys which are gone. Rows not changed are not touched.
+        :param stats_all: dictionary with stats collected.
+        """
+        for Key, Value in stats_all.items():
+            if Key not in self.rows:
+                self.add_row(bisect_left(self.sorted_keys, Key), Key, Value)
+            elif self.values[Key] != Value:
+                self.values[Key] = Value
+                self.list_store.set(self.rows[Key], {self.COLUMN_VALUE: Value,
+                                                     self.COLUMN_WEIGHT: self.row_weight(Key)})
+                self.update_row(Key)
+
+        if len(self.values) != len(stats_all):
+            for Key in [Key for Key in self.values if Key not in stats_all]:
+                self.list_store.remove(self.rows.pop(Key))
+                del self.values[Key]
+                del self.categories[Key]
+                del self.search_keys[Key]
+                self.visible_keys.discard(Key)
+                self.sorted_keys.remove(Key)
 
     # noinspection PyUnusedLocal
     def destroy_stats_dialog(self, widget):
         """Close statistics window"""
-        self.destroy()
+        if self.hide_on_close:
+            self.hide()
+        else:
+            self.destroy()
 
     # noinspection PyUnusedLocal
-    def stats_dialog_filter(self, model, iter_index, data):
-        """Tests if the stats key in the row is the one in the filter"""
-
-        stats_key = model[iter_index][0]
-        stats_value = model[iter_index][1]
-
-        if (
-                self.current_filter_key is None
-                or self.current_filter_key == "None"
-        ):
-            return False
-
-        # No filter at all - show everything.
-        elif self.current_filter_key == "All stats":
-            return True
-
-        elif self.current_filter_key == "Default view":
-
-            # Show only main disable reasons
-            if "disableReason" in stats_key and len(stats_value) == 0:
-                if stats_key == "disableReason_idle" or stats_key == "disableReason_sleep":
-                    return True
-                else:
-                    # Skipping empty disable reason
-                    return False
-            else:
-                # Skipping fake stats
-                if stats_key != "permissionsCheck":
-                    return True
-        else:
-            # Show only values that match the filter
-            return self.current_filter_key in stats_key
+    def on_delete_event(self, widget, event):
+        """Closed by the window manager: keep the window to show it again, if it is reusable"""
+        if self.hide_on_close:
+            self.hide()
+        return self.hide_on_close
 
     def on_stats_selection_button_clicked(self, widget):
         """Called on any of the filter button clicks"""
@@ -829,12 +991,20 @@ class LightsonStatisticsWindow(Gtk.Window):
         self.current_filter_key = widget.get_label()
 
         # Update window title with the name of the filter selected.
-        self.set_title("lightson-ng statistics: " + self.current_filter_key)
+        self.set_title(self.title_prefix + ": " + self.current_filter_key)
 
         log("%s stats key selected!" % self.current_filter_key)
         # we update the filter, which updates in turn the view
 
-        self.key_filter.refilter()
+        self.apply_filter()
+
+    # noinspection PyUnusedLocal
+    def on_search_changed(self, entry):
+        """Filter the rows by the text typed, case-insensitive"""
+        search_text = entry.get_text().lower()
+        narrowed = search_text.startswith(self.search_text)
+        self.search_text = search_text
+        self.apply_filter(narrowed)
 
     def on_key_press_event(self, widget, event):
         """ Close the window when Escape key pressed"""
@@ -850,10 +1020,37 @@ class LightsonStatisticsWindow(Gtk.Window):
         """
 
         if event.keyval == Gdk.KEY_Escape:
-            self.destroy_stats_dialog(widget)
+            # Clear the search first.
+            if self.search_entry.get_text():
+                self.search_entry.set_text("")
+            else:
+                self.destroy_stats_dialog(widget)
+            return True
+
+        # Start searching by typing anywhere in the window. Keys of the focused buttons and view (Space, Enter,
+        # arrows, typeahead of the view) and shortcuts with Ctrl/Alt are left to them.
+        if self.search_entry.has_focus() or isinstance(self.get_focus(), (Gtk.Button, Gtk.TreeView)) \
+                or event.state & (Gdk.ModifierType.CONTROL_MASK | Gdk.ModifierType.MOD1_MASK):
+            return False
+        character = chr(Gdk.keyval_to_unicode(event.keyval))
+        if character.isprintable():
+            return self.search_entry.handle_event(event)
+        return False
 
 
 class LightsonLogsWindow(Gtk.Window):
+    """
+    The window with logs of lightson-ng and its stats module, read from the journal.
+    Logs are filtered by journal fields (LIGHTSON_ITERATION, LIGHTSON_CHECK, PRIORITY), i.e. by journald indexes,
+    and highlighted by fields too, not by the text of messages.
+    """
+
+    # Syslog identifiers of lightson-ng processes.
+    JOURNAL_IDENTIFIERS = ("lightson-ng", "lightson-ng-stat", "lightson-ng-stats")
+
+    # Logs shown since this time.
+    JOURNAL_PERIOD = "today"
+
     def __init__(self):
         # noinspection PyArgumentList
         super().__init__(title="lightson-ng logs")
@@ -863,6 +1060,19 @@ class LightsonLogsWindow(Gtk.Window):
         self.grid = Gtk.Grid()
         self.add(self.grid)
 
+        # Filters of the logs. Entries are applied by Enter.
+        self.filter_errors = Gtk.CheckButton(label="Errors only")
+        self.filter_errors.connect("toggled", self.on_filter_changed)
+        self.grid.attach(self.filter_errors, 0, 0, 1, 1)
+
+        self.filter_iteration = Gtk.Entry(placeholder_text="Iteration number")
+        self.filter_iteration.connect("activate", self.on_filter_changed)
+        self.grid.attach(self.filter_iteration, 1, 0, 1, 1)
+
+        self.filter_check = Gtk.Entry(placeholder_text="Check name")
+        self.filter_check.connect("activate", self.on_filter_changed)
+        self.grid.attach(self.filter_check, 2, 0, 1, 1)
+
         # create textview, text buffer.
         self.scrolledwindow = Gtk.ScrolledWindow()
         self.scrolledwindow.set_hexpand(True)
@@ -887,13 +1097,11 @@ class LightsonLogsWindow(Gtk.Window):
         # self.set_keep_above(True)
         self.present()
 
-        # Define the tread, updating your text
-        # Daemonize the thread to make it stop with the GUI
+        # Lines read by the previous reader of the journal are not shown after the filter is changed.
+        self.journal_generation = 0
         self._quit_reading = None
-        self.log_update = Thread(target=self.read_journal, daemon=True)
-        # Start the thread
-        self.log_update.start()
-        # self.read_journal()
+        self.log_update = None
+        self.start_reading()
         self.connect('delete-event', self.on_log_win_close)
 
     # noinspection PyUnusedLocal
@@ -901,7 +1109,49 @@ class LightsonLogsWindow(Gtk.Window):
         """ Set the flag to quit reading the journal"""
         self._quit_reading = True
 
-    def read_journal(self):
+    # noinspection PyUnusedLocal
+    def on_filter_changed(self, widget):
+        """ Read the journal again with the filter changed. """
+        self._quit_reading = True
+        if self.log_update is not None:
+            self.log_update.join()
+        self.textbuffer.set_text("")
+        self.start_reading()
+
+    def journal_command(self):
+        """
+        :return: journalctl command reading the logs selected by filters.
+            Matches of different fields are AND-ed by journalctl, identifiers are OR-ed.
+        """
+        command = ["journalctl", "--follow", "--output", "json", "--since", self.JOURNAL_PERIOD]
+        for identifier in self.JOURNAL_IDENTIFIERS:
+            command += ["--identifier", identifier]
+
+        if self.filter_errors.get_active():
+            command += ["--priority", "err"]
+        iteration = self.filter_iteration.get_text().strip()
+        if iteration:
+            command.append("LIGHTSON_ITERATION=" + iteration)
+        check = self.filter_check.get_text().strip()
+        if check:
+            command.append("LIGHTSON_CHECK=" + check)
+        return command
+
+    def start_reading(self):
+        """
+        Start the thread reading the journal.
+        """
+        self.journal_generation += 1
+        self._quit_reading = False
+
+        # Define the tread, updating your text
+        # Daemonize the thread to make it stop with the GUI
+        self.log_update = Thread(target=self.read_journal, args=(self.journal_command(), self.journal_generation),
+                                 daemon=True)
+        # Start the thread
+        self.log_update.start()
+
+    def read_journal(self, command, generation):
         """
         Continuously read logs of lightson-ng service and update log-window with new logs.
         Logs are shown in "tail -f" mode, i.e. window is automatically scrolled to the last log message.
@@ -909,9 +1159,10 @@ class LightsonLogsWindow(Gtk.Window):
         To make it happen with Gtk, text is updated in the idle_add() job and scrolling is done in
         a separate idle_add() job. Furthermore, read_journal() itself should not be called directly from
         Gtk, but from a separate thread.
+        :param command: journalctl command, see journal_command().
+        :param generation: generation of the reader, see append_new_line().
         :return:
         """
-        self._quit_reading = False
 
         # put lines read from the process into the queue
         # decode() - to convert from bytes to string
@@ -920,13 +1171,7 @@ class LightsonLogsWindow(Gtk.Window):
                 queue.put(q_line.decode())
             out.close()
 
-        journal_period = "today"
-        # journal_period = "1 hour ago"
-        # journal_period = "2 minutes ago"
-
-        journal_ctl = subprocess.Popen(["journalctl", "--follow", "--identifier", "lightson-ng-stats",
-                                        "--identifier", "lightson-ng",
-                                        "--since", journal_period], stdout=subprocess.PIPE)
+        journal_ctl = subprocess.Popen(command, stdout=subprocess.PIPE)
         queue_journal = Queue()
         thread_journal = Thread(target=enqueue_output, args=(journal_ctl.stdout, queue_journal))
         thread_journal.start()
@@ -949,27 +1194,65 @@ class LightsonLogsWindow(Gtk.Window):
                 # no output yet
                 pass
             else:  # got line ... do something with line
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
 
                 # Note: using GLib.PRIORITY_DEFAULT is a must, otherwise scrolling does not work
                 # noinspection PyArgumentList
-                GLib.idle_add(self.append_new_line, line, priority=GLib.PRIORITY_DEFAULT)
+                GLib.idle_add(self.append_new_line, entry, generation, priority=GLib.PRIORITY_DEFAULT)
                 GLib.idle_add(self.log_win_scroll_to_end)
 
-    def append_new_line(self, line):
-        """ Append new line to the end of text buffer """
+    @staticmethod
+    def journal_field(entry, name, default=""):
+        """
+        :return: the field of journal entry as string. Binary fields are given by journalctl as arrays of bytes.
+        """
+        value = entry.get(name, default)
+        if isinstance(value, list):
+            value = bytes(value).decode(errors="replace")
+        return str(value)
+
+    def format_entry(self, entry):
+        """
+        :return: the line of log, like "journalctl --output short" prints it, marked by the iteration number.
+        """
+        timestamp = time.strftime("%b %d %H:%M:%S",
+                                  time.localtime(int(entry.get("__REALTIME_TIMESTAMP", 0)) / 1000000))
+        process = self.journal_field(entry, "SYSLOG_IDENTIFIER") + \
+            "[" + self.journal_field(entry, "SYSLOG_PID", entry.get("_PID", "")) + "]"
+        if "LIGHTSON_ITERATION" in entry:
+            process += " #" + self.journal_field(entry, "LIGHTSON_ITERATION")
+        return f"{timestamp} {process}: {self.journal_field(entry, 'MESSAGE')}\n"
+
+    def append_new_line(self, entry, generation):
+        """ Append new journal entry to the end of text buffer """
+        # Entry is read before the filter was changed.
+        if generation != self.journal_generation:
+            return False
+
+        line = self.format_entry(entry)
         text_iter_end = self.textbuffer.get_end_iter()
 
         # Add some fancy tags and display the line
         # Highlight errors
-        if "ERROR:" in line:
+        if int(self.journal_field(entry, "PRIORITY", 6)) <= 3:
 
             tag = self.tag_found
 
-        # Highlight the result of checks
-        elif "Lights off..." in line\
-                or "Disabling " in line\
-                or "Enabling " in line:
+        # Highlight the change of PM states
+        elif "LIGHTSON_STATE" in entry:
+
+            tag = self.tag_bold
+
+        # Messages written to syslog, without journal fields (logJournalFields=0).
+        elif "LIGHTSON_ITERATION" not in entry and "ERROR:" in line:
+            tag = self.tag_found
 
+        elif "LIGHTSON_ITERATION" not in entry and ("Lights off..." in line
+                                                   or "Disabling " in line
+                                                   or "Enabling " in line):
             tag = self.tag_bold
             # log("Bold line: " + line)
 
@@ -978,6 +1261,7 @@ class LightsonLogsWindow(Gtk.Window):
 
         self.textbuffer.insert_with_tags(text_iter_end, line, tag)
         # self.textbuffer.insert(text_iter_end, line)
+        return False
 
     def log_win_scroll_to_end(self):
         """ scroll the window to the end of text. """
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+
+"""
+ Offline simulator of loop delay and check ordering policies. Helper for lightson-ng program.
+
+ Copyright (c) 2022 grytsenko.alexander at gmail com
+ URL: https://github.com/LehValensa/lightson-ng
+ This script is licensed under GNU GPL version 2.0 or above
+
+ Simulator:
+   - reads the trace written by lightson-ng-stat.py --trace-file: one iteration of lightson-ng per line.
+   - rebuilds the timeline of the traced machine from it: user activity (from idle counters),
+     disable reasons and idle/sleep timeouts.
+   - replays the timeline through the rules of calculateLoopDelay() and through alternative policies,
+     and reports for every policy:
+       - iterations and checks performed (every check is at least one fork in lightson-ng);
+       - missed inhibits: the timeout is reached while a disable reason exists, but the policy has not seen it yet;
+       - detection latency: time from the start of disable reason to the iteration which sees it.
+ The trace is sampled by iterations only, so the timeline is pessimistic: the reason seen by iteration
+ is considered started right after the previous iteration, the user activity is known from idle counters.
+ Simulation is event-driven: policy jumps from one iteration to the next, the timeline is searched by bisection.
+   - replays the checks of every traced iteration through check ordering policies: all checks (useCheckPlanner=0)
+     and planChecks() of lightson-ng, and reports checks performed and skipped, and the time spent in checks.
+"""
+
+import json
+import sys
+import time
+from argparse import ArgumentParser
+from bisect import bisect_left, bisect_right
+
+# Policies of the stats module. Only pure Python part of the module is used, no DBUS.
+statModule = __import__("lightson-ng-stat")
+LoopScheduler = statModule.LoopScheduler
+
+SECONDS_PER_DAY = 86400
+
+# checkRunsMax of lightson-ng: runs and hits of the check are halved when runs reach it.
+CHECK_RUNS_MAX = 100
+
+
+class Timeline:
+    """
+    The traced machine: user activity, disable reasons and timeouts, rebuilt from the trace.
+    """
+
+    def __init__(self, records, default_timeout=None):
+        """
+        :param records: iterations of the trace, sorted by time.
+        :param default_timeout: timeout for iterations traced without it (static loop delay). [seconds]
+        """
+        self.times = [record["time"] for record in records]
+        self.reasons = [tuple(sorted((state, reason) for state, reason in record.get("reasons", {}).items()
+                                     if reason)) for record in records]
+        # Every state is held by a reason: no timeout comes until the next iteration.
+        self.held = [bool(record.get("reasons")) and all(record["reasons"].values()) for record in records]
+        self.checks = [record.get("checks", 0) for record in records]
+        self.timeouts = [record.get("idleTimeout") or default_timeout for record in records]
+        self.min_delays = [record.get("loopMinDelay") or 0 for record in records]
+        self.spare_times = [record.get("loopSpareTime") or 0 for record in records]
+
+        # User activity: idle counter tells when the user was active last time.
+        # The last activity can not move back in time.
+        self.activity = []
+        for record in records:
+            if record.get("idleCounter") is None:
+                continue
+            last_activity = record["time"] - record["idleCounter"]
+            if not self.activity or last_activity > self.activity[-1]:
+                self.activity.append(last_activity)
+
+        # Starts of disable reasons: reason seen by iteration is considered started right after the previous one.
+        self.reason_starts = [self.times[i - 1] for i in range(1, len(records))
+                              if self.reasons[i] and not self.reasons[i - 1]]
+
+        # Moments when the machine goes idle: the idle counter reaches the timeout before the next user activity.
+        self.timeout_events = []
+        for i, last_activity in enumerate(self.activity):
+            timeout = self.timeout_at(last_activity)
+            if timeout is None:
+                continue
+            event = last_activity + timeout
+            if (i + 1 == len(self.activity) or self.activity[i + 1] > event) and event <= self.times[-1]:
+                self.timeout_events.append(event)
+
+        self.start = self.times[0]
+        self.end = self.times[-1]
+
+    def sample(self, moment):
+        """
+        :param moment: time. [unix time]
+        :return: index of the trace record describing the moment: the next iteration, which sees the reasons.
+        """
+        return min(bisect_left(self.times, moment), len(self.times) - 1)
+
+    def timeout_at(self, moment):
+        return self.timeouts[self.sample(moment)]
+
+    def idle_counter(self, moment):
+        """
+        :return: idle counter at the moment, None if unknown. [seconds]
+        """
+        i = bisect_right(self.activity, moment)
+        return None if i == 0 else int(moment - self.activity[i - 1])
+
+    def next_idle(self, moment, idle_time):
+        """
+        :return: the first moment after the given one when idle counter reaches idle_time, None if never.
+        """
+        i = bisect_right(self.activity, moment)
+        if i == 0:
+            return None
+        while True:
+            event = self.activity[i - 1] + idle_time
+            if event > moment and (i == len(self.activity) or self.activity[i] > event):
+                return event
+            if i == len(self.activity):
+                return None
+            i += 1
+
+
+class Iteration:
+    """
+    What lightson-ng knows at its iteration.
+    """
+    __slots__ = ("moment", "reasons", "held", "checks", "idle_counter", "idle_timeout", "min_delay", "spare_time")
+
+    def __init__(self, timeline, moment):
+        i = timeline.sample(moment)
+        self.moment = moment
+        self.reasons = timeline.reasons[i]
+        self.held = timeline.held[i]
+        self.checks = timeline.checks[i]
+        self.idle_counter = timeline.idle_counter(moment)
+        self.idle_timeout = timeline.timeouts[i]
+        self.min_delay = timeline.min_delays[i]
+        self.spare_time = timeline.spare_times[i]
+
+
+class LightsonPolicy:
+    """
+    The same as calculateLoopDelay() of lightson-ng.
+    """
+    name = "lightson"
+
+    def __init__(self, static_delay, subtract_idle=True):
+        """
+        :param static_delay: loopDelay used when the timeout is unknown. [seconds]
+        :param subtract_idle: subtract the idle counter from the delay.
+        """
+        self.static_delay = static_delay
+        self.subtract_idle = subtract_idle
+
+    def delay(self, iteration):
+        delay = self.static_delay
+        if iteration.idle_timeout is not None:
+            delay = iteration.idle_timeout
+            if self.subtract_idle and iteration.idle_counter is not None \
+                    and delay - iteration.spare_time - iteration.min_delay > iteration.idle_counter:
+                delay -= iteration.idle_counter
+        return max(delay - iteration.spare_time, iteration.min_delay)
+
+    def next_iteration(self, timeline, iteration):
+        return iteration.moment + self.delay(iteration)
+
+
+class StaticPolicy(LightsonPolicy):
+    """
+    Static loop delay: dynamicLoopDelay=0.
+    """
+
+    def __init__(self, static_delay):
+        super().__init__(static_delay)
+        self.name = "static:" + str(static_delay)
+
+    def delay(self, iteration):
+        return max(self.static_delay - iteration.spare_time, iteration.min_delay)
+
+
+class SchedulerPolicy(LightsonPolicy):
+    """
+    Loop delay of lightson-ng adapted by LoopScheduler of the stats module: useLoopScheduler=1.
+    """
+    name = "scheduler"
+
+    def __init__(self, static_delay):
+        super().__init__(static_delay)
+        self.scheduler = LoopScheduler()
+
+    def delay(self, iteration):
+        return self.scheduler.plan(super().delay(iteration), iteration.reasons,
+                                   idle_counter=iteration.idle_counter, idle_timeout=iteration.idle_timeout,
+                                   min_delay=iteration.min_delay, spare_time=iteration.spare_time,
+                                   held=iteration.held, now=iteration.moment)[0]
+
+
+class IdleWatchPolicy(LightsonPolicy):
+    """
+    Idle watches of lightson-ng-agent: useIdleScheduler=1. The idle counter is not subtracted,
+    the watch breaks the delay when the idle counter reaches the timeout minus spare time.
+    """
+    name = "idle-watch"
+
+    def __init__(self, static_delay):
+        super().__init__(static_delay, subtract_idle=False)
+
+    def next_iteration(self, timeline, iteration):
+        moment = super().next_iteration(timeline, iteration)
+        if iteration.idle_timeout is not None:
+            watch = timeline.next_idle(iteration.moment, max(iteration.idle_timeout - iteration.spare_time, 1))
+            if watch is not None and watch < moment:
+                moment = watch
+        return moment
+
+
+def simulate(timeline, policy):
+    """
+    Replay the timeline through the policy.
+    :return: dictionary of results.
+    """
+    moments = []
+    checks = 0
+    moment = timeline.start
+    while moment <= timeline.end:
+        iteration = Iteration(timeline, moment)
+        moments.append(moment)
+        checks += iteration.checks
+        # Timer is set in whole seconds, and never for zero.
+        moment = max(policy.next_iteration(timeline, iteration), moment + 1)
+
+    # The inhibitor is set by the iteration which has seen the reason, and is kept until the next iteration.
+    missed = 0
+    for event in timeline.timeout_events:
+        last = bisect_right(moments, event) - 1
+        if last >= 0 and timeline.reasons[timeline.sample(event)] \
+                and not timeline.reasons[timeline.sample(moments[last])]:
+            missed += 1
+
+    latencies = []
+    for start in timeline.reason_starts:
+        seen = bisect_right(moments, start)
+        if seen < len(moments):
+            latencies.append(moments[seen] - start)
+
+    return {
+        "policy": policy.name,
+        "iterations": len(moments),
+        "checks": checks,
+        "missedInhibits": missed,
+        "worstLatency": max(latencies, default=0),
+        "meanLatency": sum(latencies) / len(latencies) if latencies else 0,
+    }
+
+
+class AllChecksPolicy:
+    """
+    All enabled checks are performed: useCheckPlanner=0.
+    """
+    name = "all-checks"
+
+    def order(self, checks):
+        return list(checks)
+
+    def is_skipped(self, states, disabled):
+        return False
+
+    def measure(self, check, cost, hit):
+        pass
+
+
+class PlannerPolicy(AllChecksPolicy):
+    """
+    The same as planChecks() of lightson-ng: useCheckPlanner=1. Checks are ordered by their measured cost
+    divided by hit rate, a check is skipped when every state it disables already has a reason.
+    """
+    name = "planner"
+
+    def __init__(self):
+        self.costs = {}
+        self.runs = {}
+        self.hits = {}
+
+    def order(self, checks):
+        # Sorting is stable, the same as insertion sort of planChecks().
+        return sorted(checks, key=lambda check: self.costs.get(check, 0) * (self.runs.get(check, 0) + 2)
+                      // (self.hits.get(check, 0) + 1))
+
+    def is_skipped(self, states, disabled):
+        return states <= disabled
+
+    def measure(self, check, cost, hit):
+        # The same as measureCheck() of lightson-ng.
+        self.costs[check] = cost if check not in self.costs else (3 * self.costs[check] + cost) // 4
+        self.runs[check] = self.runs.get(check, 0) + 1
+        if hit:
+            self.hits[check] = self.hits.get(check, 0) + 1
+        if self.runs[check] >= CHECK_RUNS_MAX:
+            self.runs[check] //= 2
+            self.hits[check] = self.hits.get(check, 0) // 2
+
+
+def replay_checks(records, policy):
+    """
+    Replay the checks of every traced iteration through the check ordering policy.
+    The states a check disables are learned from the whole trace. A check which has never disabled anything
+    is considered disabling every state, so it is skipped only when all states have reasons.
+    A check not performed by the traced iteration (skipped) is considered false when the policy performs it.
+    The cost of check is the one measured by the iteration, or the last one known.
+    :return: dictionary of results.
+    """
+    all_states = set()
+    check_states = {}
+    for record in records:
+        all_states.update(record.get("reasons", {}))
+        for check, states in record.get("checkStates", {}).items():
+            check_states.setdefault(check, set()).update(states)
+
+    costs = {}
+    iterations = checks = skipped = check_time = 0
+    for record in records:
+        results = record.get("checkResults")
+        if not results:
+            continue
+        iterations += 1
+        costs.update(record.get("checkCosts", {}))
+
+        disabled = set()
+        for check in policy.order(results):
+            states = check_states.get(check, all_states)
+            if policy.is_skipped(states, disabled):
+                skipped += 1
+                continue
+            hit = results[check] == "0"
+            checks += 1
+            check_time += costs.get(check, 0)
+            policy.measure(check, costs.get(check, 0), hit)
+            if hit:
+                disabled.update(record.get("checkStates", {}).get(check, states))
+
+    return {
+        "policy": policy.name,
+        "iterations": iterations,
+        "checks": checks,
+        "skipped": skipped,
+        # Microseconds are measured, seconds are reported.
+        "checkTime": check_time / 1000000,
+        "meanCheckTime": check_time / 1000000 / iterations if iterations else 0,
+    }
+
+
+def read_trace(trace_file):
+    """
+    :param trace_file: name of file written by lightson-ng-stat.py --trace-file.
+    :return: iterations sorted by time.
+    """
+    records = []
+    with open(trace_file) as trace:
+        for line_number, line in enumerate(trace, 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                print(f"{trace_file}:{line_number}: skipping malformed line", file=sys.stderr)
+    return sorted(records, key=lambda record: record["time"])
+
+
+def make_policies(names, static_delay):
+    """
+    :param names: policy names: lightson, scheduler, idle-watch, static:<seconds>.
+    :return: list of policies.
+    """
+    policies = []
+    for name in names:
+        if name.startswith("static:"):
+            policies.append(StaticPolicy(int(name.split(":", 1)[1])))
+        else:
+            policies.append({"lightson": LightsonPolicy, "scheduler": SchedulerPolicy,
+                             "idle-watch": IdleWatchPolicy}[name](static_delay))
+    return policies
+
+
+def make_order_policies(names):
+    """
+    :param names: check ordering policy names: all-checks, planner.
+    :return: list of policies.
+    """
+    return [{"all-checks": AllChecksPolicy, "planner": PlannerPolicy}[name]() for name in names]
+
+
+if __name__ == '__main__':
+    argument_parser = ArgumentParser(description="lightson-ng-sim - offline simulator of loop delay "
+                                                 "and check ordering policies")
+    argument_parser.add_argument("trace_file", metavar="TRACE", help="trace written by lightson-ng-stat.py --trace-file")
+    argument_parser.add_argument("-p", "--policy", action="append", dest="policies",
+                                 help="policy to replay: lightson, scheduler, idle-watch, static:<seconds>. "
+                                      "Can be repeated, default: all but static")
+    argument_parser.add_argument("-o", "--order", action="append", dest="orders", choices=["all-checks", "planner"],
+                                 help="check ordering policy to replay: all-checks, planner. "
+                                      "Can be repeated, default: all")
+    argument_parser.add_argument("--loop-delay", type=int, default=60,
+                                 help="loopDelay used when the timeout is not traced (default: %(default)s)")
+    argument_parser.add_argument("--timeout", type=int,
+                                 help="idle/sleep timeout for iterations traced without it [seconds]")
+    argument_parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    cmdline = argument_parser.parse_args()
+
+    trace_records = read_trace(cmdline.trace_file)
+    if len(trace_records) < 2:
+        sys.exit("Trace has less than 2 iterations: " + cmdline.trace_file)
+
+    trace_timeline = Timeline(trace_records, cmdline.timeout)
+    simulated_days = (trace_timeline.end - trace_timeline.start) / SECONDS_PER_DAY
+
+    if not cmdline.json:
+        print(f"Trace: {len(trace_records)} iterations, {simulated_days:.2f} days, "
+              f"{len(trace_timeline.timeout_events)} timeouts, {len(trace_timeline.reason_starts)} reasons started")
+        print(f"{'policy':<12} {'iterations':>10} {'checks':>8} {'missed':>7} {'worst lat':>10} "
+              f"{'mean lat':>9} {'days/sec':>10}")
+
+    for sim_policy in make_policies(cmdline.policies or ["lightson", "scheduler", "idle-watch"], cmdline.loop_delay):
+        started = time.perf_counter()
+        results = simulate(trace_timeline, sim_policy)
+        elapsed = time.perf_counter() - started
+        results["daysPerSecond"] = simulated_days / elapsed if elapsed else 0
+
+        if cmdline.json:
+            print(json.dumps(results))
+        else:
+            print(f"{results['policy']:<12} {results['iterations']:>10} {results['checks']:>8} "
+                  f"{results['missedInhibits']:>7} {results['worstLatency']:>10.0f} "
+                  f"{results['meanLatency']:>9.1f} {results['daysPerSecond']:>10.0f}")
+
+    # Check ordering is replayed only if the trace has results of checks: written by lightson-ng with this feature.
+    if not any(record.get("checkResults") for record in trace_records):
+        if not cmdline.json:
+            print("No results of checks in the trace: check ordering policies are not replayed")
+        sys.exit(0)
+
+    if not cmdline.json:
+        print(f"{'order':<12} {'iterations':>10} {'checks':>8} {'skipped':>8} {'check time':>11} {'mean time':>10}")
+
+    for order_policy in make_order_policies(cmdline.orders or ["all-checks", "planner"]):
+        results = replay_checks(trace_records, order_policy)
+        if cmdline.json:
+            print(json.dumps(results))
+        else:
+            print(f"{results['policy']:<12} {results['iterations']:>10} {results['checks']:>8} "
+                  f"{results['skipped']:>8} {results['checkTime']:>11.1f} {results['meanCheckTime']:>10.3f}")
@@ -12,6 +12,24 @@
    - stores lightson statistics which is shown then by lightson-ng-indicator GUI program.
    - declares signals for IPC between lightson-ng process and lightson-ng-late-check service.
    - declares methods to communicate between lightson-ng, lightson-ng-indicator and the Late Check.
+   - keeps the data published by lightson-ng-agent from the GUI session (audio streams, results of GUI checks, etc.).
+   - keeps the results of lightson-ng checks fresh by running them in the background, each on its own cadence.
+   - runs the checks of lightson-ng iteration concurrently, each with a hard timeout.
+   - watches the config file of lightson-ng, keeps it parsed and tells when it is changed.
+   - tracks the active GUI session by logind signals and provides its user and environment to lightson-ng.
+   - holds idle/sleep inhibitors for lightson-ng: logind's inhibitor as file descriptor,
+     gnome's inhibitor as cookie held by lightson-ng-agent in the GUI session.
+   - keeps the power context of loop delay: AC/battery power from UPower, idle/sleep delays from gnome settings.
+   - decides whether sleep should be prevented, right before the system goes to sleep (the Late Check).
+   - adapts the loop delay of lightson-ng to the history of its iterations.
+     Iterations can be written to the trace file and replayed then by lightson-ng-sim.py.
+     Being launched with --late-check option, asks the running stats service for this decision.
+   - prints the stats of the running stats service for scripts (--get, --watch, --json options).
+   - publishes the stats of every iteration to the memory-mapped file in /run, readable without DBUS.
+   - tells when it is ready: its DBUS name is owned. To systemd (sd_notify) and to lightson-ng (--ready-file).
+   - exports the stats as OpenMetrics text for Prometheus, on 127.0.0.1 port or unix socket (--metrics option).
+   - can be activated by DBUS on demand: exits when idle (--idle-exit option) and keeps its stats across
+     the exits in the state file (--state-file option).
  This module is accomplished with *.conf file where DBUS permissions are configured.
  Python bindings of Gio and Glib used in the module are modern and powerful,
  but are documented purely, I've found only one working example:
@@ -28,47 +46,127 @@
                 https://lazka.github.io/pgi-docs/#Gio-2.0/classes/DBusServer.html#Gio.DBusServer
                 Tried, but no python examples on using it (while C -examples for gio-2.0 and glib-2.0 are compiling
                 and working just fine, including GDBusObjectManagerServer)
- TODOFEATURE: check benefits installing ng-stat as standalone service into
-              /usr/share/dbus-1/services/org.lightsOnStat.service:
-              [D-BUS Service]
-              Name=com.example.Sample
-              Exec=/usr/local/bin/lightson-ng-stat.py
 """
 
-from gi.repository import Gio, GLib
+try:
+    from gi.repository import Gio, GLib
+except ImportError:
+    # Offline tools (lightson-ng-sim.py) reuse the policies of this module without DBUS.
+    Gio = GLib = None
+from collections import deque
+import atexit
+import json
+import mmap
 import re
+import shlex
+import signal
+import socket
+import struct
+import tempfile
 from threading import Timer, Lock
+from queue import Queue, Full
 import os
 from argparse import ArgumentParser
 import logging.handlers
 import sys
+import time
 import traceback
 
 
-def get_dbus_config(var_name, default_value):
+# DBUS configuration shared with lightson-ng: variable name -> (command line option, default value).
+DBUS_CONFIG = {
+    "LIGHTSON_STATS_INTERFACE": ("--stats-interface", "org.LightsOn.StatInterface"),
+    "LIGHTSON_STATS_CONNECTION_NAME": ("--stats-connection-name", "org.LightsOn.StatService"),
+    "LIGHTSON_STATS_OBJECT": ("--stats-object", "/LightsOnStat"),
+}
+
+
+def add_dbus_config_arguments(argument_parser):
     """
-    Get DBUS configuration from lightson-ng main shell module.
-    lightson-ng should reside in the same directory as stats module
-    :param var_name: name of variable
-    :param default_value: set default value of variable, if not found in lightson-ng.
-    :return:
+    Add the options overriding DBUS configuration to the command line parser.
+    :param argument_parser:
     """
-    try:
-        ng_file = os.path.dirname(sys.argv[0]) + "/lightson-ng"
-        with open(ng_file, "r") as file:
-            for line in file:
-                if re.search(var_name, line):
-                    file.close()
-                    return re.search(var_name + "=\"(.+)\"(.*)$", line).group(1)
+    for var_name, (option, default_value) in DBUS_CONFIG.items():
+        argument_parser.add_argument(option, dest=var_name, metavar="NAME",
+                                     help=f"DBUS name, overrides {var_name} of lightson-ng "
+                                          f"(default: {default_value})")
 
-    except (AttributeError, Exception):
-        return default_value
 
+def get_dbus_config():
+    """
+    Get DBUS configuration. The first found is taken:
+    command line option, environment variable, variable of lightson-ng main shell module, default value.
+    lightson-ng is read only if some name is not given explicitly, in a single pass which stops when all names
+    are found: they are declared at the top of lightson-ng. lightson-ng should reside in the same directory as stats
+    module.
+    Command line is parsed before parse_command_line(), since the names are needed at import of the module.
+    :return: dictionary: variable name -> value.
+    """
+    option_parser = ArgumentParser(add_help=False, allow_abbrev=False)
+    add_dbus_config_arguments(option_parser)
+    options = vars(option_parser.parse_known_args()[0])
 
-# Try first the config exported from lightson-ng process, then use default values.
-IF_NAME = get_dbus_config("LIGHTSON_STATS_INTERFACE", "org.LightsOn.StatInterface")
-SRV_NAME = get_dbus_config("LIGHTSON_STATS_CONNECTION_NAME", "org.LightsOn.StatService")
-OBJ_NAME = get_dbus_config("LIGHTSON_STATS_OBJECT", "/LightsOnStat")
+    dbus_config = {}
+    for var_name in DBUS_CONFIG:
+        value = options.get(var_name) or os.environ.get(var_name)
+        if value:
+            dbus_config[var_name] = value
+
+    if len(dbus_config) < len(DBUS_CONFIG):
+        try:
+            ng_file = os.path.join(os.path.dirname(sys.argv[0]), "lightson-ng")
+            with open(ng_file, "r") as file:
+                for line in file:
+                    if not line.startswith("LIGHTSON_STATS_"):
+                        continue
+                    match = re.match(r'(\w+)="(.+)"', line)
+                    if match and match.group(1) in DBUS_CONFIG:
+                        dbus_config.setdefault(match.group(1), match.group(2))
+                        if len(dbus_config) == len(DBUS_CONFIG):
+                            break
+        except OSError:
+            pass
+
+    for var_name, (option, default_value) in DBUS_CONFIG.items():
+        dbus_config.setdefault(var_name, default_value)
+    return dbus_config
+
+
+# Try first the config given explicitly or exported from lightson-ng process, then use default values.
+_dbus_config = get_dbus_config()
+IF_NAME = _dbus_config["LIGHTSON_STATS_INTERFACE"]
+SRV_NAME = _dbus_config["LIGHTSON_STATS_CONNECTION_NAME"]
+OBJ_NAME = _dbus_config["LIGHTSON_STATS_OBJECT"]
+
+# Levels of logging, chosen by --log-level option.
+LOG_LEVELS = ("debug", "info", "warning", "error")
+
+# Messages waiting in the queue to be written to syslog/stdout. When the queue is full, new messages are dropped.
+LOG_QUEUE_SIZE = 1000
+
+# Messages of the same kind are passed at most LOG_RATE_LIMIT per LOG_RATE_PERIOD seconds, the rest are dropped.
+# Warnings and errors are never dropped.
+LOG_RATE_LIMIT = 20
+LOG_RATE_PERIOD = 10
+
+# Native protocol socket of systemd journal. When it exists, messages are written to the journal
+# with structured fields instead of syslog.
+JOURNAL_SOCKET = "/run/systemd/journal/socket"
+
+# Stats of the last iteration, published to the memory-mapped file, see StatsSnapshot.
+STATS_SNAPSHOT_FILE = "/run/lightson-ng/stats"
+
+# Size of the stats area of snapshot file. Stats which do not fit into it are not published. [bytes]
+STATS_SNAPSHOT_SIZE = 65536
+
+# State of the stats service kept across its exits (--state-file without FILE):
+# system-wide when running as root, in XDG state directory of the user otherwise.
+STATS_STATE_FILE = "/var/lib/lightson-ng/stats-state.json" if os.getuid() == 0 else os.path.join(
+    os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state"), "lightson-ng", "stats-state.json")
+STATS_STATE_VERSION = 1
+
+# How often the service checks whether it is idle, when it exits being idle (--idle-exit). [seconds]
+IDLE_EXIT_CHECK_PERIOD = 10
 
 # The name of lightson-ng service in systemd.
 SYSTEMD_LIGHTSON_SERVICE = "lightson-ng.service"
@@ -76,6 +174,90 @@ SYSTEMD_LIGHTSON_SERVICE = "lightson-ng.service"
 # Timeout to wait until service is started by systemd.
 SERVICE_OPERATION_TIMEOUT = 30
 
+# Error returned to the caller when the data is not provided by anybody yet,
+# ex. when lightson-ng-agent is not running in the GUI session.
+# The caller (lightson-ng) falls back to its own way of getting the data.
+ERROR_NOT_AVAILABLE = IF_NAME + ".Error.NotAvailable"
+
+# Error returned to the caller which is not allowed to call the method.
+ERROR_ACCESS_DENIED = IF_NAME + ".Error.AccessDenied"
+
+# Methods acting as root on behalf of lightson-ng: only root, or the user running the service, may call them.
+# The policy of lightson-ng-stat.conf lets any local user call the service.
+TRUSTED_METHODS = ("WatchConfig", "RunChecks", "SetBackgroundChecks", "SetCheckOptions", "GetGuiSession",
+                   "EnableLateCheck",
+                   "AcquireInhibitor", "ReleaseInhibitor")
+
+# Methods publishing the state of the GUI session: only lightson-ng-agent, i.e. the user of the GUI session,
+# or trusted callers may call them.
+SESSION_METHODS = ("SetAudioState", "SetSessionResults", "SetGnomeSettings")
+
+# Checks are run as "lightson-ng --run-check <check>" by the service: the script installed next to this module,
+# never a command given by the caller. The caller gives the check names only.
+LIGHTSON_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "lightson-ng")
+CHECK_NAME_PATTERN = r"is\w+Check"
+# Options of lightson-ng command line passed to the checks run by the service: option -> it takes a value.
+CHECK_OPTIONS = {"--debug-on": False, "--debug-off": False, "--syslog": False, "--no-syslog": False,
+                 "--chrome-app": True, "--window-name": True}
+
+# The bus itself: asked for the unix user of the caller.
+DBUS_NAME = "org.freedesktop.DBus"
+DBUS_PATH = "/org/freedesktop/DBus"
+
+# Time to wait for lightson-ng-agent to evaluate GUI checks and push the results. [milliseconds]
+SESSION_RESULTS_TIMEOUT = 2000
+
+# Time given to a single check running in the background, then it is killed. [seconds]
+BACKGROUND_CHECK_TIMEOUT = 60
+
+# Return codes of the check run concurrently, when it has not printed its result:
+# killed by timeout (as by "timeout" command), or failed to run or print.
+RUN_CHECK_TIMEOUT = 124
+RUN_CHECK_NO_RESULT = 125
+
+# logind service, which tells about user sessions.
+LOGIN1_NAME = "org.freedesktop.login1"
+LOGIN1_PATH = "/org/freedesktop/login1"
+LOGIN1_MANAGER = "org.freedesktop.login1.Manager"
+LOGIN1_SESSION = "org.freedesktop.login1.Session"
+
+# Object exported by lightson-ng-agent in the bus of stats service, to hold gnome's inhibitors.
+AGENT_IF_NAME = "org.LightsOn.AgentInterface"
+AGENT_OBJ_NAME = "/LightsOnAgent"
+
+# Who holds the inhibitor, as shown by systemd-inhibit and gnome.
+INHIBITOR_WHO = "lightson-ng"
+
+# Flags of gnome's inhibitor for lightson-ng states.
+GNOME_INHIBIT_FLAGS = {"idle": 8, "sleep": 4}
+
+# UPower service, which tells whether the system is on battery.
+UPOWER_NAME = "org.freedesktop.UPower"
+UPOWER_PATH = "/org/freedesktop/UPower"
+
+# Gnome settings of idle and sleep delays, published by lightson-ng-agent as "schema key".
+GNOME_IDLE_DELAY = "org.gnome.desktop.session idle-delay"
+GNOME_SLEEP_TIMEOUT = {False: "org.gnome.settings-daemon.plugins.power sleep-inactive-ac-timeout",
+                       True: "org.gnome.settings-daemon.plugins.power sleep-inactive-battery-timeout"}
+
+# Time lightson-ng is given to do the late check iteration,
+# then the decision of the last regular iteration is taken. [milliseconds]
+# Well under InhibitDelayMaxSec of logind (5 seconds by default): the delay inhibitor is released by the decision,
+# not cut off by logind.
+LATE_CHECK_TIMEOUT = 3000
+# Time the Late Check waits for the decision of stats service: the late check iteration and a margin for a busy bus.
+# Well under TimeoutSec of lightson-ng-late-check.service (20 seconds): a hung service lets the system sleep,
+# the unit is not killed by systemd. [milliseconds]
+LATE_CHECK_CALL_TIMEOUT = LATE_CHECK_TIMEOUT + 5000
+
+# Adaptive loop scheduler: number of iterations kept in history,
+# and the max power of 2 the loop delay is multiplied by when nothing changes.
+LOOP_SCHEDULER_HISTORY = 6
+LOOP_SCHEDULER_MAX_BACKOFF = 3
+
+# Process which environment has DBUS_* and DISPLAY variables of GUI session. Name is truncated by kernel.
+GUI_ENV_PROCESS = "gnome-session-b"
+
 # Note: <property> is defined in XML, but not implemented yet.
 serviceXml = (
         """<node>
@@ -120,6 +302,47 @@ serviceXml = (
             </doc:doc>
         </method>
         
+        <method name='WatchConfig'>
+            <arg type='s' name='ConfigFile' direction='in'/>
+            <arg type='u' name='Generation' direction='out'/>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Parse the config file of lightson-ng and watch it. The generation is incremented
+                        every time the content of file is changed.
+                        Allowed for root (or the user running the service) only: the file is read as root.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='GetConfigGeneration'>
+            <arg type='u' name='Generation' direction='out'/>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Return the generation of config file. Fails with NotAvailable error if no config is watched.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='GetConfig'>
+            <arg type='u' name='Generation' direction='out'/>
+            <arg type='a{ss}' name='Config' direction='out'>
+                <doc:doc><doc:summary>variable name -> value, as assigned in config file</doc:summary></doc:doc>
+            </arg>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Return the parsed config file and its generation.
+                        Fails with NotAvailable error if no config is watched.
+                        Allowed for any caller (lightson-ng-indicator shows it): the file is chosen by WatchConfig() of root.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
         <method name='PingStats'>
             <arg type='s' name='PingReply' direction='out'/>
             <doc:doc>
@@ -131,11 +354,252 @@ serviceXml = (
             </doc:doc>
         </method>
         
+        <method name='SetAudioState'>
+            <arg type='a{sb}' name='AudioApps' direction='in'/>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Store the audio streams published by the audio tracker of lightson-ng-agent:
+                        application name -> stream is running
+                        Allowed for the user of the active GUI session (or root) only.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='GetAudioState'>
+            <arg type='a{sb}' name='AudioApps' direction='out'/>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Retrieve the audio streams tracked in the GUI session.
+                        Fails with NotAvailable error if no audio tracker is attached.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='SetSessionResults'>
+            <arg type='a{ss}' name='SessionResults' direction='in'/>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Store the results of GUI checks and GUI values evaluated by lightson-ng-agent in the GUI session
+                        Allowed for the user of the active GUI session (or root) only.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='GetSessionResults'>
+            <arg type='as' name='Settings' direction='in'>
+                <doc:doc><doc:summary>lightson-ng settings needed by checks, as "name=value"</doc:summary></doc:doc>
+            </arg>
+            <arg type='a{ss}' name='SessionResults' direction='out'/>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Ask lightson-ng-agent to evaluate GUI checks and wait for the results.
+                        Check name maps to the disable reason (empty if check is false),
+                        the rest are GUI values, such as idleCounter.
+                        Fails with NotAvailable error if no agent is attached.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='SetBackgroundChecks'>
+            <arg type='a{su}' name='Intervals' direction='in'>
+                <doc:doc><doc:summary>check name -> interval between runs, in seconds</doc:summary></doc:doc>
+            </arg>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Run the given checks in the background, each on its own cadence. Empty list stops them.
+                        Checks are run by lightson-ng with the config file watched.
+                        Allowed for root (or the user running the service) only: checks are run as root.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='GetCheckResults'>
+            <arg type='a{s(bst)}' name='CheckResults' direction='out'>
+                <doc:doc><doc:summary>check name -> (check is true, disable reason, unix time of the run)</doc:summary></doc:doc>
+            </arg>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Return the latest results of checks running in the background
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='SetCheckOptions'>
+            <arg type='s' name='Options' direction='in'>
+                <doc:doc><doc:summary>options of lightson-ng command line, quoted for shell</doc:summary></doc:doc>
+            </arg>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Pass the options of lightson-ng command line to the checks run by the service, so they
+                        behave as the checks run by lightson-ng itself. Only options changing the checks are accepted:
+                        --debug-on, --debug-off, --syslog, --no-syslog, --chrome-app, --window-name.
+                        Allowed for root (or the user running the service) only: checks are run as root.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='RunChecks'>
+            <arg type='as' name='Checks' direction='in'>
+                <doc:doc><doc:summary>names of checks, run by lightson-ng with the config file watched</doc:summary></doc:doc>
+            </arg>
+            <arg type='u' name='Workers' direction='in'>
+                <doc:doc><doc:summary>max number of checks running at the same time</doc:summary></doc:doc>
+            </arg>
+            <arg type='u' name='Timeout' direction='in'>
+                <doc:doc><doc:summary>time given to every check, then it is killed, in seconds</doc:summary></doc:doc>
+            </arg>
+            <arg type='a{s(is)}' name='CheckResults' direction='out'>
+                <doc:doc><doc:summary>check name -> (return code, disable reason)</doc:summary></doc:doc>
+            </arg>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Run the checks concurrently and reply when all of them are finished.
+                        Return code is 124 if check is killed by timeout, 125 if check has not printed its result.
+                        Allowed for root (or the user running the service) only: checks are run as root.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='GetGuiSession'>
+            <arg type='s' name='GdmUser' direction='in'>
+                <doc:doc><doc:summary>user of the login screen, its session is not a GUI session</doc:summary></doc:doc>
+            </arg>
+            <arg type='s' name='EnvFile' direction='in'>
+                <doc:doc><doc:summary>file to write environment variables of GUI session to</doc:summary></doc:doc>
+            </arg>
+            <arg type='a{ss}' name='GuiSession' direction='out'>
+                <doc:doc><doc:summary>session, user, leader, envPid of GUI session. Empty if no GUI session</doc:summary></doc:doc>
+            </arg>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Return the active GUI session tracked by logind signals and write its environment to the file.
+                        Fails with NotAvailable error if logind can not be asked.
+                        Allowed for root (or the user running the service) only: the file is written as root.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='AcquireInhibitor'>
+            <arg type='s' name='State' direction='in'>
+                <doc:doc><doc:summary>state to inhibit: idle or sleep</doc:summary></doc:doc>
+            </arg>
+            <arg type='s' name='Type' direction='in'>
+                <doc:doc><doc:summary>inhibitor type: systemd or gnome</doc:summary></doc:doc>
+            </arg>
+            <arg type='s' name='Why' direction='in'/>
+            <arg type='s' name='Handle' direction='out'>
+                <doc:doc><doc:summary>file descriptor or cookie of the inhibitor, informational</doc:summary></doc:doc>
+            </arg>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Add the inhibitor of state and hold it until ReleaseInhibitor() is called or service exits.
+                        Gnome's inhibitor is held by lightson-ng-agent, fails with NotAvailable error if no agent.
+                        Allowed for root (or the user running the service) only.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='ReleaseInhibitor'>
+            <arg type='s' name='State' direction='in'/>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Remove the inhibitor of state added by AcquireInhibitor()
+                        Allowed for root (or the user running the service) only.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='SetGnomeSettings'>
+            <arg type='a{ss}' name='GnomeSettings' direction='in'>
+                <doc:doc><doc:summary>"schema key" -> value, and user the settings belong to</doc:summary></doc:doc>
+            </arg>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Store gnome settings published by lightson-ng-agent when they are changed
+                        Allowed for the user of the active GUI session (or root) only.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='GetPowerContext'>
+            <arg type='a{ss}' name='PowerContext' direction='out'>
+                <doc:doc><doc:summary>onBattery, idleDelay, sleepTimeout, user. Unknown values are absent</doc:summary></doc:doc>
+            </arg>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Return the current power context needed to calculate the loop delay
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='LateCheck'>
+            <arg type='b' name='PreventSleep' direction='out'/>
+            <arg type='s' name='Reason' direction='out'/>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Decide whether sleep should be prevented. Called by lightson-ng-late-check service.
+                        The decision made when system is preparing for sleep is replied at once,
+                        otherwise lightson-ng is asked to do the late check iteration.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
+        <method name='EnableLateCheck'>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        The Late Check is in the sleep chain: delay the sleep until lightson-ng does the late check
+                        iteration. Called by lightson-ng at start. Fails with NotAvailable error on the session bus.
+                        Allowed for root (or the user running the service) only.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
+
         <method name='Quit'/>
 
         <!-- **************** signal emitters -->
         <method name='IterationFinished'/>
         <method name='ForceNewIteration'/>
+        <method name='IdleWatchFired'>
+            <arg type='s' name='Reason' direction='in'/>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Idle watch of lightson-ng-agent fired right before the idle/sleep timeout, or the user is active
+                        again: break the delay and loop over new iteration.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </method>
         <method name='DoLateCheckIteration'/>
         <method name='AnyReasonFound'/>
         <method name='ReasonNotFound'/>
@@ -159,10 +623,31 @@ serviceXml = (
         <!-- signals enumerated -->
         <signal name='DoLateCheckSignal'/>
         <signal name='FinishLoopDelaySignal'/>
+        <signal name='ForceNewIterationSignal'/>
         <signal name='EnableReasonidleSignal'/>
         <signal name='DisableReasonidleSignal'/>
         <signal name='EnableReasonsleepSignal'/>
         <signal name='DisableReasonsleepSignal'/>
+        <signal name='ConfigChangedSignal'>
+            <arg type='u' name='Generation'/>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        The content of config file is changed.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </signal>
+        <signal name='EvaluateSessionChecksSignal'>
+            <arg type='as' name='Settings'/>
+            <doc:doc>
+                <doc:description>
+                    <doc:para>
+                        Emitted to ask lightson-ng-agent to evaluate GUI checks and push the results.
+                    </doc:para>
+                </doc:description>
+            </doc:doc>
+        </signal>
 
         <!-- **************** properties (unused yet) -->
         <!--
@@ -201,8 +686,10 @@ def print_stats_array(source_dict):
     :param source_dict:
     :return:
     """
+    if not log_enabled(logging.DEBUG):
+        return
     for Key, Value in sorted(source_dict.items()):
-        log("lightson-stats: " + Key + " =" + Value)
+        log_debug("lightson-stats: " + Key + " =" + Value)
 
 
 def _prepare_arguments(signature, prep_args):
@@ -231,6 +718,45 @@ def parse_command_line(description):
                                  help="don't print messages to syslog")
     argument_parser.add_argument('-v', "--verbose", action="store_true", dest="verbose",
                                  help="print messages to syslog and to stdout")
+    argument_parser.add_argument("--log-level", choices=LOG_LEVELS, dest="log_level",
+                                 help="log messages of this level and above (default: debug if --verbose, else info)")
+    # The options are already applied by get_dbus_config(), they are added to be shown in help.
+    add_dbus_config_arguments(argument_parser)
+    if 'lightson-ng stats' in description:
+        argument_parser.add_argument("--late-check", action="store_true", dest="late_check",
+                                     help="ask the running stats service whether sleep should be prevented, "
+                                          "exit with non-zero code if so")
+        argument_parser.add_argument("--trace-file", dest="trace_file", metavar="FILE",
+                                     help="append every iteration of lightson-ng to FILE, to replay it "
+                                          "by lightson-ng-sim.py")
+        argument_parser.add_argument("--get", nargs="*", dest="get_keys", metavar="KEY",
+                                     help="print the stats of the running stats service as KEY=VALUE lines: "
+                                          "all or the given keys only, and exit")
+        argument_parser.add_argument("--watch", action="store_true", dest="watch",
+                                     help="print the stats again after every iteration of lightson-ng "
+                                          "if they are changed, until interrupted")
+        argument_parser.add_argument("--json", action="store_true", dest="json",
+                                     help="print the stats as JSON object, one per line")
+        argument_parser.add_argument("--session-bus", action="store_true", dest="session_bus",
+                                     help="connect --get/--watch to the stats service on the session bus "
+                                          "(lightson-ng is not running as root)")
+        argument_parser.add_argument("--snapshot-file", dest="snapshot_file", metavar="FILE",
+                                     default=STATS_SNAPSHOT_FILE,
+                                     help="publish stats of every iteration to memory-mapped FILE, "
+                                          "empty value disables it (default: %(default)s)")
+        argument_parser.add_argument("--ready-file", dest="ready_file", metavar="FIFO",
+                                     help="write READY line to FIFO when the DBUS name is owned, "
+                                          "or FAILED line if it can not be owned")
+        argument_parser.add_argument("--metrics", dest="metrics", metavar="ADDRESS",
+                                     help="export stats as OpenMetrics text on ADDRESS: [HOST:]PORT "
+                                          "(HOST is 127.0.0.1 by default) or unix:PATH")
+        argument_parser.add_argument("--idle-exit", type=int, dest="idle_exit", metavar="SECONDS",
+                                     help="exit when no lightson-ng loop is attached and no method is called "
+                                          "for SECONDS, to be activated by DBUS again when needed")
+        argument_parser.add_argument("--state-file", nargs="?", const=STATS_STATE_FILE, dest="state_file",
+                                     metavar="FILE",
+                                     help="restore the stats saved by the previous run from FILE, save them there "
+                                          "at exit (default FILE: %(const)s)")
     # noinspection PyGlobalUndefined
     global cmdline
     cmdline = argument_parser.parse_args()
@@ -239,30 +765,190 @@ def parse_command_line(description):
         cmdline.print_stdout = True
         cmdline.log_syslog = True
     else:
-        # Change defaults for lightson-ng-indicator
-        if 'lightson-ng-indicator' in description:
+        # Change defaults for lightson-ng-indicator and lightson-ng-agent: they are running in GUI session.
+        if 'lightson-ng-indicator' in description or 'lightson-ng-agent' in description:
             cmdline.print_stdout = False
             cmdline.log_syslog = False
 
+    if cmdline.log_level is None:
+        cmdline.log_level = "debug" if cmdline.verbose else "info"
+
     return cmdline
 
 
-def log(message):
+def sd_notify(state):
     """
-    Log/print the message
-    :param message:  text message to print
-    :return:
+    Notify systemd about the state of service, if it is run by the unit of Type=notify.
+    :param state: ex. "READY=1".
+    :return: True if the notification is sent.
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    # Abstract socket.
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+            notify_socket.sendto(state.encode(), address)
+    except OSError:
+        log_error("can not notify systemd: " + state)
+        return False
+    return True
+
+
+def notify_launcher(state):
+    """
+    Tell lightson-ng, waiting on --ready-file FIFO, the state of the service: READY or FAILED <reason>.
+    The FIFO is opened without blocking: if lightson-ng is not waiting anymore, nobody is notified.
+    :param state:
     """
+    if not getattr(cmdline, "ready_file", None):
+        return
+    try:
+        fd = os.open(cmdline.ready_file, os.O_WRONLY | os.O_NONBLOCK)
+        try:
+            os.write(fd, (state + "\n").encode())
+        finally:
+            os.close(fd)
+    except OSError:
+        log_error("can not notify lightson-ng by " + cmdline.ready_file)
 
-    # Setup new syslog logger if not done yet.
-    if 'rootLogger' not in globals():
-        # noinspection PyGlobalUndefined
-        global rootLogger
 
-        # The name of logger is a short filename without extension.
-        rootLogger = logging.getLogger(os.path.basename(os.path.splitext(sys.argv[0])[0]))
-        rootLogger.setLevel(logging.DEBUG)
+class RateLimitFilter(logging.Filter):
+    """
+    Drop the messages of the same kind coming faster than LOG_RATE_LIMIT per LOG_RATE_PERIOD seconds.
+    Kind of message is given to log(), by default it is the function which logs the message.
+    The first message passed after the drop tells how many messages of its kind were dropped.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Kind of message -> [start of period, messages in period].
+        self.periods = {}
+        # Kind of message -> messages dropped since the last one passed.
+        self.dropped = {}
+        self.droppedTotal = 0
+        # Messages are logged also by timer threads.
+        self.lock = Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        kind = getattr(record, "kind", None) or record.funcName
+        now = time.monotonic()
+        with self.lock:
+            period = self.periods.get(kind)
+            if period is None or now - period[0] >= LOG_RATE_PERIOD:
+                period = self.periods[kind] = [now, 0]
+            period[1] += 1
+            if period[1] > LOG_RATE_LIMIT:
+                self.dropped[kind] = self.dropped.get(kind, 0) + 1
+                self.droppedTotal += 1
+                return False
+            dropped = self.dropped.pop(kind, 0)
+
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} messages of {kind} dropped)"
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Put the message to the queue without waiting. When the queue is full, the message is dropped and counted.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class JournalHandler(logging.Handler):
+    """
+    Write the message to systemd journal by its native protocol, with structured fields:
+    PRIORITY, SYSLOG_IDENTIFIER, LIGHTSON_KIND, and fields of the record, ex. LIGHTSON_ITERATION.
+    So the messages can be filtered by journald indexes: journalctl LIGHTSON_CHECK=isAudioPlayingCheck
+    """
+
+    # Logging level -> syslog priority.
+    PRIORITIES = {logging.DEBUG: 7, logging.INFO: 6, logging.WARNING: 4, logging.ERROR: 3, logging.CRITICAL: 2}
+
+    def __init__(self, identifier):
+        super().__init__()
+        self.identifier = identifier
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    @staticmethod
+    def encode_field(name, value):
+        """
+        :return: the field in journal native protocol. Value with new lines is written with its length.
+        """
+        value = str(value).encode()
+        if b"\n" in value:
+            return name.encode() + b"\n" + len(value).to_bytes(8, "little") + value + b"\n"
+        return name.encode() + b"=" + value + b"\n"
+
+    def emit(self, record):
+        try:
+            fields = {
+                "MESSAGE": self.format(record),
+                "PRIORITY": self.PRIORITIES.get(record.levelno, 6),
+                "SYSLOG_IDENTIFIER": self.identifier,
+                "SYSLOG_PID": record.process,
+                "LIGHTSON_KIND": getattr(record, "kind", None) or record.funcName,
+            }
+            for name, value in (getattr(record, "fields", None) or {}).items():
+                fields["LIGHTSON_" + name] = value
+            self.socket.sendto(b"".join(self.encode_field(name, value) for name, value in fields.items()),
+                               JOURNAL_SOCKET)
+        except (OSError, Exception):
+            self.handleError(record)
+
+    def close(self):
+        self.socket.close()
+        super().close()
+
+
+class TraceFormatter(logging.Formatter):
+    """
+    Append the traceback given by log_error() to the message. Used for stdout, syslog gets the message only.
+    """
+
+    def format(self, record):
+        message = super().format(record)
+        trace = getattr(record, "trace", None)
+        return message + "\n" + trace.rstrip() if trace else message
+
+
+def setup_logging():
+    """
+    Setup the logger. log() only puts the message to the queue, and never waits for syslog/stdout:
+    the messages are written by the thread of queue listener, so the main loop is not blocked by the output.
+    Messages below --log-level are skipped before they are formatted, too frequent messages are dropped
+    by the rate limit, see log_dropped().
+    """
+    if 'cmdline' not in globals():
+        raise NameError("cmdline global variable not found. Forgot to parse arguments?")
+
+    # noinspection PyGlobalUndefined
+    global rootLogger, logListener, logQueueHandler, logRateLimit
+
+    # The name of logger is a short filename without extension.
+    rootLogger = logging.getLogger(os.path.basename(os.path.splitext(sys.argv[0])[0]))
+    rootLogger.setLevel(getattr(logging, cmdline.log_level.upper()))
+    rootLogger.propagate = False
 
+    output_handlers = []
+    if cmdline.log_syslog and os.path.exists(JOURNAL_SOCKET):
+        output_handlers.append(JournalHandler(rootLogger.name))
+    elif cmdline.log_syslog:
         # Try the standard Unix device first, then try to go over UDP
         address = '/dev/log'
         if not os.path.exists(address):
@@ -270,43 +956,172 @@ def log(message):
         syslog_handler = logging.handlers.SysLogHandler(address)
 
         # Setup formatter the same way as /usr/bin/logger do.
-        syslog_formatter = logging.Formatter('%(name)s[%(process)d]: %(message)s')
-        syslog_handler.setFormatter(syslog_formatter)
-        syslog_handler.setLevel(logging.INFO)
-
-        rootLogger.addHandler(syslog_handler)
-
-    if 'cmdline' not in globals():
-        raise NameError("cmdline global variable not found. Forgot to parse arguments?")
+        syslog_handler.setFormatter(logging.Formatter('%(name)s[%(process)d]: %(message)s'))
+        output_handlers.append(syslog_handler)
 
     if cmdline.print_stdout:
-        print(message)
-    if cmdline.log_syslog:
-        # noinspection PyUnboundLocalVariable
-        rootLogger.info(message)
+        stdout_handler = logging.StreamHandler(sys.stdout)
+        stdout_handler.setFormatter(TraceFormatter('%(message)s'))
+        output_handlers.append(stdout_handler)
 
+    logQueueHandler = DroppingQueueHandler(Queue(LOG_QUEUE_SIZE))
+    logRateLimit = RateLimitFilter()
+    logQueueHandler.addFilter(logRateLimit)
+    rootLogger.addHandler(logQueueHandler)
 
-def log_error(message):
-    log("ERROR: " + message)
-    if cmdline.print_stdout:
-        print(traceback.format_exc())
+    logListener = logging.handlers.QueueListener(logQueueHandler.queue, *output_handlers)
+    logListener.start()
+    # Write the messages left in the queue at exit.
+    atexit.register(logListener.stop)
 
 
-class StatObject:
+def log_enabled(level):
     """
-    DBUS helper for lightson-ng
-    It can act as server for lightson-ng or as a client for lightson-ng-indicator.
+    :param level: logging level, ex. logging.DEBUG.
+    :return: True if messages of the level are logged. Used to skip building of messages which are not logged.
     """
+    if 'rootLogger' not in globals():
+        setup_logging()
+    return rootLogger.isEnabledFor(level)
 
-    def __init__(self):
-        """
-        Connect to dbus as service
-        """
 
-        self.statsOther = {}
-        self.disableReason = {}
+# Journal fields added to every message, ex. ITERATION: the iteration of lightson-ng being processed.
+logFields = {}
+
+
+def log(message, level=logging.INFO, kind=None, trace=None, fields=None):
+    """
+    Log/print the message
+    :param message:  text message to print
+    :param level: logging level of the message, ex. logging.DEBUG.
+    :param kind: kind of message for the rate limit. Default: the function which logs the message.
+    :param trace: traceback printed to stdout after the message.
+    :param fields: journal fields of the message, without LIGHTSON_ prefix, ex. {"CHECK": "isCpuLoadHighCheck"}.
+    :return:
+    """
+    if log_enabled(level):
+        _log_record(level, message, kind, trace, fields)
+
+
+def log_debug(message, kind=None, fields=None):
+    """
+    Log the message of debug level: it is skipped at once unless --log-level is debug.
+    """
+    if log_enabled(logging.DEBUG):
+        _log_record(logging.DEBUG, message, kind, None, fields)
+
+
+def log_error(message):
+    if log_enabled(logging.ERROR):
+        _log_record(logging.ERROR, "ERROR: " + message, None, traceback.format_exc(), None)
+
+
+def _log_record(level, message, kind, trace, fields):
+    """
+    Create the record of log()/log_debug()/log_error(). Journal fields are taken at the moment of call,
+    since the record is written later by the queue listener.
+    """
+    # stacklevel points the record to the caller of log(), which is the default kind of message.
+    rootLogger.log(level, message, stacklevel=3,
+                   extra={"kind": kind, "trace": trace, "fields": {**logFields, **fields} if fields else logFields.copy()})
+
+
+def log_dropped():
+    """
+    :return: messages dropped by the rate limit and because the queue was full.
+    """
+    if 'rootLogger' not in globals():
+        return 0, 0
+    return logRateLimit.droppedTotal, logQueueHandler.dropped
+
+
+class StatObject:
+    """
+    DBUS helper for lightson-ng
+    It can act as server for lightson-ng or as a client for lightson-ng-indicator.
+    """
+
+    def __init__(self):
+        """
+        Connect to dbus as service
+        """
+
+        self.statsOther = {}
+        self.disableReason = {}
         self.checkPerformed = {}
         self.timer = None
+        # Stats are restored from the state file, and lightson-ng has not sent new ones yet.
+        self.stateRestored = False
+        # Checks performed by the current iteration of lightson-ng.
+        self.iterationChecks = 0
+
+        # State published by lightson-ng-agent from the GUI session.
+        # None means: no agent attached, lightson-ng should get the data itself.
+        self.audioState = None
+        self.gnomeSettings = None
+        self.sessionResults = None
+        self.sessionResultsWaiting = []
+        self.sessionResultsTimeoutId = None
+        self.agentName = None
+        self.agentWatchId = None
+
+        # Active GUI session.
+        self.sessionTracker = SessionTracker()
+
+        # Checks executed in the background, with the GUI session of lightson-ng.
+        self.checkRunner = CheckRunner(self.sessionTracker.check_environment)
+
+        # AC/battery power.
+        self.powerTracker = PowerTracker()
+
+        # Decision made right before the sleep.
+        # Reason restored from the state file is found by the previous run, it does not prevent the sleep.
+        self.lateChecker = LateChecker(lambda: self.emit_lightson_signal("DoLateCheckIteration"),
+                                       lambda: "" if self.stateRestored
+                                       else self.disableReason.get("disableReason_sleep", ""))
+
+        # Inhibitors held for lightson-ng: state -> (type, file descriptor or cookie, agent holding the cookie).
+        self.inhibitors = {}
+
+        # Adaptive policy of the loop delay.
+        self.loopScheduler = LoopScheduler()
+
+        # Results of checks performed by the current iteration: checkPerformed_<check> -> return code.
+        self.iterationCheckResults = {}
+        # Costs of checks executed by the current iteration, sent for the trace only: check -> microseconds.
+        self.iterationCheckCosts = {}
+
+        # Stats of the last iteration, readable without DBUS.
+        self.statsSnapshot = None
+        if getattr(cmdline, "snapshot_file", None):
+            try:
+                self.statsSnapshot = StatsSnapshot(cmdline.snapshot_file)
+            except (OSError, Exception):
+                log_error("can not publish stats to " + cmdline.snapshot_file)
+
+        # Exporter of stats for Prometheus.
+        self.metricsExporter = None
+        if getattr(cmdline, "metrics", None):
+            try:
+                self.metricsExporter = MetricsExporter(cmdline.metrics)
+            except (GLib.Error, Exception):
+                log_error("can not export metrics on " + cmdline.metrics)
+
+        # Stats of the previous run, when the service is activated by DBUS again.
+        if getattr(cmdline, "state_file", None):
+            self.restore_state()
+
+        # Exit when idle, the service is activated by DBUS again when it is needed.
+        self.lastActivity = time.monotonic()
+        if getattr(cmdline, "idle_exit", None):
+            GLib.timeout_add_seconds(min(cmdline.idle_exit, IDLE_EXIT_CHECK_PERIOD), self.on_idle_check)
+
+        # Config file of lightson-ng.
+        self.configWatcher = ConfigWatcher(
+            lambda generation: self.emit_lightson_signal("ConfigChanged", _prepare_arguments("u", (generation,))))
+
+        # The service is ready when its DBUS name is owned.
+        self.nameOwned = False
 
         # Publish this service definition to DBUS.
         try:
@@ -322,21 +1137,23 @@ class StatObject:
                 raise
 
             self._bus = Gio.bus_get_sync(Gio.BusType.SYSTEM)
+            self.busType = Gio.BusType.SYSTEM
 
             self.owner_id = Gio.bus_own_name(
                 Gio.BusType.SYSTEM,
                 SRV_NAME,
                 Gio.BusNameOwnerFlags.NONE,
-                None, None, None)
+                None, self.on_name_acquired, self.on_name_lost)
             # ValueError is mentioned to prevent PyCharm's IDE complaints.
         except (ValueError, Exception):
             try:
                 self._bus = Gio.bus_get_sync(Gio.BusType.SESSION)
+                self.busType = Gio.BusType.SESSION
                 self.owner_id = Gio.bus_own_name(
                     Gio.BusType.SESSION,
                     SRV_NAME,
                     Gio.BusNameOwnerFlags.NONE,
-                    None, None, None)
+                    None, self.on_name_acquired, self.on_name_lost)
             except (ValueError, Exception):
                 self.Quit()
 
@@ -350,6 +1167,30 @@ class StatObject:
         except (ValueError, Exception):
             self.Quit()
 
+    # noinspection PyUnusedLocal
+    def on_name_acquired(self, connection, name):
+        """
+        The service is ready: the object is registered, and the name is owned now, so clients can call it.
+        Tell it to systemd and to lightson-ng which has launched the service.
+        """
+        log("DBUS name is owned: " + name)
+        self.nameOwned = True
+        notify_launcher("READY")
+        sd_notify(f"READY=1\nSTATUS=Stats service {name} is ready")
+
+    # noinspection PyUnusedLocal
+    def on_name_lost(self, connection, name):
+        """
+        The name can not be owned (ex. no permissions or another service owns it), or it is taken by another
+        service later. Exit, the service is useless without its name.
+        """
+        if self.nameOwned:
+            log_error("DBUS name is lost: " + name)
+        else:
+            log_error("can not own DBUS name: " + name)
+            notify_launcher("FAILED can not own DBUS name " + name)
+        self.Quit()
+
     # noinspection PyPep8Naming
     def SetStats(self, params):
         """
@@ -361,7 +1202,7 @@ class StatObject:
         """
         statName = params.unpack()[0]
         statValue = params.unpack()[1]
-        log(f"SetStats: Name={statName} Value={statValue}")
+        log_debug(f"SetStats: Name={statName} Value={statValue}")
 
         if re.search(r'disableReason_', statName):
 
@@ -370,8 +1211,19 @@ class StatObject:
         elif re.search(r'checkPerformed_', statName):
 
             self.checkPerformed[statName] = statValue
+            self.iterationCheckResults[statName] = statValue
+            if statValue != "skipped":
+                self.iterationChecks += 1
+        elif statName.startswith("checkCost_"):
+            try:
+                self.iterationCheckCosts[statName[len("checkCost_"):]] = int(statValue)
+            except ValueError:
+                log_error(f"ERROR: An integer value of {statName} expected, got: {statValue}")
         else:
             self.statsOther[statName] = statValue
+            # Messages are marked by the iteration of lightson-ng they belong to.
+            if statName == "iteration":
+                logFields["ITERATION"] = statValue
 
     # noinspection PyUnusedLocal, PyPep8Naming
     def SetTimer(self, params):
@@ -387,7 +1239,39 @@ class StatObject:
             return
         # FOR DEBUG ONLY:
         # loopDelay = int("3")
-        log("Setting timer for " + str(loopDelay) + " seconds")
+
+        # lightson-ng is attached: the stats are its own now.
+        if self.stateRestored:
+            self.stateRestored = False
+            self.statsOther.pop("stateSaved", None)
+
+        reasons = self.get_main_reasons()
+        held = bool(reasons) and all(reason for name, reason in reasons)
+        requestedDelay = loopDelay
+
+        if self.statsOther.get("loopScheduler") == "1":
+            loopDelay, schedulerReason = self.loopScheduler.plan(loopDelay, reasons,
+                                                                 idle_counter=self.get_int_stat("idleCounter"),
+                                                                 idle_timeout=self.get_int_stat("idleTimeout"),
+                                                                 min_delay=self.get_int_stat("loopMinDelay") or 0,
+                                                                 spare_time=self.get_int_stat("loopSpareTime") or 0,
+                                                                 held=held)
+            self.statsOther["schedulerDelay"] = str(loopDelay)
+            self.statsOther["schedulerReason"] = schedulerReason
+            log("Loop scheduler: " + schedulerReason)
+
+        if cmdline.trace_file:
+            self.write_trace(requestedDelay, loopDelay, reasons)
+        if self.metricsExporter is not None:
+            self.metricsExporter.update(reasons, loopDelay, self.get_int_stat("runtimeErrors"),
+                                        self.iterationCheckResults)
+        # Decision of the loop scheduler is known now.
+        self.publish_stats()
+        self.iterationChecks = 0
+        self.iterationCheckResults = {}
+        self.iterationCheckCosts = {}
+
+        log_debug("Setting timer for " + str(loopDelay) + " seconds")
 
         # Using cancellable thread-safe timer
         if self.timer is not None:
@@ -397,14 +1281,299 @@ class StatObject:
                              signal_name="FinishLoopDelay"
                              ).start()
 
-    def emit_lightson_signal(self, signal_name):
+    def write_trace(self, requestedDelay, loopDelay, reasons):
+        """
+        Append the iteration of lightson-ng to the trace file, one JSON object per line.
+        :param requestedDelay: loop delay calculated by lightson-ng.
+        :param loopDelay: loop delay the timer is set on.
+        :param reasons: main disable reasons of the iteration: (disableReason_<state>, reason).
+        """
+        record = {
+            "time": round(time.time(), 3),
+            "requestedDelay": requestedDelay,
+            "delay": loopDelay,
+            "idleCounter": self.get_int_stat("idleCounter"),
+            "idleTimeout": self.get_int_stat("idleTimeout"),
+            "loopMinDelay": self.get_int_stat("loopMinDelay"),
+            "loopSpareTime": self.get_int_stat("loopSpareTime"),
+            "reasons": {name.split("_", 1)[1]: value for name, value in reasons},
+            "checks": self.iterationChecks,
+            # Replayed by check ordering policies: results and costs of checks, states disabled by every check.
+            "checkResults": {name[len("checkPerformed_"):]: result
+                             for name, result in self.iterationCheckResults.items()},
+            "checkCosts": self.iterationCheckCosts,
+            "checkStates": self.get_check_states(),
+        }
+        try:
+            with open(cmdline.trace_file, "a") as trace_file:
+                trace_file.write(json.dumps(record) + "\n")
+        except OSError:
+            log_error("can not write trace file: " + cmdline.trace_file)
+
+    def get_check_states(self):
+        """
+        :return: states disabled by the checks of the iteration: check -> list of states.
+        """
+        checkStates = {}
+        for name, reason in self.disableReason.items():
+            match = re.fullmatch(r'disableReason_([^_]+)_(\w+)', name)
+            if reason and match:
+                checkStates.setdefault(match.group(2), []).append(match.group(1))
+        return checkStates
+
+    def get_main_reasons(self):
+        """
+        :return: main disable reasons of the iteration: (disableReason_<state>, reason), sorted by state.
+        """
+        return tuple(sorted((name, value) for name, value in self.disableReason.items()
+                            if re.fullmatch(r'disableReason_[^_]+', name)))
+
+    def get_int_stat(self, stat_name):
+        """
+        :param stat_name: name of statistics set by lightson-ng.
+        :return: integer value of statistics, None if it is not set or empty.
+        """
+        try:
+            return int(self.statsOther.get(stat_name, ""))
+        except ValueError:
+            return None
+
+    # noinspection PyPep8Naming
+    def SetAudioState(self, params, sender):
+        """
+        Store the audio streams published by the audio tracker of lightson-ng-agent.
+        Tracker pushes the whole map every time a sink input appears, disappears or changes its state,
+        so lightson-ng reads the audio state with one call instead of running pacmd.
+        :param params: dictionary: application name -> stream is running (not corked).
+        :param sender: unique bus name of the agent.
+        """
+        self.audioState = dict(params.unpack()[0])
+        log("SetAudioState: " + str(self.audioState))
+        self.watch_agent(sender)
+
+    # noinspection PyPep8Naming
+    def SetGnomeSettings(self, params, sender):
+        """
+        Store gnome settings published by lightson-ng-agent.
+        :param params: dictionary: "schema key" -> value, "user" -> user the settings belong to.
+        :param sender: unique bus name of the agent.
+        """
+        self.gnomeSettings = dict(params.unpack()[0])
+        log("SetGnomeSettings: " + str(self.gnomeSettings))
+        self.watch_agent(sender)
+
+    # noinspection PyPep8Naming
+    def GetPowerContext(self):
+        """
+        Return the power context of loop delay from the data tracked by signals, so it is always current.
+        Sleep timeout is taken for the current power source: AC or battery.
+        :return: dictionary: onBattery, idleDelay, sleepTimeout, user. Unknown values are absent.
+        """
+        powerContext = {}
+        onBattery = self.powerTracker.onBattery
+
+        if onBattery is not None:
+            powerContext["onBattery"] = str(onBattery).lower()
+
+        if self.gnomeSettings is not None:
+            powerContext["user"] = self.gnomeSettings.get("user", "")
+            if GNOME_IDLE_DELAY in self.gnomeSettings:
+                powerContext["idleDelay"] = self.gnomeSettings[GNOME_IDLE_DELAY]
+            if onBattery is not None and GNOME_SLEEP_TIMEOUT[onBattery] in self.gnomeSettings:
+                powerContext["sleepTimeout"] = self.gnomeSettings[GNOME_SLEEP_TIMEOUT[onBattery]]
+
+        return _prepare_arguments("a{ss}", (powerContext,))
+
+    # noinspection PyPep8Naming
+    def SetSessionResults(self, params, sender):
+        """
+        Store the results of GUI checks pushed by lightson-ng-agent and reply to everybody waiting for them.
+        :param params: dictionary: check name -> disable reason, GUI value name -> value.
+        :param sender: unique bus name of the agent.
+        """
+        self.sessionResults = dict(params.unpack()[0])
+        log("SetSessionResults: " + str(self.sessionResults))
+        self.watch_agent(sender)
+        self.reply_session_results()
+
+    # noinspection PyPep8Naming
+    def GetSessionResults(self, params, invocation):
+        """
+        Ask lightson-ng-agent to evaluate GUI checks in the GUI session.
+        The invocation is not replied right now, but when agent pushes the results or when timeout is reached.
+        Results of the previous request are dropped, so timeout is replied with NotAvailable error.
+        :param params: lightson-ng settings needed by checks, passed to the agent as is.
+        :param invocation: method invocation to reply.
+        """
+        if self.agentName is None:
+            invocation.return_dbus_error(ERROR_NOT_AVAILABLE, "No lightson-ng-agent is attached")
+            return
+
+        self.sessionResultsWaiting.append(invocation)
+
+        # Agent is asked already, the results will be shared.
+        if self.sessionResultsTimeoutId is not None:
+            return
+
+        self.sessionResults = None
+        self.sessionResultsTimeoutId = GLib.timeout_add(SESSION_RESULTS_TIMEOUT, self.on_session_results_timeout)
+        self.emit_lightson_signal("EvaluateSessionChecks", params)
+
+    def on_session_results_timeout(self):
+        """
+        Agent did not push the results in time.
+        :return: False to stop GLib timer.
+        """
+        log_error("lightson-ng-agent did not push session results in time")
+        self.sessionResultsTimeoutId = None
+        self.reply_session_results()
+        return False
+
+    def reply_session_results(self):
+        """
+        Reply the session results to all callers of GetSessionResults().
+        """
+        if self.sessionResultsTimeoutId is not None:
+            GLib.source_remove(self.sessionResultsTimeoutId)
+            self.sessionResultsTimeoutId = None
+
+        for invocation in self.sessionResultsWaiting:
+            if self.sessionResults is None:
+                invocation.return_dbus_error(ERROR_NOT_AVAILABLE, "No session results from lightson-ng-agent")
+            else:
+                invocation.return_value(_prepare_arguments("a{ss}", (self.sessionResults,)))
+
+        self.sessionResultsWaiting = []
+
+    # noinspection PyPep8Naming
+    def AcquireInhibitor(self, params, invocation):
+        """
+        Add the inhibitor of state. The logind's inhibitor lives while its file descriptor is open,
+        the gnome's inhibitor lives while lightson-ng-agent holding its cookie is connected to the session bus.
+        :param params: state, inhibitor type, reason.
+        :param invocation: method invocation to reply with the handle of inhibitor.
+        """
+        state, inhibitorType, why = params.unpack()
+
+        if state in self.inhibitors:
+            invocation.return_value(_prepare_arguments("s", (self.inhibitor_handle(state),)))
+            return
+
+        if inhibitorType == "systemd":
+            try:
+                result, fdList = Gio.bus_get_sync(Gio.BusType.SYSTEM).call_with_unix_fd_list_sync(
+                    LOGIN1_NAME, LOGIN1_PATH, LOGIN1_MANAGER, "Inhibit",
+                    GLib.Variant("(ssss)", (state, INHIBITOR_WHO, why, "block")), GLib.VariantType("(h)"),
+                    Gio.DBusCallFlags.NONE, SERVICE_OPERATION_TIMEOUT * 1000, None, None)
+                self.inhibitors[state] = (inhibitorType, fdList.get(result.unpack()[0]), None)
+            except (GLib.Error, Exception):
+                log_error("can not add systemd inhibitor of " + state)
+                invocation.return_dbus_error(ERROR_NOT_AVAILABLE, "logind inhibitor can not be added")
+                return
+            log(f"Inhibitor of {state} is added: {self.inhibitor_handle(state)}")
+            invocation.return_value(_prepare_arguments("s", (self.inhibitor_handle(state),)))
+
+        elif inhibitorType == "gnome" and state in GNOME_INHIBIT_FLAGS:
+            if self.agentName is None:
+                invocation.return_dbus_error(ERROR_NOT_AVAILABLE, "No lightson-ng-agent is attached")
+                return
+            self._bus.call(self.agentName, AGENT_OBJ_NAME, AGENT_IF_NAME, "Inhibit",
+                           GLib.Variant("(su)", (why, GNOME_INHIBIT_FLAGS[state])), GLib.VariantType("(u)"),
+                           Gio.DBusCallFlags.NONE, SERVICE_OPERATION_TIMEOUT * 1000, None,
+                           self.on_agent_inhibit_finished, (state, invocation, self.agentName))
+
+        else:
+            invocation.return_dbus_error(ERROR_NOT_AVAILABLE, "Unknown inhibitor: " + inhibitorType + " " + state)
+
+    def on_agent_inhibit_finished(self, connection, result, user_data):
+        """
+        lightson-ng-agent has added the gnome's inhibitor.
+        """
+        state, invocation, agentName = user_data
+        try:
+            cookie = connection.call_finish(result).unpack()[0]
+        except (GLib.Error, Exception):
+            log_error("lightson-ng-agent can not add gnome inhibitor of " + state)
+            invocation.return_dbus_error(ERROR_NOT_AVAILABLE, "gnome inhibitor can not be added")
+            return
+
+        self.inhibitors[state] = ("gnome", cookie, agentName)
+        log(f"Inhibitor of {state} is added: {self.inhibitor_handle(state)}")
+        invocation.return_value(_prepare_arguments("s", (self.inhibitor_handle(state),)))
+
+    # noinspection PyPep8Naming
+    def ReleaseInhibitor(self, state):
+        """
+        Remove the inhibitor of state.
+        :param state: idle or sleep.
+        """
+        inhibitor = self.inhibitors.pop(state, None)
+        if inhibitor is None:
+            return
+
+        inhibitorType, handle, agentName = inhibitor
+        if inhibitorType == "systemd":
+            os.close(handle)
+        else:
+            self._bus.call(agentName, AGENT_OBJ_NAME, AGENT_IF_NAME, "Uninhibit", GLib.Variant("(u)", (handle,)),
+                           None, Gio.DBusCallFlags.NONE, SERVICE_OPERATION_TIMEOUT * 1000, None, None, None)
+        log(f"Inhibitor of {state} is removed: {inhibitorType}:{handle}")
+
+    def inhibitor_handle(self, state):
+        """
+        :param state: idle or sleep.
+        :return: description of inhibitor held, ex. "systemd:fd12", "gnome:cookie1234"
+        """
+        inhibitorType, handle = self.inhibitors[state][:2]
+        return f"{inhibitorType}:{'fd' if inhibitorType == 'systemd' else 'cookie'}{handle}"
+
+    def watch_agent(self, sender):
+        """
+        Watch the bus name of lightson-ng-agent to drop its data when agent exits.
+        Otherwise lightson-ng would trust the stale data of the dead agent.
+        :param sender: unique bus name of the agent.
+        """
+        if sender == self.agentName:
+            return
+
+        if self.agentWatchId is not None:
+            Gio.bus_unwatch_name(self.agentWatchId)
+
+        log("Watching lightson-ng-agent: " + str(sender))
+        self.agentName = sender
+        self.agentWatchId = Gio.bus_watch_name_on_connection(self._bus, sender,
+                                                             Gio.BusNameWatcherFlags.NONE,
+                                                             None, self.on_agent_vanished)
+
+    # noinspection PyUnusedLocal
+    def on_agent_vanished(self, connection, name):
+        """
+        lightson-ng-agent has left the bus: forget everything it has published.
+        """
+        log("lightson-ng-agent has gone: " + str(name))
+        if self.agentWatchId is not None:
+            Gio.bus_unwatch_name(self.agentWatchId)
+        self.agentWatchId = None
+        self.agentName = None
+        self.audioState = None
+        self.gnomeSettings = None
+        self.sessionResults = None
+        self.reply_session_results()
+
+        # Gnome's inhibitors are removed along with the agent's connection to the session bus.
+        for state in [state for state, inhibitor in self.inhibitors.items() if inhibitor[2] == name]:
+            log("Inhibitor of " + state + " has gone with lightson-ng-agent")
+            del self.inhibitors[state]
+
+    def emit_lightson_signal(self, signal_name, parameters=None):
         """
         Emit a signal into the bus
         :param signal_name: signal name
+        :param parameters: (optional) GLib.Variant tuple with signal arguments.
         """
         new_signal_name = signal_name + "Signal"
-        self._bus.emit_signal(None, OBJ_NAME, IF_NAME, new_signal_name, None)
-        log("Signal: " + new_signal_name + " emitted")
+        self._bus.emit_signal(None, OBJ_NAME, IF_NAME, new_signal_name, parameters)
+        log_debug("Signal: " + new_signal_name + " emitted")
         return
 
     # noinspection PyPep8Naming
@@ -419,21 +1588,153 @@ class StatObject:
                 The dictionary is a merge of disable reasons, checks and other stats.
         """
 
-        returnStats = {**self.statsOther, **self.disableReason, **self.checkPerformed}
+        returnStats = self.all_stats()
 
         print_stats_array(returnStats)
 
-        return _prepare_arguments("a{ss}", (_dictionary_to_string(returnStats),))
+        return _prepare_arguments("a{ss}", (returnStats,))
+
+    def all_stats(self):
+        """
+        :return: the merge of disable reasons, checks and other stats, values are strings.
+        """
+        returnStats = {**self.statsOther, **self.disableReason, **self.checkPerformed}
+
+        # Messages of stats module dropped by its logger.
+        returnStats["logDropped"] = "%d by rate limit, %d by full queue" % log_dropped()
+
+        return _dictionary_to_string(returnStats)
+
+    def publish_stats(self):
+        """
+        Publish the stats to the snapshot file, if it is used.
+        """
+        if self.statsSnapshot is not None:
+            self.statsSnapshot.publish(self.all_stats())
+
+    def save_state(self):
+        """
+        Save the stats to the state file, to be restored when the service is activated again.
+        The file is replaced at once, so the exit in the middle of saving leaves the previous state.
+        """
+        state = {"version": STATS_STATE_VERSION, "saved": time.time(),
+                 "statsOther": self.statsOther, "disableReason": self.disableReason,
+                 "checkPerformed": self.checkPerformed,
+                 "loopScheduler": list(self.loopScheduler.history)}
+        if self.metricsExporter is not None:
+            state["metrics"] = {"iterations": self.metricsExporter.iterations,
+                                "checkRuns": self.metricsExporter.checkRuns,
+                                "checkHits": self.metricsExporter.checkHits}
+        temporary = cmdline.state_file + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(cmdline.state_file), mode=0o755, exist_ok=True)
+            with open(temporary, "w") as state_file:
+                json.dump(state, state_file)
+            os.replace(temporary, cmdline.state_file)
+        except (OSError, Exception):
+            log_error("can not save state to " + cmdline.state_file)
+            return
+        log("State is saved to " + cmdline.state_file)
+
+    def restore_state(self):
+        """
+        Restore the stats saved by the previous run, so clients activating the service see the stats
+        of the last iteration instead of nothing, until lightson-ng sends new ones.
+        """
+        try:
+            with open(cmdline.state_file) as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            log_error("can not restore state from " + cmdline.state_file)
+            return
+        if not isinstance(state, dict) or state.get("version") != STATS_STATE_VERSION:
+            log_error("unknown version of state file: " + cmdline.state_file)
+            return
+
+        self.statsOther.update(state.get("statsOther", {}))
+        self.disableReason.update(state.get("disableReason", {}))
+        self.checkPerformed.update(state.get("checkPerformed", {}))
+        # Disable reasons are remembered by the scheduler as tuples, JSON keeps them as lists.
+        for reasons in state.get("loopScheduler", []):
+            self.loopScheduler.history.append(tuple(tuple(reason) for reason in reasons))
+        metrics = state.get("metrics")
+        if metrics and self.metricsExporter is not None:
+            self.metricsExporter.iterations = metrics.get("iterations", 0)
+            self.metricsExporter.checkRuns = metrics.get("checkRuns", {})
+            self.metricsExporter.checkHits = metrics.get("checkHits", {})
+            # Disable reasons are restored above: the gauges show the states of the last iteration.
+            self.metricsExporter.update(self.get_main_reasons(), None, self.get_int_stat("runtimeErrors"), {},
+                                        count_iteration=False)
+
+        saved = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(state.get("saved", 0)))
+        self.statsOther["stateSaved"] = saved
+        self.stateRestored = True
+        self.publish_stats()
+        log(f"State saved at {saved} is restored from {cmdline.state_file}")
+
+    def on_idle_check(self):
+        """
+        Exit if nobody uses the service: the loop delay of lightson-ng is not running (lightson-ng sets it
+        every iteration), no method is called for --idle-exit seconds, and no caller waits for the reply.
+        :return: True to keep checking.
+        """
+        if (self.timer is not None and self.timer.is_alive()) or self.sessionResultsWaiting \
+                or self.lateChecker.waiting or time.monotonic() - self.lastActivity < cmdline.idle_exit:
+            return True
+
+        log(f"No lightson-ng loop or client is attached for {cmdline.idle_exit} seconds, exiting")
+        self.Quit()
+        return False
 
     # noinspection PyPep8Naming
     def Quit(self):
         """
-        Exit from the program. For debug purposes.
+        Exit from the program. For debug purposes, when the service is idle or killed.
         """
+        if self.timer is not None:
+            self.timer.cancel()
+        if getattr(cmdline, "state_file", None):
+            self.save_state()
+        self.checkRunner.stop()
+        if self.metricsExporter is not None:
+            self.metricsExporter.stop()
+        if self.statsSnapshot is not None:
+            self.statsSnapshot.close()
+        self.lateChecker.release_delay_inhibitor()
+        for state in list(self.inhibitors):
+            self.ReleaseInhibitor(state)
         Gio.bus_unown_name(self.owner_id)
         mainloop.quit()
         log("Exiting stats")
 
+    def caller_uid(self, sender):
+        """
+        :param sender: unique bus name of the caller.
+        :return: unix user of the caller, None if it can not be found.
+        """
+        try:
+            return self._bus.call_sync(DBUS_NAME, DBUS_PATH, DBUS_NAME, "GetConnectionUnixUser",
+                                       GLib.Variant("(s)", (sender,)), GLib.VariantType("(u)"),
+                                       Gio.DBusCallFlags.NONE, -1, None).unpack()[0]
+        except (GLib.Error, Exception):
+            log_error("can not get unix user of caller " + str(sender))
+            return None
+
+    def is_trusted_caller(self, sender):
+        """
+        :return: True if the caller is root, or the user running the service (lightson-ng on the session bus).
+        """
+        return self.caller_uid(sender) in (0, os.getuid())
+
+    def is_session_caller(self, sender):
+        """
+        :return: True if the caller is the user of the active GUI session, i.e. lightson-ng-agent, or trusted.
+        """
+        uid = self.caller_uid(sender)
+        return uid is not None and (uid in (0, os.getuid()) or str(uid) == self.sessionTracker.get_gui_uid())
+
     # noinspection PyUnusedLocal
     def handle_method_call(self, connection, sender, object_path, interface_name, method_name, params, invocation):
         """
@@ -448,7 +1749,19 @@ class StatObject:
         otherwise client get a response-timeout error.
         """
 
-        log(f"Handling method call: {method_name}")
+        log_debug(f"Handling method call: {method_name}")
+        self.lastActivity = time.monotonic()
+
+        if method_name in TRUSTED_METHODS and not self.is_trusted_caller(sender):
+            log_error(f"{method_name} is denied to caller {sender}")
+            invocation.return_dbus_error(ERROR_ACCESS_DENIED, method_name + " is allowed for lightson-ng only")
+            return
+
+        if method_name in SESSION_METHODS and not self.is_session_caller(sender):
+            log_error(f"{method_name} is denied to caller {sender}")
+            invocation.return_dbus_error(ERROR_ACCESS_DENIED,
+                                         method_name + " is allowed for the user of the GUI session only")
+            return
 
         """
         ------------------- Signals
@@ -459,6 +1772,13 @@ class StatObject:
         if method_name == "ForceNewIteration":
             # Emit a signal to break the delay and loop over new iteration.
             # Can be issued manually from lightson-ng-indicator.
+            # Signal differs from FinishLoopDelay: lightson-ng does not take cached results of checks then.
+            self.emit_lightson_signal("ForceNewIteration")
+            invocation.return_value(None)
+
+        elif method_name == "IdleWatchFired":
+            # The same as ForceNewIteration, but issued by idle scheduler of lightson-ng-agent.
+            log("Idle watch fired: " + params.unpack()[0])
             self.emit_lightson_signal("FinishLoopDelay")
             invocation.return_value(None)
 
@@ -470,6 +1790,8 @@ class StatObject:
 
         elif method_name == "IterationFinished":
             # Informational signal: lightson-ng just finished the iteration.
+            # The stats are published before, so receivers of the signal read the stats of this iteration.
+            self.publish_stats()
             self.emit_lightson_signal(method_name)
             invocation.return_value(None)
 
@@ -486,11 +1808,13 @@ class StatObject:
         elif method_name == "DisableReasonFound":
             # Informational signal: lightson has found a reason to disable PM state.
             self.emit_lightson_signal("DisableReason"+str(params.unpack()[0]))
+            self.lateChecker.set_result(params.unpack()[0], True)
             invocation.return_value(None)
 
         elif method_name == "EnableReasonFound":
             # Informational signal: lightson has not found a reason to disable PM state.
             self.emit_lightson_signal("EnableReason"+str(params.unpack()[0]))
+            self.lateChecker.set_result(params.unpack()[0], False)
             invocation.return_value(None)
 
         # --------------------- Methods
@@ -505,10 +1829,93 @@ class StatObject:
         elif method_name == "GetStats":
             invocation.return_value(self.GetStats())
 
+        elif method_name == "SetAudioState":
+            self.SetAudioState(params, sender)
+            invocation.return_value(None)
+
+        elif method_name == "SetSessionResults":
+            self.SetSessionResults(params, sender)
+            invocation.return_value(None)
+
+        elif method_name == "GetSessionResults":
+            self.GetSessionResults(params, invocation)
+
+        elif method_name == "SetBackgroundChecks":
+            self.checkRunner.configure(params.unpack()[0], self.configWatcher.path)
+            invocation.return_value(None)
+
+        elif method_name == "SetCheckOptions":
+            options = parse_check_options(params.unpack()[0])
+            if options is None:
+                invocation.return_error_literal(Gio.dbus_error_quark(), Gio.DBusError.INVALID_ARGS,
+                                                "Options can not be passed to checks")
+            else:
+                self.checkRunner.options = options
+                invocation.return_value(None)
+
+        elif method_name == "RunChecks":
+            # Batch keeps itself alive by its callbacks until all checks are finished.
+            CheckBatch(*params.unpack(), self.configWatcher.path, self.checkRunner.options,
+                       self.sessionTracker.check_environment(),
+                       lambda results: invocation.return_value(_prepare_arguments("a{s(is)}", (results,))))
+
+        elif method_name == "GetCheckResults":
+            invocation.return_value(_prepare_arguments("a{s(bst)}", (self.checkRunner.results,)))
+
+        elif method_name == "GetGuiSession":
+            guiSession = self.sessionTracker.get_gui_session(*params.unpack())
+            if guiSession is None:
+                invocation.return_dbus_error(ERROR_NOT_AVAILABLE, "GUI session can not be found")
+            else:
+                invocation.return_value(_prepare_arguments("a{ss}", (guiSession,)))
+
+        elif method_name == "AcquireInhibitor":
+            self.AcquireInhibitor(params, invocation)
+
+        elif method_name == "ReleaseInhibitor":
+            self.ReleaseInhibitor(params.unpack()[0])
+            invocation.return_value(None)
+
+        elif method_name == "SetGnomeSettings":
+            self.SetGnomeSettings(params, sender)
+            invocation.return_value(None)
+
+        elif method_name == "GetPowerContext":
+            invocation.return_value(self.GetPowerContext())
+
+        elif method_name == "LateCheck":
+            self.lateChecker.LateCheck(invocation)
+
+        elif method_name == "EnableLateCheck":
+            # logind and the late check service are on the system bus only.
+            if self.busType != Gio.BusType.SYSTEM:
+                invocation.return_dbus_error(ERROR_NOT_AVAILABLE, "Late Check is not available on the session bus")
+            else:
+                self.lateChecker.enable()
+                invocation.return_value(None)
+
+        elif method_name == "GetAudioState":
+            if self.audioState is None:
+                invocation.return_dbus_error(ERROR_NOT_AVAILABLE, "No audio tracker is attached")
+            else:
+                invocation.return_value(_prepare_arguments("a{sb}", (self.audioState,)))
+
         elif method_name == "Quit":
             self.Quit()
             invocation.return_value(None)
 
+        elif method_name == "WatchConfig":
+            invocation.return_value(_prepare_arguments("u", (self.configWatcher.watch(params.unpack()[0]),)))
+
+        elif method_name in ("GetConfigGeneration", "GetConfig"):
+            if self.configWatcher.path is None:
+                invocation.return_dbus_error(ERROR_NOT_AVAILABLE, "No config file is watched")
+            elif method_name == "GetConfigGeneration":
+                invocation.return_value(_prepare_arguments("u", (self.configWatcher.generation,)))
+            else:
+                invocation.return_value(_prepare_arguments("ua{ss}", (self.configWatcher.generation,
+                                                                      self.configWatcher.config)))
+
         elif method_name == "PingStats":
             invocation.return_value(_prepare_arguments("s", ("Hello",)))
 
@@ -517,43 +1924,1317 @@ class StatObject:
                                             "No such method on interface: %s.%s" % (interface_name, method_name))
 
 
-class TimerEx(object):
+def parse_check_output(stdout):
     """
-    A reusable thread safe timer implementation
-    Taken from https://stackoverflow.com/questions/22433394/calling-thread-timer-more-than-once
-    - returns itself to allow a one line timer creation and start
-    - optional parameter to restart a new timer or not if timer is still alive
+    Parse the output of "lightson-ng --run-check <check>": the last line is "return code<TAB>disable reason".
+    :param stdout: output of the check.
+    :return: tuple: return code, disable reason. None if check has not printed its result.
     """
+    lines = stdout.splitlines()
+    fields = lines[-1].split("\t", 1) if lines else []
+    if len(fields) == 2 and fields[0].isdigit():
+        return int(fields[0]), fields[1]
+    return None
 
-    def __init__(self, interval_sec, function, *args, **kwargs):
+
+def parse_check_options(options):
+    """
+    :param options: options of lightson-ng command line, quoted for shell.
+    :return: list of arguments, None if the options can not be passed to checks.
+    """
+    try:
+        arguments = shlex.split(options)
+    except ValueError:
+        log_error("can not parse options of checks: " + options)
+        return None
+
+    i = 0
+    while i < len(arguments):
+        takesValue = CHECK_OPTIONS.get(arguments[i])
+        if takesValue is None or (takesValue and i + 1 == len(arguments)):
+            log_error("option can not be passed to checks: " + arguments[i])
+            return None
+        i += 2 if takesValue else 1
+    return arguments
+
+
+def check_command(name, config_file, options=()):
+    """
+    :param name: check name.
+    :param config_file: config file of lightson-ng watched by the service, None if no config file is watched.
+    :param options: options of lightson-ng command line, checked by parse_check_options().
+    :return: command running the single check by lightson-ng, None if the name is not a name of check.
+    """
+    if not re.fullmatch(CHECK_NAME_PATTERN, name):
+        log_error("not a name of check: " + name)
+        return None
+    # The check runs in its own session, so it is killed together with its children, see kill_check_process().
+    command = ["setsid", LIGHTSON_SCRIPT]
+    if config_file:
+        command += ["--config-file", config_file]
+    return command + list(options) + ["--run-check", name]
+
+
+def spawn_check(command, environment):
+    """
+    Start the check process, its output is read by communicate_utf8_async().
+    :param command: command made by check_command().
+    :param environment: variables added to the environment of the process.
+    :return: Gio.Subprocess.
+    """
+    launcher = Gio.SubprocessLauncher.new(Gio.SubprocessFlags.STDOUT_PIPE)
+    for variable, value in environment.items():
+        launcher.setenv(variable, value, True)
+    return launcher.spawnv(command)
+
+
+def kill_check_process(process, cancellable=None):
+    """
+    Kill the check process with all its children, and stop waiting for its output.
+    Killing the check alone is not enough: sudo and the tools run by the check (pacmd, xprop, dbus-send)
+    keep its stdout open, so the output would not be finished until they exit by themselves.
+    :param process: Gio.Subprocess of the check, started by check_command().
+    :param cancellable: Gio.Cancellable given to communicate_utf8_async() of the process, if any.
+    """
+    identifier = process.get_identifier()
+    if identifier is not None:
+        try:
+            os.killpg(int(identifier), signal.SIGKILL)
+        except OSError:
+            process.force_exit()
+    if cancellable is not None:
+        cancellable.cancel()
+
+
+class CheckRunner:
+    """
+    Keep the results of lightson-ng checks fresh in the background, each check on its own cadence.
+    Every run is a separate "lightson-ng --run-check <check>" process started asynchronously from the main loop,
+    which prints the return code and the disable reason of the check.
+    The next run of the check is scheduled when the previous one is finished, so runs of one check never overlap.
+    """
+
+    def __init__(self, environment):
         """
-        Create a timer object which can be restarted
-        :param interval_sec: The timer interval in seconds
-        :param function: The user function timer should call once elapsed
-        :param args: The user function arguments array (optional)
-        :param kwargs: The user function named arguments (optional)
+        :param environment: function returning the variables added to the environment of check process.
         """
-        self._interval_sec = interval_sec
-        self._function = function
-        self._args = args
-        self._kwargs = kwargs
-        # Locking is needed since the '_timer' object might be replaced in a different thread
-        self._timer_lock = Lock()
-        self._timer = None
+        self.environment = environment
+        self.configFile = None
+        self.options = []
+        self.intervals = {}
+        self.results = {}
+        self.timerIds = {}
+        self.killTimerIds = {}
+        self.processes = {}
+
+    def configure(self, intervals, config_file):
+        """
+        Start running the given checks. Checks running before are stopped.
+        :param intervals: dictionary: check name -> interval between runs, in seconds.
+        :param config_file: config file of lightson-ng the checks are run with, None if not known.
+        """
+        self.stop()
+        self.configFile = config_file
+        self.intervals = {name: interval for name, interval in intervals.items()
+                          if interval > 0 and check_command(name, config_file) is not None}
+        # Results of checks which are not run anymore are dropped, the rest are still valid.
+        self.results = {name: result for name, result in self.results.items() if name in self.intervals}
+        log("Background checks: " + str(self.intervals))
+
+        for name in self.intervals:
+            self.schedule(name, 0)
+
+    def schedule(self, name, delay):
+        """
+        Schedule the run of check.
+        :param name: check name.
+        :param delay: delay before the run, in seconds.
+        """
+        self.timerIds[name] = GLib.timeout_add_seconds(delay, self.run_check, name)
 
-    def start(self, restart_if_alive=True):
+    def run_check(self, name):
         """
-        Starts the timer and returns this object [e.g. my_timer = TimerEx(10, my_func).start()]
-        :param restart_if_alive: 'True' to start a new timer if current one is still alive
-        :return: This timer object (i.e. self)
+        Start the check process.
+        :param name: check name.
+        :return: False to stop GLib timer.
         """
-        with self._timer_lock:
-            # Current timer still running
-            if self._timer is not None:
-                if not restart_if_alive:
-                    # Keep the current timer
-                    return self
-                # Cancel the current timer
+        self.timerIds.pop(name, None)
+        try:
+            process = spawn_check(check_command(name, self.configFile, self.options), self.environment())
+        except (GLib.Error, Exception):
+            log_error("can not run background check " + name)
+            self.schedule(name, self.intervals[name])
+            return False
+
+        self.processes[name] = process
+        # Kill the hanging check. communicate_utf8_finish() is called then anyway.
+        cancellable = Gio.Cancellable()
+        self.killTimerIds[name] = GLib.timeout_add_seconds(BACKGROUND_CHECK_TIMEOUT, self.kill_check,
+                                                           process, name, cancellable)
+        process.communicate_utf8_async(None, cancellable, self.on_check_finished, name)
+        return False
+
+    def kill_check(self, process, name, cancellable):
+        """
+        The check is running too long.
+        :return: False to stop GLib timer.
+        """
+        log_error("background check " + name + " is killed by timeout")
+        # The timer is removed by returning False.
+        self.killTimerIds.pop(name, None)
+        kill_check_process(process, cancellable)
+        return False
+
+    def on_check_finished(self, process, result, name):
+        """
+        Store the result printed by the check as "return code<TAB>disable reason", then schedule the next run.
+        The result is dropped if check has not printed it, ex. when GUI is not available for the GUI check.
+        """
+        try:
+            stdout = process.communicate_utf8_finish(result)[1] or ""
+        except (GLib.Error, Exception):
+            stdout = ""
+
+        # Checks were reconfigured while this one was running: its timer is removed already.
+        if self.processes.get(name) is not process:
+            return
+        del self.processes[name]
+
+        killTimerId = self.killTimerIds.pop(name, None)
+        if killTimerId is not None:
+            GLib.source_remove(killTimerId)
+
+        checkResult = parse_check_output(stdout)
+        if checkResult is not None:
+            self.results[name] = (checkResult[0] == 0, checkResult[1], int(time.time()))
+            log_debug(f"Background check {name}: {self.results[name]}", fields={"CHECK": name})
+        else:
+            self.results.pop(name, None)
+            log(f"Background check {name}: no result", fields={"CHECK": name})
+
+        self.schedule(name, self.intervals[name])
+
+    def stop(self):
+        """
+        Stop all the checks scheduled and running.
+        """
+        for timerId in list(self.timerIds.values()) + list(self.killTimerIds.values()):
+            GLib.source_remove(timerId)
+        self.timerIds = {}
+        self.killTimerIds = {}
+
+        for process in self.processes.values():
+            kill_check_process(process)
+        self.processes = {}
+
+
+class CheckBatch:
+    """
+    Run the checks of one lightson-ng iteration at once, instead of one after another.
+    Every check is a separate "lightson-ng --run-check <check>" process started asynchronously from the main loop,
+    at most the given number of processes run at the same time, the rest are waiting in the queue.
+    The check running longer than the timeout is killed. Results are reported when all checks are finished,
+    so the batch takes about as long as its slowest check.
+    """
+
+    def __init__(self, checks, workers, timeout, config_file, options, environment, on_finished):
+        """
+        Start the checks.
+        :param checks: check names.
+        :param workers: max number of checks running at the same time.
+        :param timeout: time given to every check, in seconds.
+        :param config_file: config file of lightson-ng the checks are run with, None if not known.
+        :param options: options of lightson-ng command line the checks are run with.
+        :param environment: variables added to the environment of check processes.
+        :param on_finished: function called with results: check name -> (return code, disable reason).
+        """
+        self.configFile = config_file
+        self.options = options
+        self.environment = environment
+        self.queue = list(dict.fromkeys(checks))
+        self.workers = max(workers, 1)
+        self.timeout = timeout
+        self.on_finished = on_finished
+        self.running = 0
+        self.killed = set()
+        self.results = {}
+        log(f"Running checks concurrently: {self.queue}")
+        self.start_checks()
+
+    def start_checks(self):
+        """
+        Start the checks from the queue while there are free workers. Report results when all checks are finished.
+        """
+        while self.queue and self.running < self.workers:
+            name = self.queue.pop(0)
+            command = check_command(name, self.configFile, self.options)
+            if command is None:
+                self.results[name] = (RUN_CHECK_NO_RESULT, "")
+                continue
+            try:
+                process = spawn_check(command, self.environment)
+            except (GLib.Error, Exception):
+                log_error("can not run check " + name)
+                self.results[name] = (RUN_CHECK_NO_RESULT, "")
+                continue
+
+            self.running += 1
+            cancellable = Gio.Cancellable()
+            killTimerId = GLib.timeout_add_seconds(self.timeout, self.kill_check, process, name, cancellable)
+            process.communicate_utf8_async(None, cancellable, self.on_check_finished, (name, killTimerId))
+
+        if not self.queue and not self.running:
+            log(f"Checks finished: {self.results}")
+            self.on_finished(self.results)
+
+    def kill_check(self, process, name, cancellable):
+        """
+        The check is running too long.
+        :return: False to stop GLib timer.
+        """
+        log_error("check " + name + " is killed by timeout")
+        self.killed.add(name)
+        kill_check_process(process, cancellable)
+        return False
+
+    def on_check_finished(self, process, result, user_data):
+        """
+        Store the result printed by the check and start the next one.
+        """
+        name, killTimerId = user_data
+        if name not in self.killed:
+            GLib.source_remove(killTimerId)
+
+        try:
+            stdout = process.communicate_utf8_finish(result)[1] or ""
+        except (GLib.Error, Exception):
+            stdout = ""
+
+        checkResult = parse_check_output(stdout)
+        if name in self.killed:
+            self.results[name] = (RUN_CHECK_TIMEOUT, "")
+        elif checkResult is None:
+            self.results[name] = (RUN_CHECK_NO_RESULT, "")
+        else:
+            self.results[name] = checkResult
+
+        self.running -= 1
+        self.start_checks()
+
+
+class SessionTracker:
+    """
+    Track the active GUI session of the user.
+    The session is found by asking logind, the same way as getGuiVariables() of lightson-ng does with loginctl,
+    but only when logind signals that sessions are changed: a session is added or removed, or it becomes (in)active.
+    Otherwise, the session found before is returned.
+    """
+
+    def __init__(self):
+        # None means: session should be found again.
+        self.session = None
+        self.gdmUser = None
+        # Environment file written last: (file name, PID of process the environment is taken from).
+        self.envWritten = None
+
+        try:
+            self.bus = Gio.bus_get_sync(Gio.BusType.SYSTEM)
+        except (GLib.Error, Exception):
+            log_error("can not connect to system bus, GUI session is not tracked")
+            self.bus = None
+            return
+
+        for signal_name in ("SessionNew", "SessionRemoved"):
+            self.bus.signal_subscribe(LOGIN1_NAME, LOGIN1_MANAGER, signal_name, LOGIN1_PATH, None,
+                                      Gio.DBusSignalFlags.NONE, self.on_sessions_changed)
+        # Properties of all sessions: arg0 is the interface name.
+        self.bus.signal_subscribe(LOGIN1_NAME, "org.freedesktop.DBus.Properties", "PropertiesChanged", None,
+                                  LOGIN1_SESSION, Gio.DBusSignalFlags.NONE, self.on_session_properties_changed)
+
+    # noinspection PyUnusedLocal
+    def on_sessions_changed(self, connection, sender_name, object_path, interface_name, signal_name, parameters):
+        """
+        A session is added or removed.
+        """
+        log("logind: " + signal_name)
+        self.session = None
+
+    # noinspection PyUnusedLocal
+    def on_session_properties_changed(self, connection, sender_name, object_path, interface_name, signal_name,
+                                      parameters):
+        """
+        Properties of a session are changed. Only the properties GUI session is found by are of interest.
+        """
+        changed, invalidated = parameters.unpack()[1:]
+        if {"Active", "Type"} & (set(changed) | set(invalidated)):
+            log("logind: properties of session " + object_path + " are changed")
+            self.session = None
+
+    def get_gui_session(self, gdm_user, env_file):
+        """
+        Return the active GUI session, find it if needed. Write environment of the session into the file.
+        The file is rewritten only if it or the session is changed.
+        :param gdm_user: user of the login screen, its session is not a GUI session.
+        :param env_file: file to write environment variables to, as "name=value" lines.
+        :return: dictionary: session, user, uid, leader, envPid. Empty if no GUI session. None on error.
+        """
+        if self.bus is None:
+            return None
+
+        try:
+            if self.session is None or gdm_user != self.gdmUser:
+                self.gdmUser = gdm_user
+                self.session = self.find_gui_session(gdm_user)
+                log("GUI session: " + str(self.session))
+
+            guiSession = self.session
+
+            # The session is found, but its environment is not ready yet. Look for it again next time.
+            if guiSession and "envPid" not in guiSession:
+                self.session = None
+                return {}
+
+            if guiSession and self.envWritten != (env_file, guiSession["envPid"]):
+                with open("/proc/" + guiSession["envPid"] + "/environ", "rb") as environ:
+                    environment = environ.read().replace(b"\0", b"\n")
+                self.write_env_file(env_file, environment, int(guiSession["uid"]))
+                self.envWritten = (env_file, guiSession["envPid"])
+
+        except (GLib.Error, OSError, Exception):
+            log_error("can not get GUI session")
+            self.session = None
+            self.envWritten = None
+            return None
+
+        return guiSession
+
+    def check_environment(self):
+        """
+        Environment of the check run by the service: the GUI session found for lightson-ng and the file
+        its environment is written to, so the check does not ask for them again.
+        :return: dictionary: variable -> value. Empty if the session or its environment is not known.
+        """
+        if not self.session or self.envWritten is None or self.envWritten[1] != self.session.get("envPid"):
+            return {}
+        return {"LIGHTSON_GUI_USER": self.session["user"], "LIGHTSON_GUI_ENV_FILE": self.envWritten[0]}
+
+    def get_gui_uid(self):
+        """
+        Return the unix user of the active GUI session, find the session if needed.
+        :return: uid as string, None if no GUI session or on error.
+        """
+        if self.bus is None:
+            return None
+
+        try:
+            if self.session is None:
+                self.session = self.find_gui_session(self.gdmUser)
+                log("GUI session: " + str(self.session))
+        except (GLib.Error, Exception):
+            log_error("can not get GUI session")
+            self.session = None
+            return None
+
+        return self.session.get("uid")
+
+    @staticmethod
+    def write_env_file(env_file, environment, uid):
+        """
+        Write the environment into a new file, readable by the owner only, and move it in place of the file.
+        The file is never opened by its name: a link planted there is replaced, not followed.
+        The file is owned by the user of GUI session: suGui() of lightson-ng sources it as that user.
+        :param env_file: file to write environment variables to.
+        :param environment: "name=value" lines.
+        :param uid: unix user of GUI session.
+        """
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(env_file) or ".",
+                                         prefix=os.path.basename(env_file) + ".")
+        try:
+            with os.fdopen(fd, "wb") as env:
+                # Not running as root (session bus): the file is owned by the user running lightson-ng already.
+                if os.getuid() == 0:
+                    os.fchown(env.fileno(), uid, -1)
+                env.write(environment)
+            os.replace(temporary, env_file)
+        except OSError:
+            os.unlink(temporary)
+            raise
+
+    def find_gui_session(self, gdm_user):
+        """
+        Ask logind for the active x11 session of a user other than gdm.
+        :param gdm_user: user of the login screen.
+        :return: dictionary: session, user, uid, leader, envPid (if process with environment is found). Empty if no session.
+        """
+        sessions = self.bus.call_sync(LOGIN1_NAME, LOGIN1_PATH, LOGIN1_MANAGER, "ListSessions", None,
+                                      GLib.VariantType("(a(susso))"), Gio.DBusCallFlags.NONE,
+                                      SERVICE_OPERATION_TIMEOUT * 1000, None).unpack()[0]
+        guiSession = {}
+        for session_id, uid, user, seat, session_path in sessions:
+            properties = self.bus.call_sync(LOGIN1_NAME, session_path, "org.freedesktop.DBus.Properties", "GetAll",
+                                            GLib.Variant("(s)", (LOGIN1_SESSION,)), GLib.VariantType("(a{sv})"),
+                                            Gio.DBusCallFlags.NONE, SERVICE_OPERATION_TIMEOUT * 1000,
+                                            None).unpack()[0]
+
+            if properties["Type"] == "x11" and properties["Active"] and properties["Name"] != gdm_user:
+                guiSession = {"session": session_id, "user": properties["Name"], "uid": str(uid),
+                              "leader": str(properties["Leader"])}
+                envPid = self.find_env_process(properties["Leader"])
+                if envPid is not None:
+                    guiSession["envPid"] = str(envPid)
+
+        return guiSession
+
+    @staticmethod
+    def find_env_process(leader):
+        """
+        Find the process holding GUI environment among descendants of session leader.
+        In Gnome3, a leader is gdm-session-worker, its child is gdm-x-session and then gnome-session-binary.
+        :param leader: PID of session leader.
+        :return: PID of the process, None if not found.
+        """
+        children = {}
+        for pid in filter(str.isdigit, os.listdir("/proc")):
+            try:
+                with open("/proc/" + pid + "/stat") as stat_file:
+                    stat = stat_file.read()
+            except OSError:
+                continue
+            # Process name is in parentheses and may contain spaces, parent PID follows the state.
+            name = stat[stat.find("(") + 1:stat.rfind(")")]
+            ppid = int(stat[stat.rfind(")") + 2:].split()[1])
+            children.setdefault(ppid, []).append((int(pid), name))
+
+        # The nearest descendant is taken, the latest one if there are several of them.
+        level = [leader]
+        while level:
+            descendants = sorted((child for parent in level for child in children.get(parent, [])), reverse=True)
+            for pid, name in descendants:
+                if name == GUI_ENV_PROCESS:
+                    return pid
+            level = [pid for pid, name in descendants]
+
+        return None
+
+
+class PowerTracker:
+    """
+    Track whether the system is on battery, by the changes of UPower's OnBattery property.
+    """
+
+    def __init__(self):
+        # None means: unknown, ex. UPower is not running.
+        self.onBattery = None
+
+        try:
+            self.bus = Gio.bus_get_sync(Gio.BusType.SYSTEM)
+        except (GLib.Error, Exception):
+            log_error("can not connect to system bus, power source is not tracked")
+            return
+
+        self.bus.signal_subscribe(UPOWER_NAME, "org.freedesktop.DBus.Properties", "PropertiesChanged", UPOWER_PATH,
+                                  UPOWER_NAME, Gio.DBusSignalFlags.NONE, self.on_properties_changed)
+        # UPower may be restarted.
+        Gio.bus_watch_name_on_connection(self.bus, UPOWER_NAME, Gio.BusNameWatcherFlags.NONE,
+                                         self.on_upower_appeared, self.on_upower_vanished)
+
+    # noinspection PyUnusedLocal
+    def on_upower_appeared(self, connection, name, owner):
+        """
+        Read the initial value of the property.
+        """
+        try:
+            self.onBattery = self.bus.call_sync(UPOWER_NAME, UPOWER_PATH, "org.freedesktop.DBus.Properties", "Get",
+                                                GLib.Variant("(ss)", (UPOWER_NAME, "OnBattery")),
+                                                GLib.VariantType("(v)"), Gio.DBusCallFlags.NONE,
+                                                SERVICE_OPERATION_TIMEOUT * 1000, None).unpack()[0]
+        except (GLib.Error, Exception):
+            log_error("can not read OnBattery property of UPower")
+            self.onBattery = None
+        log("On battery: " + str(self.onBattery))
+
+    # noinspection PyUnusedLocal
+    def on_upower_vanished(self, connection, name):
+        """
+        UPower has gone, the power source is unknown.
+        """
+        self.onBattery = None
+
+    # noinspection PyUnusedLocal
+    def on_properties_changed(self, connection, sender_name, object_path, interface_name, signal_name, parameters):
+        """
+        Power source is changed.
+        """
+        changed = parameters.unpack()[1]
+        if "OnBattery" in changed:
+            self.onBattery = changed["OnBattery"]
+            log("On battery: " + str(self.onBattery))
+
+
+def parse_config(content):
+    """
+    Parse the assignments of lightson-ng config file, the simple way: "name=value" and "declare -A name=( ... )".
+    Quotes and comments are removed from scalar values, arrays are kept as written. Commands are skipped.
+    :param content: text of config file.
+    :return: dictionary: variable name -> value. The last assignment wins, as when the file is sourced.
+    """
+    config = {}
+    lines = iter(content.splitlines())
+    for line in lines:
+        match = re.match(r'\s*(?:declare\s+-\w+\s+)?([A-Za-z_]\w*)=(.*)$', line)
+        if not match:
+            continue
+        name, value = match.groups()
+
+        if value.startswith("("):
+            # Array may span several lines, until its parentheses are closed.
+            while value.count("(") > value.count(")"):
+                nextLine = next(lines, None)
+                if nextLine is None:
+                    break
+                value += "\n" + nextLine
+        else:
+            try:
+                words = shlex.split(value, comments=True)
+                value = words[0] if words else ""
+            except ValueError:
+                pass
+
+        config[name] = value
+    return config
+
+
+class ConfigWatcher:
+    """
+    Watch the config file of lightson-ng. The file is parsed once, and again only when it is written and closed
+    (inotify's IN_CLOSE_WRITE) or another file is moved in its place (IN_MOVED_TO), as editors save it.
+    Every change of the content increments the generation, so lightson-ng reads the config again
+    only when the generation moves.
+    """
+
+    def __init__(self, on_change):
+        """
+        :param on_change: function called with the new generation when the content of file is changed.
+        """
+        self.on_change = on_change
+        self.path = None
+        self.monitor = None
+        self.content = None
+        self.config = {}
+        self.generation = 0
+
+    def watch(self, path):
+        """
+        Start watching the config file. File watched before is not watched anymore.
+        :param path: config file.
+        :return: generation of config.
+        """
+        if path != self.path:
+            if self.monitor is not None:
+                self.monitor.cancel()
+            self.path = path
+            try:
+                self.monitor = Gio.File.new_for_path(path).monitor_file(Gio.FileMonitorFlags.WATCH_MOVES, None)
+                self.monitor.connect("changed", self.on_file_changed)
+            except (GLib.Error, Exception):
+                log_error("can not watch config file: " + path)
+                self.monitor = None
+            log("Watching config file: " + path)
+
+        self.read()
+        return self.generation
+
+    # noinspection PyUnusedLocal
+    def on_file_changed(self, monitor, changed_file, other_file, event_type):
+        """
+        Read the file when it is completely written or replaced. Partial writes (CHANGED) are not read.
+        The file replaced by rename within its directory is the other file of RENAMED event,
+        the file moved in from another directory (mv, install) or created anew is the changed file.
+        """
+        if event_type == Gio.FileMonitorEvent.RENAMED:
+            replaced = other_file is not None and other_file.get_path() == self.path
+        else:
+            replaced = event_type in (Gio.FileMonitorEvent.MOVED_IN, Gio.FileMonitorEvent.CREATED) \
+                and changed_file.get_path() == self.path
+        if (event_type == Gio.FileMonitorEvent.CHANGES_DONE_HINT or replaced) and self.read():
+            self.on_change(self.generation)
+
+    def read(self):
+        """
+        Read and parse the file if its content is changed.
+        :return: True if content is changed.
+        """
+        try:
+            with open(self.path) as config_file:
+                content = config_file.read()
+        except OSError:
+            log_error("can not read config file: " + self.path)
+            return False
+
+        if content == self.content:
+            return False
+
+        self.content = content
+        self.config = parse_config(content)
+        self.generation += 1
+        log(f"Config file {self.path} is read, generation: {self.generation}")
+        return True
+
+
+class StatsSnapshot:
+    """
+    Stats of the last iteration in the memory-mapped file of fixed size, so readers (indicator, --get client)
+    take them without DBUS: after the file is mapped, a read is memory access, plus a check of /proc/<pid>
+    of the writer if the reader asks for it.
+    Layout: header, then the stats as JSON object of "length" bytes.
+        header: magic "LSNG", version (uint32), sequence (uint64), length (uint32), pid of writer (uint32).
+    The stats are protected by seqlock: sequence is odd while the stats are written, and is incremented again
+    when they are written. Reader copies the stats and takes them if sequence is even and not changed meanwhile.
+    There is the only writer: the stats service.
+    Note: Python gives no memory barriers, the order of stores is kept by the memory model of x86 and
+    by the copy of the stats taken between two reads of the sequence.
+    """
+
+    HEADER = struct.Struct("<4sIQII")
+    MAGIC = b"LSNG"
+    VERSION = 1
+    SEQUENCE_OFFSET = 8
+
+    def __init__(self, path, size=STATS_SNAPSHOT_SIZE):
+        """
+        Create the snapshot file, readable by everybody. Snapshot left by the previous run is replaced:
+        the new file is created aside and renamed in its place. The old file is never truncated,
+        readers still mapping it would be killed by SIGBUS, they see it removed and map the new file.
+        :param path: snapshot file.
+        :param size: size of the stats area. [bytes]
+        """
+        self.path = path
+        self.size = size
+        self.sequence = 0
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+        self.invalidate(path)
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".")
+        try:
+            os.fchmod(fd, 0o644)
+            os.ftruncate(fd, self.HEADER.size + size)
+            self.map = mmap.mmap(fd, self.HEADER.size + size)
+            self.HEADER.pack_into(self.map, 0, self.MAGIC, self.VERSION, self.sequence, 0, os.getpid())
+            os.replace(temporary, path)
+        except OSError:
+            os.unlink(temporary)
+            raise
+        finally:
+            os.close(fd)
+        log("Publishing stats to " + path)
+
+    @classmethod
+    def invalidate(cls, path):
+        """
+        Mark the snapshot left by the previous run as removed, for readers still mapping it.
+        The header is overwritten in place, the size of file is not changed.
+        :param path: snapshot file.
+        """
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NOFOLLOW)
+        except OSError:
+            return
+        try:
+            if os.fstat(fd).st_size >= cls.HEADER.size:
+                os.pwrite(fd, bytes(cls.HEADER.size), 0)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def publish(self, stats):
+        """
+        :param stats: dictionary: key -> value.
+        """
+        data = json.dumps(stats).encode()
+        if len(data) > self.size:
+            log_error(f"stats of {len(data)} bytes do not fit into snapshot file {self.path}")
+            return
+
+        self.sequence += 1
+        struct.pack_into("<Q", self.map, self.SEQUENCE_OFFSET, self.sequence)
+        self.map[self.HEADER.size:self.HEADER.size + len(data)] = data
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.VERSION, self.sequence + 1, len(data), os.getpid())
+        self.sequence += 1
+
+    def close(self):
+        """
+        Remove the snapshot file. Readers still mapping it see no stats and map the file again.
+        """
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.VERSION, 0, 0, 0)
+        self.map.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class StatsSnapshotReader:
+    """
+    Reader of StatsSnapshot. The file is mapped once, read-only, and is mapped again when it is re-created.
+    """
+
+    # Attempts to read the stats while they are being written.
+    READ_ATTEMPTS = 100
+
+    def __init__(self, path=STATS_SNAPSHOT_FILE):
+        self.path = path
+        self.map = None
+        self.sequence = None
+
+    def open(self):
+        """
+        :return: True if the snapshot file is mapped.
+        """
+        try:
+            with open(self.path, "rb") as snapshot_file:
+                self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.map = None
+        return self.map is not None
+
+    def read(self, check_writer=False):
+        """
+        :param check_writer: return None if the writer is not running, ex. the stats service crashed.
+        :return: the stats: key -> value, None if the snapshot is not available.
+        """
+        if self.map is None and not self.open():
+            return None
+
+        header = StatsSnapshot.HEADER
+        for attempt in range(self.READ_ATTEMPTS):
+            try:
+                magic, version, sequence, length, pid = header.unpack_from(self.map, 0)
+            except struct.error:
+                # The file is shorter than the header: it is not a snapshot.
+                self.map = None
+                return None
+            if magic != StatsSnapshot.MAGIC or version != StatsSnapshot.VERSION or sequence == 0:
+                # Nothing is published yet, or the file is removed by the writer: map it again next time.
+                self.map = None
+                return None
+            if sequence % 2:
+                continue
+            data = self.map[header.size:header.size + length]
+            if struct.unpack_from("<Q", self.map, StatsSnapshot.SEQUENCE_OFFSET)[0] != sequence:
+                continue
+            if check_writer and not os.path.exists(f"/proc/{pid}"):
+                # The writer has died without removing the file: map the file again next time,
+                # it is replaced by the new writer.
+                self.map = None
+                return None
+            self.sequence = sequence
+            return json.loads(data)
+        return None
+
+
+class MetricsExporter:
+    """
+    Export the stats of lightson-ng as OpenMetrics text, to be scraped by Prometheus:
+    disabled PM states, loop delay, iterations, runs and hits of checks, runtime errors.
+    The HTTP server is Gio.SocketService running in the main loop, listening on 127.0.0.1 port or unix socket.
+    The response is rendered once per iteration, by SetTimer(), so scrapes only send the snapshot:
+    they never touch stats and SetStats() does not render anything.
+    """
+
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def __init__(self, address):
+        """
+        :param address: [HOST:]PORT or unix:PATH.
+        """
+        self.iterations = 0
+        self.checkRuns = {}
+        self.checkHits = {}
+        self.response = b""
+        self.update((), None, None, {}, count_iteration=False)
+
+        self.socketPath = None
+        self.service = Gio.SocketService()
+        if address.startswith("unix:"):
+            self.socketPath = address[len("unix:"):]
+            # Socket left by the previous run.
+            if os.path.exists(self.socketPath):
+                os.unlink(self.socketPath)
+            socket_address = Gio.UnixSocketAddress.new(self.socketPath)
+            protocol = Gio.SocketProtocol.DEFAULT
+        else:
+            host, port = address.rsplit(":", 1) if ":" in address else ("127.0.0.1", address)
+            socket_address = Gio.InetSocketAddress.new_from_string(host, int(port))
+            protocol = Gio.SocketProtocol.TCP
+        self.service.add_address(socket_address, Gio.SocketType.STREAM, protocol, None)
+        self.service.connect("incoming", self.on_incoming)
+        self.service.start()
+        log("Exporting metrics on " + address)
+
+    def stop(self):
+        self.service.stop()
+        self.service.close()
+        if self.socketPath is not None and os.path.exists(self.socketPath):
+            os.unlink(self.socketPath)
+
+    @staticmethod
+    def label(value):
+        """
+        :return: label value escaped as OpenMetrics requires.
+        """
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def update(self, reasons, loop_delay, runtime_errors, check_results, count_iteration=True):
+        """
+        Count the iteration and render the snapshot sent to scrapers.
+        :param reasons: main disable reasons of the iteration: (disableReason_<state>, reason).
+        :param loop_delay: loop delay the timer is set on. [seconds]
+        :param runtime_errors: errors occurred in lightson-ng since its start.
+        :param check_results: checks performed by the iteration: checkPerformed_<check> -> return code.
+        :param count_iteration: False for the initial snapshot, rendered before any iteration.
+        """
+        if count_iteration:
+            self.iterations += 1
+        for name, result in check_results.items():
+            if result == "skipped":
+                continue
+            check = name[len("checkPerformed_"):]
+            self.checkRuns[check] = self.checkRuns.get(check, 0) + 1
+            if result == "0":
+                self.checkHits[check] = self.checkHits.get(check, 0) + 1
+
+        lines = ["# TYPE lightson_disabled gauge",
+                 "# HELP lightson_disabled 1 if lightson-ng has found a reason to disable the PM state."]
+        lines += [f'lightson_disabled{{state="{self.label(name.split("_", 1)[1])}"}} {1 if reason else 0}'
+                  for name, reason in reasons]
+        lines += ["# TYPE lightson_loop_delay_seconds gauge",
+                  "# UNIT lightson_loop_delay_seconds seconds",
+                  "# HELP lightson_loop_delay_seconds Delay before the next iteration of lightson-ng."]
+        if loop_delay is not None:
+            lines.append(f"lightson_loop_delay_seconds {loop_delay}")
+        lines += ["# TYPE lightson_iterations counter",
+                  "# HELP lightson_iterations Iterations of lightson-ng seen by the stats module.",
+                  f"lightson_iterations_total {self.iterations}",
+                  "# TYPE lightson_check_runs counter",
+                  "# HELP lightson_check_runs Checks performed, skipped checks are not counted."]
+        lines += [f'lightson_check_runs_total{{check="{self.label(check)}"}} {runs}'
+                  for check, runs in sorted(self.checkRuns.items())]
+        lines += ["# TYPE lightson_check_hits counter",
+                  "# HELP lightson_check_hits Checks which have found a reason to disable PM state."]
+        lines += [f'lightson_check_hits_total{{check="{self.label(check)}"}} {self.checkHits.get(check, 0)}'
+                  for check in sorted(self.checkRuns)]
+        lines += ["# TYPE lightson_runtime_errors counter",
+                  "# HELP lightson_runtime_errors Errors occurred in lightson-ng since its start."]
+        if runtime_errors is not None:
+            lines.append(f"lightson_runtime_errors_total {runtime_errors}")
+        lines.append("# EOF")
+
+        body = ("\n".join(lines) + "\n").encode()
+        self.response = (f"HTTP/1.0 200 OK\r\nContent-Type: {self.CONTENT_TYPE}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode() + body
+
+    # noinspection PyUnusedLocal
+    def on_incoming(self, service, connection, source_object):
+        """
+        Read the request of scraper, whatever it is, and reply with the snapshot.
+        """
+        connection.get_input_stream().read_bytes_async(4096, GLib.PRIORITY_DEFAULT, None,
+                                                       self.on_request, connection)
+        return True
+
+    def on_request(self, input_stream, result, connection):
+        try:
+            input_stream.read_bytes_finish(result)
+        except (GLib.Error, Exception):
+            log_error("can not read metrics request")
+            connection.close(None)
+            return
+        self.write(connection, self.response)
+
+    def write(self, connection, data):
+        connection.get_output_stream().write_bytes_async(GLib.Bytes.new(data), GLib.PRIORITY_DEFAULT, None,
+                                                         self.on_written, (connection, data))
+
+    def on_written(self, output_stream, result, user_data):
+        """
+        Write the rest of response if it is written partially, close the connection when it is written.
+        """
+        connection, data = user_data
+        try:
+            written = output_stream.write_bytes_finish(result)
+        except (GLib.Error, Exception):
+            log_error("can not send metrics")
+            written = len(data)
+        if written < len(data):
+            self.write(connection, data[written:])
+        else:
+            connection.close(None)
+
+
+class LoopScheduler:
+    """
+    Adaptive policy of the loop delay, driven by the history of iterations.
+    lightson-ng calculates the delay from the timeouts and the idle counter of the current iteration only,
+    the scheduler also remembers the disable reasons of recent iterations:
+      - reasons change often - the delay is halved, so the next change is noticed earlier;
+      - reasons have not changed, and either every state is held by a reason, or the user was active during
+        the last delay - the delay is doubled for every quiet iteration, up to 2^LOOP_SCHEDULER_MAX_BACKOFF times;
+      - while some state is not held, the delay never exceeds the time left to the nearest idle/sleep timeout
+        minus spare time: that is the time the new reason has to be found in. The time lightson-ng has calculated
+        its delay from is not a limit: a state held by its inhibitor does not go idle, whatever the idle counter is;
+      - while every state is held, the delay never exceeds twice the timeout: the inhibitor is released
+        at most one timeout later than without the scheduler, when the reason is gone;
+      - the delay is never lower than the minimal loop delay, nor than 1 second.
+    Back off is done only when the timeout is known, and the idle counter too while some state is not held,
+    otherwise the delay is not increased.
+    """
+
+    def __init__(self):
+        self.history = deque(maxlen=LOOP_SCHEDULER_HISTORY)
+        self.lastPlanTime = None
+
+    def plan(self, delay, reasons, idle_counter=None, idle_timeout=None, min_delay=0, spare_time=0, held=False,
+             now=None):
+        """
+        Choose the loop delay and remember the iteration.
+        :param delay: loop delay calculated by lightson-ng. [seconds]
+        :param reasons: disable reasons of the iteration, any comparable value.
+        :param idle_counter: idle counter read by the iteration, None if unknown. [seconds]
+        :param idle_timeout: the nearest idle/sleep timeout, None if unknown. [seconds]
+        :param min_delay: minimal loop delay. [seconds]
+        :param spare_time: time reserved for performing checks. [seconds]
+        :param held: every PM state is held by a disable reason, so no timeout comes until the next iteration.
+        :param now: monotonic time of the iteration, current time if not given. [seconds]
+        :return: tuple: delay, reason of the choice.
+        """
+        now = time.monotonic() if now is None else now
+        self.history.append(reasons)
+        history = list(self.history)
+
+        changes = sum(previous != current for previous, current in zip(history, history[1:]))
+        quiet = 0
+        for previous in reversed(history[:-1]):
+            if previous != reasons:
+                break
+            quiet += 1
+
+        # Idle counter is lower than the time passed since the last plan: the user did something meanwhile.
+        userActive = idle_counter is not None and self.lastPlanTime is not None \
+            and idle_counter < now - self.lastPlanTime
+        self.lastPlanTime = now
+
+        timeLeft = None
+        if idle_timeout is not None and idle_counter is not None and not held:
+            timeLeft = idle_timeout - idle_counter - spare_time
+
+        if changes >= 2:
+            newDelay = delay // 2
+            reason = f"reasons changed {changes} times in {len(history)} iterations"
+        elif quiet and held and idle_timeout is not None:
+            newDelay = min(delay * 2 ** min(quiet, LOOP_SCHEDULER_MAX_BACKOFF), max(2 * idle_timeout, delay))
+            reason = f"no changes for {quiet} iterations, all states are held"
+        elif quiet and userActive and timeLeft is not None:
+            newDelay = delay * 2 ** min(quiet, LOOP_SCHEDULER_MAX_BACKOFF)
+            reason = f"no changes for {quiet} iterations, user is active"
+        else:
+            newDelay = delay
+            reason = "delay of lightson-ng"
+
+        # The timeout is already passed: the state is idle already, looking for reasons sooner would not help.
+        if timeLeft is not None and 0 < timeLeft < newDelay:
+            newDelay = timeLeft
+            reason += f", {timeLeft} seconds left to timeout"
+
+        # Timeout is already passed or the halved delay is zero: keep looping, at least every second.
+        minDelay = max(1, min_delay)
+        if newDelay < minDelay:
+            newDelay = minDelay
+            reason += ", limited by min delay"
+
+        return newDelay, f"{newDelay} seconds: {reason}"
+
+
+class LateChecker:
+    """
+    Decide whether sleep should be prevented, right before the system goes to sleep.
+    logind's delay inhibitor holds the sleep when PrepareForSleep(true) comes, so lightson-ng has time
+    to do the late check iteration: all checks are done, but inhibitors are not set.
+    Then the delay inhibitor is released, and the decision is ready when lightson-ng-late-check service asks for it.
+    Note: delay inhibitor can only delay the sleep, it is the late check service failing which breaks the sleep chain.
+    The sleep is delayed only after lightson-ng enables the Late Check, i.e. the late check service is in the sleep chain.
+    """
+
+    def __init__(self, request_check, cached_reason):
+        """
+        :param request_check: function to ask lightson-ng to do the late check iteration.
+        :param cached_reason: function returning the sleep disable reason found by the last regular iteration.
+        """
+        self.request_check = request_check
+        self.cached_reason = cached_reason
+        # Sleep disable reason found by the late check iteration, None if not found yet.
+        self.lateReason = None
+        self.waiting = []
+        self.timeoutId = None
+        self.delayFd = None
+        self.bus = None
+
+    def enable(self):
+        """
+        Watch the sleep and delay it for the late check iteration. Called once lightson-ng asks for late checks.
+        """
+        if self.bus is not None:
+            return
+        try:
+            self.bus = Gio.bus_get_sync(Gio.BusType.SYSTEM)
+        except (GLib.Error, Exception):
+            log_error("can not connect to system bus, sleep is not watched")
+            return
+
+        log("Late Check is enabled")
+        self.bus.signal_subscribe(LOGIN1_NAME, LOGIN1_MANAGER, "PrepareForSleep", LOGIN1_PATH, None,
+                                  Gio.DBusSignalFlags.NONE, self.on_prepare_for_sleep)
+        self.take_delay_inhibitor()
+
+    def take_delay_inhibitor(self):
+        """
+        Ask logind to wait for lightson-ng before the sleep.
+        """
+        if self.bus is None or self.delayFd is not None:
+            return
+        try:
+            result, fdList = self.bus.call_with_unix_fd_list_sync(
+                LOGIN1_NAME, LOGIN1_PATH, LOGIN1_MANAGER, "Inhibit",
+                GLib.Variant("(ssss)", ("sleep", INHIBITOR_WHO, "Late check of lightson-ng", "delay")),
+                GLib.VariantType("(h)"), Gio.DBusCallFlags.NONE, SERVICE_OPERATION_TIMEOUT * 1000, None, None)
+            self.delayFd = fdList.get(result.unpack()[0])
+        except (GLib.Error, Exception):
+            log_error("can not add delay inhibitor of sleep")
+
+    def release_delay_inhibitor(self):
+        """
+        Let logind continue to sleep.
+        """
+        if self.delayFd is not None:
+            os.close(self.delayFd)
+            self.delayFd = None
+
+    # noinspection PyUnusedLocal
+    def on_prepare_for_sleep(self, connection, sender_name, object_path, interface_name, signal_name, parameters):
+        """
+        System is going to sleep (True), or has resumed/cancelled the sleep (False).
+        """
+        if parameters.unpack()[0]:
+            log("System is preparing for sleep")
+            self.start_check()
+        else:
+            log("System has resumed")
+            self.lateReason = None
+            self.take_delay_inhibitor()
+
+    def start_check(self):
+        """
+        Ask lightson-ng to do the late check iteration, wait for it a limited time.
+        """
+        if self.timeoutId is not None:
+            return
+        self.lateReason = None
+        self.timeoutId = GLib.timeout_add(LATE_CHECK_TIMEOUT, self.on_check_timeout)
+        self.request_check()
+
+    def on_check_timeout(self):
+        """
+        lightson-ng has not finished the late check iteration in time.
+        :return: False to stop GLib timer.
+        """
+        log_error("late check iteration is not finished in time, the decision of the last iteration is taken")
+        self.timeoutId = None
+        self.finish_check()
+        return False
+
+    def set_result(self, state, reason_found):
+        """
+        Result of the late check iteration reported by lightson-ng.
+        :param state: PM state, only sleep is of interest.
+        :param reason_found: True if reason to disable the state is found.
+        """
+        if state != "sleep" or self.timeoutId is None:
+            return
+        GLib.source_remove(self.timeoutId)
+        self.timeoutId = None
+        self.lateReason = "sleep disable reason is found by late check" if reason_found else ""
+        self.finish_check()
+
+    def finish_check(self):
+        """
+        The decision is made: reply it to everybody waiting and let logind continue.
+        """
+        preventSleep, reason = self.decision()
+        log(f"Late check: prevent sleep={preventSleep} {reason}")
+        for invocation in self.waiting:
+            invocation.return_value(_prepare_arguments("bs", (preventSleep, reason)))
+        self.waiting = []
+        self.release_delay_inhibitor()
+
+    def decision(self):
+        """
+        :return: tuple: sleep should be prevented, reason.
+        """
+        reason = self.lateReason if self.lateReason is not None else self.cached_reason()
+        return bool(reason), reason
+
+    # noinspection PyPep8Naming
+    def LateCheck(self, invocation):
+        """
+        Reply the decision to the late check service. Ask lightson-ng to do the late check iteration
+        if it is not done yet, ex. when the sleep was not announced by PrepareForSleep.
+        :param invocation: method invocation to reply.
+        """
+        if self.lateReason is None and self.timeoutId is None:
+            self.start_check()
+
+        if self.timeoutId is not None:
+            self.waiting.append(invocation)
+        else:
+            invocation.return_value(_prepare_arguments("bs", self.decision()))
+
+
+def late_check():
+    """
+    The Late Check: ask the running stats service whether sleep should be prevented.
+    Executed by lightson-ng-late-check service right before sleep.target.
+    The stats service is not activated by DBUS for the call: started without lightson-ng, it would only wait
+    for the late check iteration which never comes.
+    :return: exit code: non-zero to break the sleep chain of systemd, 0 to let the system sleep.
+    """
+    try:
+        preventSleep, reason = Gio.bus_get_sync(Gio.BusType.SYSTEM).call_sync(
+            SRV_NAME, OBJ_NAME, IF_NAME, "LateCheck", None, GLib.VariantType("(bs)"),
+            Gio.DBusCallFlags.NO_AUTO_START, LATE_CHECK_CALL_TIMEOUT, None).unpack()
+    except (GLib.Error, Exception):
+        log("lightson-ng is not running, sleep is allowed")
+        return 0
+
+    if preventSleep:
+        log("Sleep is prevented: " + reason)
+        return 1
+
+    log("Sleep is allowed")
+    return 0
+
+
+class StatsClient:
+    """
+    Print the stats of the running stats service for scripts: --get [KEY...], --watch, --json.
+    The stats are read from the snapshot file, if it is published. Otherwise, they are got by DBUS:
+    one DBUS connection is used for all calls. --watch follows IterationFinishedSignal instead of polling.
+    """
+
+    def __init__(self, keys, as_json, watching, session_bus):
+        """
+        :param keys: stats to print, all if empty.
+        :param as_json: print JSON object per line instead of KEY=VALUE lines.
+        :param watching: stats are printed after every iteration, separated by blank line.
+        :param session_bus: the stats service is on the session bus instead of the system one.
+        """
+        self.keys = keys
+        self.as_json = as_json
+        self.watching = watching
+        self.printed = None
+        self.snapshot = StatsSnapshotReader(cmdline.snapshot_file) if cmdline.snapshot_file else None
+        self.connection = Gio.bus_get_sync(Gio.BusType.SESSION if session_bus else Gio.BusType.SYSTEM, None)
+
+    def get_stats(self):
+        """
+        :return: the stats selected: key -> value.
+        """
+        stats = self.snapshot.read(check_writer=True) if self.snapshot is not None else None
+        if stats is None:
+            stats = self.connection.call_sync(SRV_NAME, OBJ_NAME, IF_NAME, "GetStats", None,
+                                              GLib.VariantType("(a{ss})"), Gio.DBusCallFlags.NONE,
+                                              SERVICE_OPERATION_TIMEOUT * 1000, None).unpack()[0]
+        if self.keys:
+            return {key: stats[key] for key in self.keys if key in stats}
+        return dict(sorted(stats.items()))
+
+    def print_stats(self):
+        """
+        Print the stats if they are changed since printed last time.
+        :return: exit code: 0 if the stats are got.
+        """
+        try:
+            stats = self.get_stats()
+        except (GLib.Error, Exception) as error:
+            print("Can not get stats: " + str(error), file=sys.stderr)
+            return 1
+
+        if stats != self.printed:
+            if self.as_json:
+                print(json.dumps(stats))
+            else:
+                print("\n".join(f"{key}={value}" for key, value in stats.items()))
+                # Blank line separates the stats of iterations.
+                if self.watching:
+                    print()
+            sys.stdout.flush()
+            self.printed = stats
+        return 0
+
+    def watch(self):
+        """
+        Print the stats after every iteration, until interrupted.
+        """
+        self.connection.signal_subscribe(SRV_NAME, IF_NAME, "IterationFinishedSignal", OBJ_NAME, None,
+                                         Gio.DBusSignalFlags.NONE, self.on_iteration_finished)
+        self.print_stats()
+        loop = GLib.MainLoop()
+        try:
+            loop.run()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    # noinspection PyUnusedLocal
+    def on_iteration_finished(self, connection, sender, object_path, interface_name, signal_name, parameters):
+        self.print_stats()
+
+
+class TimerEx(object):
+    """
+    A reusable thread safe timer implementation
+    Taken from https://stackoverflow.com/questions/22433394/calling-thread-timer-more-than-once
+    - returns itself to allow a one line timer creation and start
+    - optional parameter to restart a new timer or not if timer is still alive
+    """
+
+    def __init__(self, interval_sec, function, *args, **kwargs):
+        """
+        Create a timer object which can be restarted
+        :param interval_sec: The timer interval in seconds
+        :param function: The user function timer should call once elapsed
+        :param args: The user function arguments array (optional)
+        :param kwargs: The user function named arguments (optional)
+        """
+        self._interval_sec = interval_sec
+        self._function = function
+        self._args = args
+        self._kwargs = kwargs
+        # Locking is needed since the '_timer' object might be replaced in a different thread
+        self._timer_lock = Lock()
+        self._timer = None
+
+    def start(self, restart_if_alive=True):
+        """
+        Starts the timer and returns this object [e.g. my_timer = TimerEx(10, my_func).start()]
+        :param restart_if_alive: 'True' to start a new timer if current one is still alive
+        :return: This timer object (i.e. self)
+        """
+        with self._timer_lock:
+            # Current timer still running
+            if self._timer is not None:
+                if not restart_if_alive:
+                    # Keep the current timer
+                    return self
+                # Cancel the current timer
                 self._timer.cancel()
             # Create new timer
             self._timer = Timer(self._interval_sec, self.__internal_call)
@@ -592,10 +3273,24 @@ if __name__ == '__main__':
     # Parse command line
     parse_command_line(description="lightson-ng stats - dbus module")
 
+    if Gio is None:
+        notify_launcher("FAILED no Gio and GLib of PyGObject")
+        sys.exit("lightson-ng stats requires Gio and GLib of PyGObject")
+
+    # Client of the running stats service.
+    if cmdline.late_check:
+        sys.exit(late_check())
+    if cmdline.get_keys is not None or cmdline.watch:
+        statsClient = StatsClient(cmdline.get_keys, cmdline.json, cmdline.watch, cmdline.session_bus)
+        sys.exit(statsClient.watch() if cmdline.watch else statsClient.print_stats())
+
     # A loop to handle both API and DBUS
     mainloop = GLib.MainLoop()
 
     # Stats DBUS service.
-    StatObject()
+    statObject = StatObject()
+
+    # Exit cleanly when killed by lightson-ng or by systemd: inhibitors are released, the state is saved.
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, statObject.Quit)
 
     mainloop.run()
@@ -0,0 +1,53 @@
+import importlib.util
+import os
+import sys
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The agent runs in GUI session only, with PyGObject installed.
+if importlib.util.find_spec("gi") is not None:
+    # The agent imports the stats module by its file name.
+    sys.path.insert(0, REPO)
+    spec = importlib.util.spec_from_file_location("lightson_ng_agent", os.path.join(REPO, "lightson-ng-agent.py"))
+    agent = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(agent)
+else:
+    agent = None
+
+SINK_INPUTS = """Sink Input #41
+\tDriver: protocol-native.c
+\tCorked: no
+\tProperties:
+\t\tapplication.name = "Firefox"
+\t\tmedia.name = "AudioStream"
+
+Sink Input #42
+\tCorked: yes
+\tProperties:
+\t\tapplication.name = "VLC media player"
+
+Sink Input #43
+\tCorked: yes
+\tProperties:
+\t\tapplication.name = "Firefox"
+"""
+
+
+@unittest.skipIf(agent is None, "PyGObject is not installed")
+class TestParseSinkInputs(unittest.TestCase):
+
+    def test_applications(self):
+        self.assertEqual(agent.AudioTracker.parse_sink_inputs(SINK_INPUTS),
+                         {"firefox": True, "vlc media player": False})
+
+    def test_no_streams(self):
+        self.assertEqual(agent.AudioTracker.parse_sink_inputs(""), {})
+
+    def test_stream_without_corked_state(self):
+        self.assertEqual(agent.AudioTracker.parse_sink_inputs(
+            'Sink Input #1\n\tProperties:\n\t\tapplication.name = "mpv"\n'), {"mpv": False})
+
+
+if __name__ == "__main__":
+    unittest.main()
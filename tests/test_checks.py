@@ -0,0 +1,199 @@
+import argparse
+import importlib.util
+import os
+import select
+import subprocess
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+spec = importlib.util.spec_from_file_location(
+    "lightson_ng_stat", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lightson-ng-stat.py"))
+stat = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(stat)
+# Errors logged by the functions under test are not printed.
+stat.cmdline = argparse.Namespace(log_level="critical", log_syslog=False, print_stdout=False)
+
+
+class CheckProcess:
+    """
+    The part of Gio.Subprocess used by kill_check_process(), over subprocess.Popen.
+    """
+
+    def __init__(self, popen):
+        self.popen = popen
+        self.forceExited = False
+
+    def get_identifier(self):
+        return None if self.popen.poll() is not None else str(self.popen.pid)
+
+    def force_exit(self):
+        self.forceExited = True
+        self.popen.kill()
+
+
+class Cancellable:
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TestCheckOutput(unittest.TestCase):
+
+    def test_result_is_the_last_line(self):
+        self.assertEqual(stat.parse_check_output("debug output\n0\tvideo is playing\n"), (0, "video is playing"))
+        self.assertEqual(stat.parse_check_output("1\t"), (1, ""))
+
+    def test_no_result(self):
+        self.assertIsNone(stat.parse_check_output(""))
+        self.assertIsNone(stat.parse_check_output("0\tfirst\nsomething else\n"))
+        self.assertIsNone(stat.parse_check_output("x\treason"))
+
+
+class TestCheckCommand(unittest.TestCase):
+
+    def test_options(self):
+        self.assertEqual(stat.parse_check_options("--debug-on --window-name 'My Player' --no-syslog"),
+                         ["--debug-on", "--window-name", "My Player", "--no-syslog"])
+        self.assertEqual(stat.parse_check_options(""), [])
+
+    def test_options_not_passed(self):
+        self.assertIsNone(stat.parse_check_options("--delay 10"))
+        self.assertIsNone(stat.parse_check_options("--chrome-app"))
+        self.assertIsNone(stat.parse_check_options("'unclosed"))
+
+    def test_command(self):
+        command = stat.check_command("isFullscreenAppCheck", "/etc/lightson-ng.conf", ["--debug-on"])
+        self.assertEqual(command, ["setsid", stat.LIGHTSON_SCRIPT, "--config-file", "/etc/lightson-ng.conf",
+                                   "--debug-on", "--run-check", "isFullscreenAppCheck"])
+        self.assertEqual(stat.check_command("isCpuLoadHighCheck", None)[-3:],
+                         [stat.LIGHTSON_SCRIPT, "--run-check", "isCpuLoadHighCheck"])
+
+    def test_command_of_not_a_check(self):
+        self.assertIsNone(stat.check_command("rm -rf", None))
+        self.assertIsNone(stat.check_command("isCheck; reboot", None))
+
+
+class TestKillCheckProcess(unittest.TestCase):
+
+    def test_children_are_killed(self):
+        # The child of check keeps stdout open: the output is finished only when the whole session is killed.
+        popen = subprocess.Popen(["setsid", "sh", "-c", "sleep 60 & sleep 60"], stdout=subprocess.PIPE)
+        self.addCleanup(popen.stdout.close)
+        process = CheckProcess(popen)
+        cancellable = Cancellable()
+        time.sleep(0.2)
+
+        stat.kill_check_process(process, cancellable)
+
+        self.assertTrue(select.select([popen.stdout], [], [], 5)[0], "stdout is not closed")
+        self.assertEqual(popen.stdout.read(), b"")
+        self.assertEqual(popen.wait(5), -9)
+        self.assertFalse(process.forceExited)
+        self.assertTrue(cancellable.cancelled)
+
+    def test_finished_process(self):
+        popen = subprocess.Popen(["true"])
+        popen.wait()
+        cancellable = Cancellable()
+        stat.kill_check_process(CheckProcess(popen), cancellable)
+        self.assertTrue(cancellable.cancelled)
+
+    def test_process_not_in_its_session(self):
+        # The process group can not be killed: the process is killed alone.
+        process = SimpleNamespace(get_identifier=lambda: "999999999", force_exit=mock.Mock())
+        stat.kill_check_process(process)
+        process.force_exit.assert_called_once_with()
+
+
+class FakeCheck:
+    """
+    The part of Gio.Subprocess used by CheckBatch: the output is given by the test.
+    """
+
+    def __init__(self, command):
+        self.name = command[-1]
+        self.callback = None
+
+    @staticmethod
+    def get_identifier():
+        return None
+
+    def communicate_utf8_async(self, stdin, cancellable, callback, user_data):
+        self.cancellable = cancellable
+        self.callback = lambda: callback(self, None, user_data)
+
+    def communicate_utf8_finish(self, result):
+        if self.cancellable.cancelled:
+            raise OSError("cancelled")
+        return True, self.stdout, None
+
+
+class TestCheckBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.processes = {}
+        self.timers = {}
+
+        def spawn_check(command, environment):
+            process = self.processes[command[-1]] = FakeCheck(command)
+            return process
+
+        def timeout_add_seconds(interval, function, *args):
+            self.timers[len(self.timers) + 1] = lambda: function(*args)
+            return len(self.timers)
+
+        glib = SimpleNamespace(Error=OSError, timeout_add_seconds=timeout_add_seconds,
+                               source_remove=lambda timer_id: self.timers.pop(timer_id))
+        for patcher in (mock.patch.object(stat, "spawn_check", spawn_check),
+                        mock.patch.object(stat, "GLib", glib),
+                        mock.patch.object(stat, "Gio", SimpleNamespace(Cancellable=Cancellable))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def finish(self, name, stdout):
+        self.processes[name].stdout = stdout
+        self.processes[name].callback()
+
+    def test_results(self):
+        results = []
+        stat.CheckBatch(["isAudioCheck", "isVideoCheck", "isAudioCheck", "not a check"], 4, 10, None, [], {},
+                        results.append)
+        self.assertEqual(sorted(self.processes), ["isAudioCheck", "isVideoCheck"])
+        self.finish("isAudioCheck", "0\taudio\n")
+        self.assertEqual(results, [])
+        self.finish("isVideoCheck", "")
+        self.assertEqual(results, [{"not a check": (stat.RUN_CHECK_NO_RESULT, ""),
+                                    "isAudioCheck": (0, "audio"),
+                                    "isVideoCheck": (stat.RUN_CHECK_NO_RESULT, "")}])
+        # Timers of finished checks are removed.
+        self.assertEqual(self.timers, {})
+
+    def test_workers(self):
+        results = []
+        stat.CheckBatch(["isAudioCheck", "isVideoCheck", "isCpuCheck"], 2, 10, None, [], {}, results.append)
+        self.assertEqual(sorted(self.processes), ["isAudioCheck", "isVideoCheck"])
+        self.finish("isVideoCheck", "1\t")
+        self.assertIn("isCpuCheck", self.processes)
+        self.finish("isCpuCheck", "1\t")
+        self.finish("isAudioCheck", "1\t")
+        self.assertEqual(len(results), 1)
+
+    def test_killed_check(self):
+        results = []
+        stat.CheckBatch(["isAudioCheck", "isVideoCheck"], 1, 10, None, [], {}, results.append)
+        # The hanging check is killed by its timer, the next one is started when the output is finished.
+        self.timers.pop(1)()
+        self.assertTrue(self.processes["isAudioCheck"].cancellable.cancelled)
+        self.assertNotIn("isVideoCheck", self.processes)
+        self.finish("isAudioCheck", "0\ttoo late\n")
+        self.finish("isVideoCheck", "0\tvideo\n")
+        self.assertEqual(results, [{"isAudioCheck": (stat.RUN_CHECK_TIMEOUT, ""), "isVideoCheck": (0, "video")}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import importlib.util
+import os
+import unittest
+
+spec = importlib.util.spec_from_file_location(
+    "lightson_ng_stat", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lightson-ng-stat.py"))
+stat = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(stat)
+
+
+class TestLoopScheduler(unittest.TestCase):
+
+    def test_idle_counter_past_timeout(self):
+        # The state is idle already: the delay of lightson-ng is kept, not shortened to nothing.
+        scheduler = stat.LoopScheduler()
+        delay, reason = scheduler.plan(30, "", idle_counter=700, idle_timeout=600, spare_time=10, now=100)
+        self.assertEqual(delay, 30, reason)
+
+    def test_zero_delay_limited_by_min_delay(self):
+        scheduler = stat.LoopScheduler()
+        self.assertEqual(scheduler.plan(0, "", idle_counter=700, idle_timeout=600, now=100)[0], 1)
+        self.assertEqual(scheduler.plan(0, "", idle_counter=700, idle_timeout=600, min_delay=5, now=200)[0], 5)
+
+    def test_held_idle_state_backs_off(self):
+        # The user is idle for long, the video keeps every state held: lightson-ng asks for timeout - spare time.
+        scheduler = stat.LoopScheduler()
+        delays = [scheduler.plan(590, "video", idle_counter=idle, idle_timeout=600, spare_time=10, held=True,
+                                 now=idle)[0] for idle in (1000, 1590, 2180)]
+        self.assertEqual(delays[0], 590)
+        self.assertGreater(delays[1], 590)
+        self.assertLessEqual(delays[2], 2 * 600)
+
+    def test_active_user_backs_off_up_to_timeout(self):
+        scheduler = stat.LoopScheduler()
+        delays = [scheduler.plan(100, "", idle_counter=5, idle_timeout=600, spare_time=10, now=now)[0]
+                  for now in (0, 100, 300, 700)]
+        # The last one is limited by the time left to the timeout.
+        self.assertEqual(delays, [100, 200, 400, 585])
+
+    def test_halved_delay_is_not_zero(self):
+        scheduler = stat.LoopScheduler()
+        delay = None
+        for now, reasons in enumerate(("a", "b", "a", "b")):
+            delay, reason = scheduler.plan(1, reasons, now=now)
+        self.assertEqual(delay, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
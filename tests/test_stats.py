@@ -0,0 +1,167 @@
+import argparse
+import importlib.util
+import logging
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+spec = importlib.util.spec_from_file_location(
+    "lightson_ng_stat", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lightson-ng-stat.py"))
+stat = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(stat)
+# Messages logged by the classes under test are not printed.
+stat.cmdline = argparse.Namespace(log_level="critical", log_syslog=False, print_stdout=False)
+
+
+class TestParseConfig(unittest.TestCase):
+
+    def test_assignments(self):
+        config = stat.parse_config(
+            'delay=50  # seconds\n'
+            'window_name="My Player"\n'
+            "  chrome_app='app id'\n"
+            'empty=\n'
+            'echo "not an assignment"\n'
+            'delay=60\n')
+        self.assertEqual(config, {"delay": "60", "window_name": "My Player", "chrome_app": "app id", "empty": ""})
+
+    def test_arrays(self):
+        config = stat.parse_config(
+            'declare -A checkInterval=(\n'
+            '    [isCpuLoadHighCheck]=30\n'
+            ')\n'
+            'players=(vlc mpv)\n'
+            'broken=(never closed\n')
+        self.assertEqual(config["checkInterval"], "(\n    [isCpuLoadHighCheck]=30\n)")
+        self.assertEqual(config["players"], "(vlc mpv)")
+        self.assertEqual(config["broken"], "(never closed")
+
+    def test_unbalanced_quotes_kept(self):
+        self.assertEqual(stat.parse_config('name="unclosed\n'), {"name": '"unclosed'})
+
+
+class TestMetricsExporter(unittest.TestCase):
+
+    def setUp(self):
+        # The exporter without its HTTP server.
+        self.exporter = object.__new__(stat.MetricsExporter)
+        self.exporter.iterations = 0
+        self.exporter.checkRuns = {}
+        self.exporter.checkHits = {}
+
+    def body(self):
+        headers, body = self.exporter.response.split(b"\r\n\r\n", 1)
+        self.assertIn(b"Content-Length: %d\r\n" % len(body), headers)
+        return body.decode().splitlines()
+
+    def test_metrics(self):
+        results = {"checkPerformed_isAudioCheck": "0", "checkPerformed_isVideoCheck": "1",
+                   "checkPerformed_isCpuCheck": "skipped"}
+        self.exporter.update((("disableReason_idle", "audio"), ("disableReason_sleep", "")), 30, 2, results)
+        self.exporter.update((), 60, 2, {"checkPerformed_isAudioCheck": "0"})
+        lines = self.body()
+        self.assertEqual(lines[-1], "# EOF")
+        self.assertIn("lightson_loop_delay_seconds 60", lines)
+        self.assertIn("lightson_iterations_total 2", lines)
+        self.assertIn('lightson_check_runs_total{check="isAudioCheck"} 2', lines)
+        self.assertIn('lightson_check_hits_total{check="isAudioCheck"} 2', lines)
+        self.assertIn('lightson_check_hits_total{check="isVideoCheck"} 0', lines)
+        self.assertFalse([line for line in lines if "isCpuCheck" in line])
+        self.assertIn("lightson_runtime_errors_total 2", lines)
+
+    def test_states_and_labels(self):
+        self.exporter.update((("disableReason_idle", "x"), ("disableReason_sleep", "")), None, None,
+                             {'checkPerformed_is"Quoted\\Check': "1"})
+        lines = self.body()
+        self.assertIn('lightson_disabled{state="idle"} 1', lines)
+        self.assertIn('lightson_disabled{state="sleep"} 0', lines)
+        self.assertIn('lightson_check_runs_total{check="is\\"Quoted\\\\Check"} 1', lines)
+        # Unknown values are not exported.
+        self.assertFalse([line for line in lines if line.startswith(("lightson_loop_delay_seconds ",
+                                                                     "lightson_runtime_errors_total "))])
+
+
+class TestStatsSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "run", "stats")
+        self.snapshot = stat.StatsSnapshot(self.path, size=1024)
+        self.reader = stat.StatsSnapshotReader(self.path)
+
+    def test_published_stats(self):
+        self.assertIsNone(self.reader.read())
+        self.snapshot.publish({"loopDelay": "30"})
+        self.assertEqual(self.reader.read(check_writer=True), {"loopDelay": "30"})
+        self.snapshot.publish({"loopDelay": "60", "iteration": "2"})
+        self.assertEqual(self.reader.read(), {"loopDelay": "60", "iteration": "2"})
+        self.assertEqual(self.reader.sequence, 4)
+
+    def test_stats_being_written(self):
+        self.snapshot.publish({"loopDelay": "30"})
+        # The writer is stopped in the middle of publish(): the sequence is odd.
+        struct.pack_into("<Q", self.snapshot.map, stat.StatsSnapshot.SEQUENCE_OFFSET, 3)
+        self.assertIsNone(self.reader.read())
+        struct.pack_into("<Q", self.snapshot.map, stat.StatsSnapshot.SEQUENCE_OFFSET, 2)
+        self.assertEqual(self.reader.read(), {"loopDelay": "30"})
+
+    def test_stats_too_big(self):
+        self.snapshot.publish({"loopDelay": "30"})
+        self.snapshot.publish({"reason": "x" * 2000})
+        self.assertEqual(self.reader.read(), {"loopDelay": "30"})
+
+    def test_replaced_snapshot(self):
+        self.snapshot.publish({"loopDelay": "30"})
+        self.assertEqual(self.reader.read(), {"loopDelay": "30"})
+        # The new writer replaces the file: the reader still mapping the old one maps the new one.
+        snapshot = stat.StatsSnapshot(self.path, size=1024)
+        self.addCleanup(snapshot.close)
+        self.assertIsNone(self.reader.read())
+        snapshot.publish({"loopDelay": "60"})
+        self.assertEqual(self.reader.read(), {"loopDelay": "60"})
+
+    def test_closed_snapshot(self):
+        self.snapshot.publish({"loopDelay": "30"})
+        self.reader.read()
+        self.snapshot.close()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIsNone(self.reader.read())
+
+
+class TestRateLimitFilter(unittest.TestCase):
+
+    @staticmethod
+    def record(kind, level=logging.INFO):
+        record = logging.LogRecord("lightson-ng-stat", level, __file__, 1, "message", None, None, "caller")
+        record.kind = kind
+        return record
+
+    def test_kind_limited(self):
+        rateLimit = stat.RateLimitFilter()
+        with mock.patch.object(stat.time, "monotonic", return_value=100):
+            passed = [rateLimit.filter(self.record("audio")) for i in range(stat.LOG_RATE_LIMIT + 5)]
+            # Other kinds and warnings are passed.
+            self.assertTrue(rateLimit.filter(self.record(None)))
+            self.assertTrue(rateLimit.filter(self.record("audio", logging.WARNING)))
+        self.assertEqual(passed, [True] * stat.LOG_RATE_LIMIT + [False] * 5)
+        self.assertEqual(rateLimit.droppedTotal, 5)
+
+        with mock.patch.object(stat.time, "monotonic", return_value=100 + stat.LOG_RATE_PERIOD):
+            record = self.record("audio")
+            self.assertTrue(rateLimit.filter(record))
+        self.assertEqual(record.msg, "message (5 messages of audio dropped)")
+
+    def test_default_kind_is_caller(self):
+        rateLimit = stat.RateLimitFilter()
+        with mock.patch.object(stat.time, "monotonic", return_value=100):
+            for i in range(stat.LOG_RATE_LIMIT):
+                rateLimit.filter(self.record(None))
+            self.assertFalse(rateLimit.filter(self.record(None)))
+        self.assertEqual(rateLimit.dropped, {"caller": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()